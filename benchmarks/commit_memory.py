@@ -0,0 +1,70 @@
+"""
+Measure the peak memory allocated by FVS while scanning and committing a
+synthetic tree of small files, and the size and load cost of the
+resulting manifest.
+
+Usage:
+    python benchmarks/commit_memory.py [files] [files per directory]
+
+The peak is measured with tracemalloc, so it only accounts for Python
+allocations, which is where the per-file records live.
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from fvs.repo import FVSRepo  # noqa: E402
+from fvs.state import FVSState  # noqa: E402
+
+
+def make_tree(path: str, files: int, per_dir: int):
+    for i in range(files):
+        dir_path = os.path.join(path, "drive_c", "windows", f"dir{i // per_dir}")
+        if i % per_dir == 0:
+            os.makedirs(dir_path, exist_ok=True)
+        with open(os.path.join(dir_path, f"file{i}.dll"), "w") as f:
+            f.write(str(i))
+
+
+def measure(label: str, func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<20} peak {peak / 2 ** 20:8.1f} MiB {elapsed:8.2f}s")
+    return result
+
+
+def main():
+    files = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    per_dir = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    path = tempfile.mkdtemp(prefix="fvs-bench-")
+    try:
+        make_tree(path, files, per_dir)
+        repo = FVSRepo(path)
+        print(f"{files} files, {per_dir} per directory")
+        measure("scan (first)", repo.get_unstaged_files)
+        measure("commit (first)", lambda: repo.commit("first"))
+        manifest_size = os.path.getsize(os.path.join(repo.get_state_path(0), "files.json"))
+        print(f"{'manifest size':<20} {manifest_size / 2 ** 20:13.1f} MiB")
+        measure("load manifest", lambda: FVSState(repo, 0))
+
+        for i in range(0, files, 10):
+            with open(os.path.join(path, "drive_c", "windows", f"dir{i // per_dir}", f"file{i}.dll"), "a") as f:
+                f.write("changed")
+        repo = FVSRepo(path)
+        measure("scan (10% changed)", repo.get_unstaged_files)
+        measure("commit (10% changed)", lambda: repo.commit("second"))
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
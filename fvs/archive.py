@@ -0,0 +1,82 @@
+import logging
+import tarfile
+import contextlib
+
+from fvs.exceptions import FVSUnsupportedArchiveFormat
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger("fvs.archive")
+
+
+class FVSArchive:
+    """
+    Streaming tar archives used to export and import states. Archives are
+    always read and written in stream mode (no seeking), so they can be
+    piped, and compressed with gzip or, if the zstandard package is
+    available, zstd.
+    """
+    zstd_magic: bytes = b"\x28\xb5\x2f\xfd"
+
+    @staticmethod
+    def formats() -> list:
+        """
+        Get the list of supported formats, the first being the preferred.
+        """
+        if zstandard is not None:
+            return ["zstd", "gz", "tar"]
+        return ["gz", "tar"]
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_writer(fileobj, archive_format: str = None):
+        """
+        Open a tar archive for writing on the given file object, which is
+        not closed.
+        ...
+        Raises:
+            FVSUnsupportedArchiveFormat: if the format is not supported.
+        """
+        if archive_format is None:
+            archive_format = FVSArchive.formats()[0]
+        if archive_format not in FVSArchive.formats():
+            raise FVSUnsupportedArchiveFormat(archive_format, FVSArchive.formats())
+
+        if archive_format == "zstd":
+            with zstandard.ZstdCompressor().stream_writer(fileobj, closefd=False) as writer:
+                with tarfile.open(fileobj=writer, mode="w|") as tar:
+                    yield tar
+            return
+
+        mode = "w|gz" if archive_format == "gz" else "w|"
+        with tarfile.open(fileobj=fileobj, mode=mode) as tar:
+            yield tar
+
+    @staticmethod
+    @contextlib.contextmanager
+    def open_reader(fileobj):
+        """
+        Open a tar archive for reading from the given file object. The
+        compression is detected from the stream, zstd detection requires
+        a file object supporting peek (e.g. sys.stdin.buffer or files
+        opened in binary buffered mode).
+        ...
+        Raises:
+            FVSUnsupportedArchiveFormat: if the stream is zstd compressed
+            but the zstandard package is not available.
+        """
+        magic = fileobj.peek(4)[:4] if hasattr(fileobj, "peek") else b""
+
+        if magic == FVSArchive.zstd_magic:
+            if zstandard is None:
+                raise FVSUnsupportedArchiveFormat("zstd", FVSArchive.formats())
+            with zstandard.ZstdDecompressor().stream_reader(fileobj, closefd=False) as reader:
+                with tarfile.open(fileobj=reader, mode="r|") as tar:
+                    yield tar
+            return
+
+        with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+            yield tar
@@ -0,0 +1,54 @@
+import logging
+
+logger = logging.getLogger("fvs.change")
+
+
+class FVSChange:
+    """
+    A change of a file in the working tree, compared with a state. It is
+    yielded by FVSRepo.iter_changes as soon as the change is discovered and
+    is also the entry type of the lists returned by get_unstaged_files.
+    Status values:
+        added:    the file is not in the state.
+        modified: the file content differs from the state.
+        removed:  the file is in the state but not in the working tree.
+        intact:   the file didn't change, only yielded on request.
+        moved:    the same file was removed from old_relative_path, in the
+                  state, and added to relative_path, in the working tree.
+                  Moves are yielded once the scan is over, as the removed
+                  files are known only then.
+    """
+    __slots__ = ("status", "file_name", "sha1", "relative_path", "stat", "old_relative_path")
+    statuses: list = ["added", "modified", "removed", "intact", "moved"]
+    symbols: dict = {"added": "A", "modified": "M", "removed": "D", "intact": " ", "moved": "R"}
+
+    def __init__(self, status: str, file_name: str, sha1: str, relative_path: str, stat: tuple = None,
+                 old_relative_path: str = None):
+        self.status = status
+        self.file_name = file_name
+        self.sha1 = sha1
+        self.relative_path = relative_path
+        self.stat = stat
+        self.old_relative_path = old_relative_path
+
+    def as_dict(self) -> dict:
+        return {
+            "status": self.status,
+            "file_name": self.file_name,
+            "sha1": self.sha1,
+            "relative_path": self.relative_path,
+            "stat": self.stat,
+            "old_relative_path": self.old_relative_path
+        }
+
+    def as_porcelain(self) -> str:
+        """
+        Get the change as a stable, script friendly line: the status
+        symbol followed by the relative path (the old one too for moves).
+        """
+        if self.status == "moved":
+            return f"{self.symbols[self.status]} {self.old_relative_path} -> {self.relative_path}"
+        return f"{self.symbols[self.status]} {self.relative_path}"
+
+    def __repr__(self) -> str:
+        return f"FVSChange({self.status}, {self.relative_path})"
@@ -0,0 +1,199 @@
+import os
+import time
+import orjson
+import logging
+import contextlib
+
+from fvs.journal import FVSJournal
+
+logger = logging.getLogger("fvs.checkpoint")
+
+
+class FVSCheckpoint:
+    """
+    The progress of a commit, saved in .fvs/checkpoint.json so that an
+    interrupted commit can be resumed instead of starting over. It keeps
+    the sha1 of the hashed files with their stat fingerprint, so files not
+    changed since are not hashed again (racy files, with no fingerprint,
+    are not kept), and the objects written by the commit. The checkpoint
+    is saved every save_interval seconds and when the commit fails, then
+    discarded once the commit is published.
+
+    Objects are planned (listed as pending) before being written and
+    listed as written once synced, written objects survive the rollback
+    of the commit and are reused by the next one. Pending objects may be
+    incomplete after a power loss, they are deleted before resuming, see
+    FVSRepo.commit, and both are released on abort if no state references
+    them.
+
+    The checkpoint is written straight to disk, not through the journal,
+    since it must survive the rollback of the commit it belongs to. It
+    records the hash mode of the repository, a checkpoint made with another
+    hash mode is ignored (see FVSRepo.migrate_hashes).
+
+    Format:
+        {
+            "version": 1,
+            "hash": "<hash mode>",
+            "message": "<message>",
+            "ignore": ["<pattern>", ...],
+            "paths": ["<path>", ...] or null,
+            "hashes": {"<relative path>": [size, mtime_ns, ctime_ns, ino, "<sha1>"]},
+            "pending": {"<sha1>": "<file name>"},
+            "objects": {"<sha1>": ["<file name>", "<codec>", size]}
+        }
+    """
+    version: int = 1
+    save_interval: float = 30.0
+    file_path: str = ".fvs/checkpoint.json"
+
+    def __init__(self, repo: 'FVSRepo'):
+        self.__repo = repo
+        self.__path = os.path.join(repo.repo_path, self.file_path)
+        self.__checkpoint = {
+            "version": self.version, "hash": repo.hash_mode, "message": None, "ignore": [], "paths": None,
+            "hashes": {}, "pending": {}, "objects": {}
+        }
+        self.__loaded = False
+        self.__unsynced = []
+        self.__saved_at = time.monotonic()
+        self.__load()
+
+    def __load(self):
+        if not os.path.exists(self.__path):
+            return
+
+        try:
+            with open(self.__path, "rb") as f:
+                checkpoint = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            logger.debug("Unreadable checkpoint, ignoring it.")
+            return
+        if checkpoint.get("version") != self.version:
+            logger.debug("Unsupported checkpoint version, ignoring it.")
+            return
+        if checkpoint.get("hash") != self.__repo.hash_mode:
+            logger.debug("Checkpoint made with another hash mode, ignoring it.")
+            return
+        self.__checkpoint = checkpoint
+        self.__loaded = True
+
+    @property
+    def exists(self) -> bool:
+        """
+        Check if there is a usable checkpoint of an interrupted commit.
+        """
+        return self.__loaded
+
+    @property
+    def message(self) -> str:
+        return self.__checkpoint["message"]
+
+    @property
+    def ignore(self) -> list:
+        return self.__checkpoint["ignore"]
+
+    @property
+    def paths(self) -> list:
+        return self.__checkpoint["paths"]
+
+    def start(self, message: str, ignore: list, paths: list):
+        """
+        Record the arguments of the commit, so it can be resumed as it was
+        started.
+        """
+        self.__checkpoint["message"] = message
+        self.__checkpoint["ignore"] = ignore
+        self.__checkpoint["paths"] = paths
+
+    def get_sha1(self, relative_path: str, stat: tuple) -> str:
+        """
+        Get the sha1 of a file hashed by the interrupted commit, None if
+        the file was not hashed or its fingerprint changed since.
+        """
+        entry = self.__checkpoint["hashes"].get(relative_path)
+        if entry is None or stat is None or tuple(entry[:-1]) != stat:
+            return None
+        return entry[-1]
+
+    def add_hash(self, relative_path: str, stat: tuple, sha1: str):
+        if stat is None:
+            return
+        self.__checkpoint["hashes"][relative_path] = [*stat, sha1]
+        self.save_if_due()
+
+    def plan_objects(self, files: list):
+        """
+        List the objects of the given FVSFile objects as pending, saving
+        the checkpoint right away, before any of them is written.
+        """
+        pending = self.__checkpoint["pending"]
+        for file in files:
+            pending[file.sha1] = file.file_name
+        self.save()
+
+    def add_object(self, sha1: str, path: str, written: tuple):
+        """
+        List a written object with its codec and size, as returned by
+        FVSFile.write. It is synced before the next save.
+        """
+        file_name = self.__checkpoint["pending"].pop(sha1, None)
+        self.__checkpoint["objects"][sha1] = [file_name, *written]
+        self.__unsynced.append(path)
+        self.save_if_due()
+
+    def get_object(self, sha1: str) -> tuple:
+        """
+        Get the codec and size of an object written by the interrupted
+        commit, None if it was not written.
+        """
+        entry = self.__checkpoint["objects"].get(sha1)
+        return tuple(entry[1:]) if entry is not None else None
+
+    def has_object(self, sha1: str) -> bool:
+        """
+        Check if the object is written or pending, i.e. if it must survive
+        the rollback of the commit.
+        """
+        return sha1 in self.__checkpoint["objects"] or sha1 in self.__checkpoint["pending"]
+
+    def iter_objects(self):
+        """
+        Yield the (file name, sha1) pairs of the written and pending
+        objects.
+        """
+        for sha1, entry in self.__checkpoint["objects"].items():
+            yield entry[0], sha1
+        yield from self.iter_pending()
+
+    def iter_pending(self):
+        for sha1, file_name in self.__checkpoint["pending"].items():
+            yield file_name, sha1
+
+    def drop_pending(self):
+        self.__checkpoint["pending"] = {}
+
+    def save_if_due(self):
+        if time.monotonic() - self.__saved_at >= self.save_interval:
+            self.save()
+
+    def save(self):
+        """
+        Sync the objects written since the last save, then replace the
+        checkpoint atomically.
+        """
+        for path in self.__unsynced:
+            FVSJournal.fsync(path)
+        self.__unsynced = []
+
+        with open(self.__path + FVSJournal.tmp_suffix, "wb") as f:
+            f.write(orjson.dumps(self.__checkpoint))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.__path + FVSJournal.tmp_suffix, self.__path)
+        self.__saved_at = time.monotonic()
+        logger.debug(f"Checkpoint saved, {len(self.__checkpoint['hashes'])} files hashed.")
+
+    def discard(self):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.__path)
@@ -1,10 +1,17 @@
 import os
 import sys
 import argparse
+import orjson
 import datetime
 import contextlib
 from fvs.repo import FVSRepo
-from fvs.exceptions import FVSNothingToCommit, FVSEmptyCommitMessage, FVSStateNotFound, FVSNothingToRestore
+from fvs.transport import FVSLocalTransport
+from fvs.archive import FVSArchive
+from fvs.scheduler import FVSScheduler
+from fvs.exceptions import FVSNothingToCommit, FVSEmptyCommitMessage, FVSStateNotFound, FVSNothingToRestore, \
+    FVSStoreCompressionMismatch, FVSRemoteCompressionMismatch, FVSDivergedStates, FVSUnsupportedArchiveFormat, \
+    FVSInvalidCheckoutPath, FVSInvalidStateRange, FVSStoreHashModeMismatch, FVSRemoteHashModeMismatch, \
+    FVSNoCommitToResume, FVSStateZeroNotDeletable, FVSNotARepository
 
 version = 'FVS 0.3.4'
 
@@ -19,21 +26,99 @@ def fvs_cli():
     init_parser.add_argument('-i', '--ignore', help='patterns to ignore', action='append', default=[], required=False)
     init_parser.add_argument('-p', '--path', help='path to the repository', default=os.getcwd())
     init_parser.add_argument('-c', '--use-compression', help='use compression', action='store_true', default=False)
+    init_parser.add_argument('-s', '--store', help='path to a shared object store', default=None)
+    init_parser.add_argument('--io-order', help='order of file reads and writes, for rotational disks',
+                             choices=FVSScheduler.orders, default=None)
+
+    attach_parser = subparsers.add_parser("attach", help="Move the repository objects to a shared object store")
+    attach_parser.add_argument('-s', '--store', help='path to the shared object store', required=True)
 
     commit_parser = subparsers.add_parser("commit", help="Commit changes to the repository")
     commit_parser.add_argument('-i', '--ignore', help='patterns to ignore', action='append', default=[], required=False)
-    commit_parser.add_argument('-m', '--message', help='commit message', nargs='+', required=True)
+    commit_parser.add_argument('-m', '--message', help='commit message', nargs='+', required=False)
+    commit_parser.add_argument('-p', '--path', help='only scan this path, keeping the rest as is', action='append',
+                               default=None, required=False)
+    commit_parser.add_argument('--resume', help='resume the interrupted commit', action='store_true', default=False)
+    commit_parser.add_argument('--abort', help='abort the interrupted commit', action='store_true', default=False)
+
+    status_parser = subparsers.add_parser("status", help="Show the changes in the working tree")
+    status_parser.add_argument('-i', '--ignore', help='patterns to ignore', action='append', default=[], required=False)
+    status_parser.add_argument('-p', '--path', help='only check this path', action='append', default=None, required=False)
+    status_parser.add_argument('--porcelain', help='stream one stable line per change', action='store_true', default=False)
+    status_parser.add_argument('--intact', help='also list intact files', action='store_true', default=False)
 
     states_parser = subparsers.add_parser("states", help="List all states in the repository")
+    states_parser.add_argument('-n', '--limit', help='list at most N states, the last ones unless --since is given',
+                               type=int, default=None)
+    states_parser.add_argument('--since', help='list the states from this id', type=int, default=None)
+    states_parser.add_argument('--json', help='output JSON lines', action='store_true', default=False)
 
     restore_parser = subparsers.add_parser("restore", help="Restore a state from the repository")
     restore_parser.add_argument('-i', '--ignore', help='patterns to ignore', action='append', default=[], required=False)
     restore_parser.add_argument('-s', '--state-id', help='state id', required=True)
+    restore_parser.add_argument('-p', '--path', help='restore only this path (non destructive)', action='append', default=None, required=False)
+
+    squash_parser = subparsers.add_parser("squash", help="Squash a range of states into the last one")
+    squash_parser.add_argument('range', help='states range, e.g. 3..7')
+    squash_parser.add_argument('-m', '--message', help='message of the squashed state', nargs='+', default=None)
+
+    prune_parser = subparsers.add_parser("prune", help="Squash the states not kept by a retention policy")
+    prune_parser.add_argument('--keep-last', help='keep the last N states', type=int, default=None)
+    prune_parser.add_argument('--keep-daily', help='keep the last state of the last N days', type=int, default=None)
+    prune_parser.add_argument('--keep-weekly', help='keep the last state of the last N weeks', type=int, default=None)
+
+    push_parser = subparsers.add_parser("push", help="Push states to another repository")
+    push_parser.add_argument('path', help='path to the other repository')
+    push_parser.add_argument('-j', '--jobs', help='parallel object transfers', type=int, default=8)
+
+    pull_parser = subparsers.add_parser("pull", help="Pull states from another repository")
+    pull_parser.add_argument('path', help='path to the other repository')
+    pull_parser.add_argument('-j', '--jobs', help='parallel object transfers', type=int, default=8)
+
+    checkout_parser = subparsers.add_parser("checkout", help="Build a state in another directory")
+    checkout_parser.add_argument('-s', '--state-id', help='state id', required=True)
+    checkout_parser.add_argument('-t', '--to', help='destination directory', required=True)
+    checkout_parser.add_argument('--method', help='how files are created from the object store',
+                                 choices=['auto', 'reflink', 'hardlink', 'copy'], default='auto')
+    checkout_parser.add_argument('-j', '--jobs', help='parallel file operations', type=int, default=8)
+
+    diff_parser = subparsers.add_parser("diff", help="Show the changes between two states")
+    diff_parser.add_argument('state_a', help='first state id')
+    diff_parser.add_argument('state_b', help='second state id')
+    diff_parser.add_argument('--json', help='output JSON lines', action='store_true', default=False)
+
+    export_parser = subparsers.add_parser("export", help="Export a state as a tar archive")
+    export_parser.add_argument('-s', '--state-id', help='state id', required=True)
+    export_parser.add_argument('-f', '--format', help='archive format', choices=FVSArchive.formats(),
+                               default=FVSArchive.formats()[0])
+    export_parser.add_argument('-o', '--output', help='output file (default: stdout)', default=None)
+
+    import_parser = subparsers.add_parser("import", help="Import a tar archive as a new state")
+    import_parser.add_argument('-m', '--message', help='commit message', nargs='+', required=True)
+    import_parser.add_argument('-f', '--file', help='input file (default: stdin)', default=None)
+
+    io_order_parser = subparsers.add_parser("io-order", help="Show or set the order of file reads and writes")
+    io_order_parser.add_argument('order', help='I/O order', choices=FVSScheduler.orders, nargs='?', default=None)
+
+    stats_parser = subparsers.add_parser("stats", help="Show the object store statistics per codec")
+    stats_parser.add_argument('--json', help='output JSON', action='store_true', default=False)
+
+    subparsers.add_parser("migrate-hashes", help="Address objects by content alone, merging duplicates")
 
     args = parser.parse_args()
 
     if args.command == 'init':
-        repo = FVSRepo(args.path, args.use_compression)
+        try:
+            repo = FVSRepo(args.path, args.use_compression, store=args.store)
+        except FVSStoreCompressionMismatch:
+            sys.stderr.write("The store {} uses a different compression setting\n".format(args.store))
+            sys.exit(1)
+        except FVSStoreHashModeMismatch:
+            sys.stderr.write("The store {} uses a different hash mode\n".format(args.store))
+            sys.exit(1)
+
+        if args.io_order is not None:
+            repo.set_io_order(args.io_order)
 
         with contextlib.suppress(FVSNothingToCommit):
             repo.commit("Init", args.ignore)
@@ -43,13 +128,18 @@ def fvs_cli():
 
     elif args.command == 'commit':
         repo = FVSRepo(os.getcwd())
-        message = ' '.join(args.message)
+        message = ' '.join(args.message) if args.message is not None else None
 
         try:
-            sys.stdout.write("Committing...\n")
-            res = repo.commit(message, args.ignore)
+            if args.abort:
+                released = repo.abort_commit()
+                sys.stdout.write("Aborted the interrupted commit, {} objects released\n".format(released))
+                sys.exit(0)
+
+            sys.stdout.write("Resuming...\n" if args.resume else "Committing...\n")
+            res = repo.commit(message, args.ignore, args.path, resume=args.resume)
             sep = "-" * 10
-            sys.stdout.write("\nCommitted state {}\nMessage: {}\nDate: {}\n{}\nAdded files: {}\nRemoved files: {}\nModified files: {}\nIntact files: {}\n".format(
+            sys.stdout.write("\nCommitted state {}\nMessage: {}\nDate: {}\n{}\nAdded files: {}\nRemoved files: {}\nModified files: {}\nIntact files: {}\nMoved files: {}\n".format(
                 res['state_id'],
                 res['message'],
                 datetime.datetime.fromtimestamp(res['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
@@ -57,8 +147,11 @@ def fvs_cli():
                 res["added"],
                 res["removed"],
                 res["modified"],
-                res["intact"]
+                res["intact"],
+                res["moved"]
             ))
+            if res["lock_wait"] > 0.01:
+                sys.stdout.write("Waited {:.2f}s for the repository lock\n".format(res["lock_wait"]))
             sys.exit(0)
         except FVSNothingToCommit:
             sys.stderr.write("Nothing to commit\n")
@@ -66,15 +159,58 @@ def fvs_cli():
         except FVSEmptyCommitMessage:
             sys.stderr.write("Empty commit message\n")
             sys.exit(1)
+        except FVSNoCommitToResume:
+            sys.stderr.write("There is no interrupted commit\n")
+            sys.exit(1)
+
+    elif args.command == 'status':
+        repo = FVSRepo(os.getcwd())
+        count = 0
+        for change in repo.iter_changes(args.ignore, paths=args.path, intact=args.intact):
+            if args.porcelain:
+                sys.stdout.write("{}\n".format(change.as_porcelain()))
+                sys.stdout.flush()
+            elif change.status == "moved":
+                sys.stdout.write("{:>8}: {} -> {}\n".format(change.status, change.old_relative_path, change.relative_path))
+            else:
+                sys.stdout.write("{:>8}: {}\n".format(change.status, change.relative_path))
+            count += change.status != "intact"
+
+        if count == 0 and not args.porcelain:
+            sys.stdout.write("Nothing to commit\n")
+        sys.exit(0)
+
+    elif args.command == 'attach':
+        repo = FVSRepo(os.getcwd())
+        try:
+            repo.attach_store(args.store)
+            sys.stdout.write("Attached to store {}\n".format(args.store))
+            sys.exit(0)
+        except FVSStoreCompressionMismatch:
+            sys.stderr.write("The store {} uses a different compression setting\n".format(args.store))
+            sys.exit(1)
+        except FVSStoreHashModeMismatch:
+            sys.stderr.write("The store {} uses a different hash mode, run fvs migrate-hashes first\n".format(
+                args.store))
+            sys.exit(1)
 
     elif args.command == 'states':
         repo = FVSRepo(os.getcwd())
 
         if len(repo.states) == 0:
-            sys.stdout.write("No states\n")
+            if not args.json:
+                sys.stdout.write("No states\n")
             sys.exit(0)
 
-        for k, v in repo.states.items():
+        for k in repo.states.page(args.since, args.limit):
+            v = repo.states[k]
+            if args.json:
+                sys.stdout.buffer.write(orjson.dumps({
+                    "state_id": k, "message": v["message"], "timestamp": v["timestamp"],
+                    "active": k == repo.active_state_id
+                }) + b"\n")
+                continue
+
             sym = "\033[32m➔" if k == repo.active_state_id else "-"
             sys.stdout.write(
                 "{} ({}): {}\n\t{}\n\n\033[0m".format(
@@ -86,7 +222,7 @@ def fvs_cli():
     elif args.command == 'restore':
         repo = FVSRepo(os.getcwd())
         try:
-            repo.restore_state(args.state_id, args.ignore)
+            repo.restore_state(args.state_id, args.ignore, args.path)
             sys.stdout.write("Restored state\n")
             sys.exit(0)
         except FVSStateNotFound:
@@ -96,6 +232,120 @@ def fvs_cli():
             sys.stderr.write("Nothing to restore from state {}\n".format(args.state_id))
             sys.exit(1)
 
+    elif args.command == 'squash':
+        repo = FVSRepo(os.getcwd())
+        state_a, _, state_b = args.range.partition("..")
+        message = ' '.join(args.message) if args.message else None
+        try:
+            removed = repo.squash_states(state_a, state_b, message)
+            sys.stdout.write("Squashed {} states into state {}\n".format(len(removed), state_b))
+            sys.exit(0)
+        except ValueError:
+            sys.stderr.write("Invalid range {}, expected A..B\n".format(args.range))
+            sys.exit(1)
+        except (FVSStateNotFound, FVSInvalidStateRange, FVSStateZeroNotDeletable) as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
+    elif args.command == 'prune':
+        if args.keep_last is None and args.keep_daily is None and args.keep_weekly is None:
+            sys.stderr.write("No retention policy given\n")
+            sys.exit(1)
+
+        repo = FVSRepo(os.getcwd())
+        removed = repo.prune_states(args.keep_last, args.keep_daily, args.keep_weekly)
+        sys.stdout.write("Removed {} states\n".format(len(removed)))
+        checkpoint = repo.get_checkpoint_stats()
+        if checkpoint is not None:
+            sys.stderr.write("{} objects ({} bytes) of an interrupted commit were kept, \
+run fvs commit --resume or --abort\n".format(checkpoint["objects"], checkpoint["stored"]))
+        sys.exit(0)
+
+    elif args.command in ['push', 'pull']:
+        repo = FVSRepo(os.getcwd())
+        transport = FVSLocalTransport(args.path)
+        try:
+            if args.command == 'push':
+                state_ids = repo.push(transport, args.jobs)
+            else:
+                state_ids = repo.pull(transport, args.jobs)
+        except FVSRemoteCompressionMismatch:
+            sys.stderr.write("Repositories use different compression settings\n")
+            sys.exit(1)
+        except FVSRemoteHashModeMismatch:
+            sys.stderr.write("Repositories use different hash modes, run fvs migrate-hashes on the older one\n")
+            sys.exit(1)
+        except (FVSDivergedStates, FVSNotARepository) as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
+        if len(state_ids) == 0:
+            sys.stdout.write("Already up to date\n")
+        else:
+            sys.stdout.write("Transferred {} states ({} to {})\n".format(len(state_ids), state_ids[0], state_ids[-1]))
+        sys.exit(0)
+
+    elif args.command == 'checkout':
+        repo = FVSRepo(os.getcwd())
+        try:
+            res = repo.checkout(args.state_id, args.to, args.method, args.jobs)
+            sys.stdout.write("Checked out state {} in {} ({} reflinked, {} hard linked, {} copied)\n".format(
+                args.state_id, args.to, res["reflink"], res["hardlink"], res["copy"]))
+            sys.exit(0)
+        except (FVSStateNotFound, FVSInvalidCheckoutPath, OSError) as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
+    elif args.command == 'diff':
+        repo = FVSRepo(os.getcwd())
+        symbols = {"added": "A", "removed": "D", "modified": "M", "moved": "R"}
+        try:
+            for change in repo.diff(args.state_a, args.state_b):
+                if args.json:
+                    sys.stdout.buffer.write(orjson.dumps(change) + b"\n")
+                elif change["status"] == "moved":
+                    sys.stdout.write("R {} -> {}\n".format(change["old_relative_path"], change["relative_path"]))
+                else:
+                    sys.stdout.write("{} {}\n".format(symbols[change["status"]], change["relative_path"]))
+            sys.exit(0)
+        except FVSStateNotFound as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
+    elif args.command == 'export':
+        repo = FVSRepo(os.getcwd())
+        try:
+            if args.output is None:
+                repo.export_state(args.state_id, sys.stdout.buffer, args.format)
+                sys.stdout.buffer.flush()
+            else:
+                with open(args.output, "wb") as f:
+                    repo.export_state(args.state_id, f, args.format)
+            sys.exit(0)
+        except FVSStateNotFound:
+            sys.stderr.write("State {} not found\n".format(args.state_id))
+            sys.exit(1)
+
+    elif args.command == 'import':
+        repo = FVSRepo(os.getcwd())
+        message = ' '.join(args.message)
+        try:
+            if args.file is None:
+                res = repo.import_state(sys.stdin.buffer, message)
+            else:
+                with open(args.file, "rb") as f:
+                    res = repo.import_state(f, message)
+            sys.stdout.write("Imported state {}\nAdded files: {}\nRemoved files: {}\nModified files: {}\n\
+Intact files: {}\nMoved files: {}\n".format(res["state_id"], res["added"], res["removed"], res["modified"],
+                                                res["intact"], res["moved"]))
+            sys.exit(0)
+        except FVSNothingToCommit:
+            sys.stderr.write("Nothing to import\n")
+            sys.exit(1)
+        except FVSUnsupportedArchiveFormat as e:
+            sys.stderr.write("{}\n".format(e))
+            sys.exit(1)
+
     elif args.command == 'active':
         repo = FVSRepo(os.getcwd())
         if repo.active_state_id in [-1, None]:
@@ -104,6 +354,40 @@ def fvs_cli():
         sys.stdout.write("Active state is {}\n".format(repo.active_state_id))
         sys.exit(0)
 
+    elif args.command == 'io-order':
+        repo = FVSRepo(os.getcwd())
+        if args.order is not None:
+            repo.set_io_order(args.order)
+        sys.stdout.write("I/O order is {}\n".format(repo.scheduler.order))
+        sys.exit(0)
+
+    elif args.command == 'stats':
+        repo = FVSRepo(os.getcwd())
+        stats = repo.get_store_stats()
+        checkpoint = repo.get_checkpoint_stats()
+        if checkpoint is not None:
+            sys.stderr.write("{} objects ({} bytes) of an interrupted commit are not counted, \
+run fvs commit --resume or --abort\n".format(checkpoint["objects"], checkpoint["stored"]))
+        if args.json:
+            sys.stdout.write(orjson.dumps(stats).decode() + "\n")
+            sys.exit(0)
+
+        sys.stdout.write("{:<10} {:>10} {:>14} {:>14} {:>7}\n".format("codec", "objects", "size", "stored", "ratio"))
+        for codec, entry in sorted(stats.items()):
+            ratio = "{:.2f}".format(entry["stored"] / entry["size"]) if entry["size"] else "-"
+            sys.stdout.write("{:<10} {:>10} {:>14} {:>14} {:>7}\n".format(
+                codec, entry["objects"], entry["size"], entry["stored"], ratio))
+            if entry["unsized"]:
+                sys.stdout.write("{:<10} {:>10} objects of unknown size\n".format("", entry["unsized"]))
+        sys.exit(0)
+
+    elif args.command == 'migrate-hashes':
+        repo = FVSRepo(os.getcwd())
+        res = repo.migrate_hashes()
+        sys.stdout.write("Objects are addressed by content: {} objects before, {} after\n".format(
+            res["objects"], res["migrated"]))
+        sys.exit(0)
+
     else:
         parser.print_help()
         sys.exit(1)
@@ -0,0 +1,131 @@
+import os
+import stat
+import zlib
+import tarfile
+import logging
+from typing import Union
+
+from fvs.hasher import FVSHasher
+
+logger = logging.getLogger("fvs.codec")
+
+
+class FVSCodec:
+    """
+    Decide how each object is stored when the repository uses compression.
+    Objects are tar archives holding a single member named after the sha1,
+    which keeps the file metadata, but only the ones worth it are gzipped:
+    a prefix of the file is trial-compressed first and files whose sample
+    doesn't shrink (archives, cabinets, images, media, ...) are stored in
+    a plain tar. The gzip level depends on the file size, so large files
+    don't keep a core busy for a marginal gain.
+
+    Sparse files keep their extent map in the member pax headers, so
+    restores write only the data and recreate the holes.
+
+    Plain tar and gzip streams are told apart by their magic bytes, so
+    objects can always be read with tarfile "r:*", whatever the codec, and
+    objects received from other repositories need no extra information.
+
+    Codecs:
+        raw:      a plain copy, the format of stores without compression.
+        tar:      a tar archive, not compressed.
+        gz:<n>:   a gzipped tar archive, compressed at level n.
+        gz:       a gzipped tar archive of unknown level (e.g. received).
+    """
+    sample_size: int = 2 ** 16
+    min_sample_size: int = 2 ** 12
+    min_gain: float = 0.1
+    tar_min_size: int = 2 ** 20
+    fast_level: int = 1
+    levels: list = [(2 ** 20, 9), (2 ** 26, 6)]
+    gzip_magic: bytes = b"\x1f\x8b"
+    extents_header: str = "FVS.extents"
+
+    @classmethod
+    def choose(cls, path: str) -> str:
+        """
+        Choose the codec for the given file. Files smaller than
+        tar_min_size are always gzipped, as the padding of a plain tar
+        would cost more than compressing them at the fastest level, files
+        smaller than min_sample_size are not even sampled. Sparse files
+        are always gzipped, their holes are zeros in the tar stream.
+        """
+        _stat = os.lstat(path)
+        if not stat.S_ISREG(_stat.st_mode):
+            return f"gz:{cls.levels[0][1]}"
+
+        sample = b""
+        if FVSHasher.is_sparse(_stat):
+            logger.debug(f"{path} is sparse.")
+        elif _stat.st_size >= cls.min_sample_size:
+            with open(path, "rb") as f:
+                sample = f.read(cls.sample_size)
+
+        if sample and len(zlib.compress(sample, cls.fast_level)) > len(sample) * (1 - cls.min_gain):
+            logger.debug(f"{path} looks incompressible.")
+            if _stat.st_size >= cls.tar_min_size:
+                return "tar"
+            return f"gz:{cls.fast_level}"
+
+        for max_size, level in cls.levels:
+            if _stat.st_size < max_size:
+                return f"gz:{level}"
+        return f"gz:{cls.fast_level}"
+
+    @classmethod
+    def write(cls, path: str, dest: str, arcname: str, codec: str):
+        """
+        Write the given file to dest as an object encoded with codec. The
+        data extents of sparse files are recorded in a pax header, so their
+        holes can be recreated on restore, see get_extents.
+        """
+        if codec == "tar":
+            mode, options = "w", {}
+        else:
+            mode, options = "w:gz", {"compresslevel": int(codec.split(":")[1])}
+
+        with tarfile.open(dest, mode, format=tarfile.PAX_FORMAT, **options) as tar:
+            info = tar.gettarinfo(path, arcname=arcname)
+            if not info.isreg():
+                tar.addfile(info)
+                return
+
+            with open(path, "rb") as f:
+                if FVSHasher.is_sparse(os.fstat(f.fileno())):
+                    extents = FVSHasher.get_extents(f.fileno(), info.size)
+                    if extents is not None:
+                        info.pax_headers[cls.extents_header] = ",".join(
+                            f"{offset}:{length}" for offset, length in extents)
+                tar.addfile(info, f)
+
+    @classmethod
+    def get_extents(cls, info: tarfile.TarInfo) -> Union[list, None]:
+        """
+        Get the data extents recorded for a sparse object, as a list of
+        (offset, length) tuples, None if the object is not sparse.
+        """
+        extents = info.pax_headers.get(cls.extents_header)
+        if extents is None:
+            return None
+        return [tuple(int(value) for value in extent.split(":")) for extent in extents.split(",") if extent]
+
+    @classmethod
+    def encode(cls, path: str, tmp_path: str, dest: str, arcname: str) -> tuple:
+        """
+        Choose the codec for the given file and write it to tmp_path, then
+        rename it to dest. It returns the codec and the size of the file.
+        """
+        codec = cls.choose(path)
+        cls.write(path, tmp_path, arcname, codec)
+        os.replace(tmp_path, dest)
+        return codec, os.lstat(path).st_size
+
+    @classmethod
+    def detect(cls, object_path: str) -> str:
+        """
+        Detect the codec of an object stored with compression, the gzip
+        level can't be told from the stream.
+        """
+        with open(object_path, "rb") as f:
+            return "gz" if f.read(2) == cls.gzip_magic else "tar"
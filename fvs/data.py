@@ -2,21 +2,26 @@ import os
 import orjson
 import logging
 from typing import Union
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 from fvs.exceptions import FVSDataHasNoState, VFSTransactionAlreadyStarted
+from fvs.codec import FVSCodec
+from fvs.file import FVSFile
+from fvs.utils import FVSUtils
+from fvs.hasher import FVSHasher
+from fvs.record import FVSCatalogRow
 
 logger = logging.getLogger("fvs.data")
 
 
 # noinspection PyTypeChecker
 class FVSData:
+    write_workers: int = os.cpu_count() or 1
+    batch_size: int = 2 ** 23
+    batch_files: int = 256
+    max_in_flight: int = 2 ** 28
     __data_conf: dict = None
     __data_conf_path: str = None
-    __data_int_paths: list = [
-        "a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m",
-        "n", "o", "p", "q", "r", "s", "t", "u", "v", "w", "x", "y", "z",
-        "0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "-"
-    ]
     __state: 'FVSState' = None
     __transaction: list = None
     __transaction_type: int = None  # 0: add, 1: remove
@@ -26,9 +31,23 @@ class FVSData:
         Initialize the FVSData.
         """
         self.__data_path = os.path.join(repo.repo_path, ".fvs/data")
+        self.__repo = repo
+        self.__store = repo.store
+        self.__journal = repo.journal
         self.__state = state
-        self.__update_fvs_path()
-        self.__load_config()
+        self.__data_conf_path = os.path.join(self.__data_path, "data.json")
+
+        """
+        The catalog is parsed once per repository session and shared by all
+        the FVSData instances, which see each other changes. It is read with
+        the read lock held, so it matches the states the repository loaded.
+        """
+        with repo.lock.shared():
+            self.__data_conf = repo.catalog
+            if self.__data_conf is None:
+                self.__update_fvs_path()
+                self.__load_config()
+                repo.catalog = self.__data_conf
 
     def __update_fvs_path(self):
         """
@@ -36,75 +55,171 @@ class FVSData:
         performs some checks to ensure that the data/ directory is valid,
         fixing it if necessary.
         """
-        self.__data_conf_path = os.path.join(self.__data_path, "data.json")
-
-        """
-        This check if the data/ directory exists. If not, create it.
-        """
         if not os.path.exists(self.__data_path):
-            os.makedirs(os.path.join(self.__data_path, dir))
-
-        """
-        This check if internal paths (__data_int_paths) exist. If not, 
-        create them.
-        """
-        for int_path in self.__data_int_paths:
-            if not os.path.exists(os.path.join(self.__data_path, int_path)):
-                os.makedirs(os.path.join(self.__data_path, int_path))
+            os.makedirs(self.__data_path)
 
         """
         Check if the data.json file exists. If not, create it and write the
         default configuration.
         """
-        if not os.path.exists(self.__data_conf_path):
-            with open(self.__data_conf_path, "wb") as f:
-                self.__data_conf = {}
-                f.write(orjson.dumps(self.__data_conf, f, option=orjson.OPT_NON_STR_KEYS,))
+        if not os.path.exists(self.__journal.resolve(self.__data_conf_path)):
+            self.__data_conf = {}
+            self.__journal.write(self.__data_conf_path, orjson.dumps(self.__data_conf, option=orjson.OPT_NON_STR_KEYS))
 
     def __load_config(self):
         """
-        Load the data configuration from the data/data.json file.
+        Load the data configuration from the data/data.json file, as a
+        FVSCatalogRow for each object.
         """
-        with open(self.__data_conf_path, "r") as f:
-            self.__data_conf = orjson.loads(f.read())
+        with open(self.__journal.resolve(self.__data_conf_path), "rb") as f:
+            self.__data_conf = {
+                sha1: FVSCatalogRow.from_dict(row) for sha1, row in orjson.loads(f.read()).items()
+            }
 
     def __save_config(self):
         """
-        Save the data configuration to the data/data.json file.
+        Save the data configuration to the data/data.json file, through the
+        journal so it is replaced atomically on commit.
         """
-        with open(self.__data_conf_path, "wb") as f:
-            f.write(orjson.dumps(self.__data_conf, f, option=orjson.OPT_NON_STR_KEYS,))
+        self.__journal.write(
+            self.__data_conf_path,
+            orjson.dumps(self.__data_conf, default=FVSCatalogRow.as_dict, option=orjson.OPT_NON_STR_KEYS)
+        )
 
     def complete_transaction(self):
         """
         Complete the transaction duplicating the files in the proper internal
         data path. It also saves the configuration to the data/data.json file.
+        Files are referenced in the store before being copied, objects already
+        in the store (e.g. written by another repository sharing it) are not
+        copied again. The codec of each object is recorded in its row, once
+        all the objects are written, so a failed write never leaves the
+        catalog referencing a missing object.
         """
         if self.__transaction is None:
             return  # it's safe to ignore this call, the state is probably only removing files
 
+        if self.__transaction_type == 0:
+            checkpoint = self.__repo.checkpoint
+            self.__store.acquire(
+                self.__transaction, self.__repo.repo_id, self.__journal,
+                checkpoint.has_object if checkpoint is not None else None
+            )
+            written = self.__write_objects()
+            for file in self.__transaction:
+                row = self.__data_conf[file.sha1]
+                if file.sha1 in written:
+                    row.codec, row.size = written[file.sha1]
+                elif checkpoint is not None and checkpoint.get_object(file.sha1) is not None:
+                    row.codec, row.size = checkpoint.get_object(file.sha1)
+                elif row.codec is None:
+                    self.__detect_codec(row)
+        elif self.__transaction_type == 1:
+            self.__store.release(self.__transaction, self.__repo.repo_id, self.__journal)
+
+        self.__save_config()
+
+    def __write_objects(self) -> dict:
+        """
+        Write the objects of the transaction, returning the codec and size
+        of each written one by sha1. Objects are prepared (and tracked in
+        the journal) here, in the order of the files on disk if an I/O
+        order is set, then written in batches by a pool of processes
+        when they are compressed, which is CPU bound, or of threads for
+        plain copies. Batches are submitted as long as the bytes in flight
+        stay under max_in_flight, so the readers never run too far ahead
+        of the writers. If a write fails, pending batches are cancelled and
+        the error is raised once the running ones are done. With a single
+        object or worker, objects are written right away. Commits being
+        checkpointed list the objects before writing them, and each one
+        once written, see FVSCheckpoint.
+        """
+        jobs = []
+        planned = []
         for file in self.__transaction:
-            _int_path = self.get_int_path(file.file_name)
+            job = file.prepare_copy(self.get_int_path(file.file_name, file.sha1))
+            if job is not None:
+                jobs.append((file.sha1, job))
+                planned.append(file)
 
-            if self.__transaction_type == 0:
-                file.copy_to(_int_path)
-            elif self.__transaction_type == 1:
-                file.remove(_int_path)
+        if self.__repo.checkpoint is not None and planned:
+            self.__repo.checkpoint.plan_objects(planned)
 
-        self.__save_config()
+        jobs = self.__repo.scheduler.sort(jobs, lambda job: job[1][0])
+        use_compression = self.__repo.has_compression
+        if len(jobs) < 2 or self.write_workers < 2:
+            written = {}
+            for sha1, job in jobs:
+                self.__add_written(sha1, job, FVSFile.write(job, use_compression), written)
+            return written
+
+        batches = [[]]
+        batch_bytes = 0
+        for sha1, job in jobs:
+            size = os.lstat(job[0]).st_size
+            if batches[-1] and (batch_bytes + size > self.batch_size or len(batches[-1]) >= self.batch_files):
+                batches.append([])
+                batch_bytes = 0
+            batches[-1].append((sha1, job, size))
+            batch_bytes += size
+
+        written = {}
+        pending = {}
+        in_flight = 0
+        executor_class = ProcessPoolExecutor if use_compression else ThreadPoolExecutor
+        executor = executor_class(max_workers=min(self.write_workers, len(batches)))
+        try:
+            for batch in batches:
+                while pending and in_flight >= self.max_in_flight:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        in_flight -= self.__collect(future, pending.pop(future), written)
+
+                future = executor.submit(FVSFile.write_batch, [job for _, job, _ in batch], use_compression)
+                pending[future] = batch
+                in_flight += sum(size for _, _, size in batch)
 
-    def get_int_path(self, file_name: str) -> str:
+            for future in list(pending):
+                self.__collect(future, pending.pop(future), written)
+        except BaseException:
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+        executor.shutdown()
+        return written
+
+    def __collect(self, future, batch: list, written: dict) -> int:
+        """
+        Collect the results of a batch, returning its size in bytes.
+        """
+        for (sha1, job, _), result in zip(batch, future.result()):
+            self.__add_written(sha1, job, result, written)
+        return sum(size for _, _, size in batch)
+
+    def __add_written(self, sha1: str, job: tuple, result: tuple, written: dict):
+        written[sha1] = result
+        if self.__repo.checkpoint is not None:
+            self.__repo.checkpoint.add_object(sha1, job[2], result)
+
+    def __detect_codec(self, row: FVSCatalogRow):
         """
-        This simple method determines the internal path of a file based
-        on the first letter of the file name. Every file starting with
-        a special character will be placed in the "-" directory.
+        Fill the codec of a row whose object was written by someone else,
+        e.g. received from another repository or already in a shared store.
+        The original size is known only for objects stored raw.
         """
-        first_letter = file_name[0].lower()
-        int_path = "-"
-        if first_letter in self.__data_int_paths:
-            int_path = first_letter
+        object_path = self.__store.get_object_path(row.file_name, row.sha1)
+        if not os.path.lexists(object_path):
+            return
+        if not self.__repo.has_compression:
+            row.codec, row.size = "raw", os.lstat(object_path).st_size
+        else:
+            row.codec = FVSCodec.detect(object_path)
 
-        return os.path.join(self.__data_path, int_path)
+    def get_int_path(self, file_name: str, sha1: str) -> str:
+        """
+        Get the internal path of a file in the object store, see
+        FVSStore.get_int_path.
+        """
+        return self.__store.get_int_path(file_name, sha1)
 
     def __set_transaction_type(self, type_id: int):
         if self.__transaction is None:
@@ -119,7 +234,8 @@ class FVSData:
         This method add a file to the catalog and append it to the
         transaction list. Files already in the catalog will be updated 
         listing the new state for the deduplication. A FVSFile object
-        is needed for the 'file' parameter.
+        is needed for the 'file' parameter. Empty files have no object,
+        they are never added.
         ...
         Raises:
             FVSDataHasNoState: if the state is not set.
@@ -129,23 +245,24 @@ class FVSData:
 
         self.__set_transaction_type(0)
 
-        if file.sha1 not in self.__data_conf.keys():
+        if file.sha1 == FVSHasher.empty_sha1:
+            logger.debug(f"File {file.file_name} is empty, no object needed.")
+            return
+
+        row = self.__data_conf.get(file.sha1)
+        if row is None:
             logger.debug(f"Adding file {file.file_name} to data catalog.")
-            self.__data_conf[file.sha1] = {
-                "file_name": file.file_name,
-                "sha1": file.sha1,
-                "states": {str(self.__state.state_id): 1}
-            }
+            self.__data_conf[file.sha1] = FVSCatalogRow(file.file_name, file.sha1, {self.__state.state_id: 1})
             self.__transaction.append(file)
 
-        elif str(self.__state.state_id) not in self.__data_conf[file.sha1]["states"]:
+        elif self.__state.state_id not in row.states:
             logger.debug(f"Adding state {self.__state.state_id} to file {file.file_name} in data catalog.")
-            self.__data_conf[file.sha1]["states"][str(self.__state.state_id)] = 1
+            row.states[self.__state.state_id] = 1
             self.__transaction.append(file)
 
         else:
             logger.debug(f"File {file.file_name} already in data catalog.")
-            self.__data_conf[file.sha1]["states"][str(self.__state.state_id)] += 1
+            row.states[self.__state.state_id] += 1
 
     def delete_file(self, file: 'FVSFile', state_id: int = None):
         """
@@ -162,37 +279,162 @@ class FVSData:
 
         if state_id is None:
             state_id = self.__state.state_id
+        state_id = int(state_id)
 
         self.__set_transaction_type(1)
 
-        if file.sha1 in self.__data_conf.keys():
-            if str(state_id) in self.__data_conf[file.sha1]["states"]:
+        row = self.__data_conf.get(file.sha1)
+        if row is not None:
+            if state_id in row.states:
                 logger.debug(f"Unlinking state {state_id} from file {file.file_name} in data catalog.")
-                self.__data_conf[file.sha1]["states"][str(state_id)] -= 1
+                row.states[state_id] -= 1
 
-                if self.__data_conf[file.sha1]["states"][str(state_id)] == 0:
+                if row.states[state_id] == 0:
                     logger.debug(
                         f"{file.file_name} reached 0 for state {state_id}. Removing state reference.")
-                    del self.__data_conf[file.sha1]["states"][str(state_id)]
-                    self.__transaction.append(file)
-            
-                if len(self.__data_conf[file.sha1]["states"]) == 0:
+                    del row.states[state_id]
+
+                """
+                The object is released only when no state references it,
+                other states may still need it.
+                """
+                if len(row.states) == 0:
                     logger.debug(f"{file.file_name} reached 0 for all states. Removing from data catalog.")
                     del self.__data_conf[file.sha1]
                     self.__transaction.append(file)
 
             else:
-                logger.debug(f"File {file.file_name} has no state {self.__state.state_id} referenced. Ignoring.")
+                logger.debug(f"File {file.file_name} has no state {state_id} referenced. Ignoring.")
         else:
             logger.debug(f"File {file.file_name} is not in data catalog. Ignoring.")
 
+    def squash_references(self, state_ids: list, files: list, state_id: int, new_files: list):
+        """
+        This method moves the references of the given squashed states to
+        state_id: the references held by the states to the given files
+        are dropped, then state_id references new_files (one FVSFile per
+        path, as add_file). Files left with no references are released on
+        complete_transaction, so many squashes can be batched in a single
+        catalog update.
+        """
+        self.__set_transaction_type(1)
+
+        for file in files:
+            row = self.__data_conf.get(file.sha1)
+            if row is not None:
+                for _state_id in state_ids:
+                    row.states.pop(_state_id, None)
+
+        for file in new_files:
+            if file.sha1 == FVSHasher.empty_sha1:
+                continue
+            row = self.__data_conf.get(file.sha1)
+            if row is None:
+                logger.debug(f"File {file.file_name} is not in data catalog, adding it back.")
+                row = self.__data_conf[file.sha1] = FVSCatalogRow(file.file_name, file.sha1)
+            row.states[state_id] = row.states.get(state_id, 0) + 1
+
+        for file in files:
+            row = self.__data_conf.get(file.sha1)
+            if row is not None and len(row.states) == 0:
+                logger.debug(f"{file.file_name} reached 0 for all states. Removing from data catalog.")
+                del self.__data_conf[file.sha1]
+                self.__transaction.append(file)
+
     def get_file_location(self, sha1: str) -> Union[str, None]:
         """
         This method returns the location of a file in the data catalog.
         """
         if sha1 in self.__data_conf.keys():
-            file_name = self.__data_conf[sha1]["file_name"]
-            return self.get_int_path(file_name)
+            file_name = self.__data_conf[sha1].file_name
+            return self.get_int_path(file_name, sha1)
         else:
             logging.debug(f"File {sha1} is not in data catalog.")
             return None
+
+    def get_stats(self) -> dict:
+        """
+        This method returns the store statistics of the catalog objects,
+        grouped by codec: the number of objects, the size of the original
+        files and the size of the stored objects. Objects of unknown size
+        (see FVSCatalogRow) are counted apart, so the ratio of the others
+        is accurate. Rows not written with a codec are grouped as
+        "unknown".
+        """
+        stats = {}
+        for row in self.__data_conf.values():
+            object_path = self.__store.get_object_path(row.file_name, row.sha1)
+            if not os.path.lexists(object_path):
+                continue
+            entry = stats.setdefault(row.codec or "unknown", {"objects": 0, "size": 0, "stored": 0, "unsized": 0})
+            entry["objects"] += 1
+            if row.size is None:
+                entry["unsized"] += 1
+                continue
+            entry["size"] += row.size
+            entry["stored"] += os.lstat(object_path).st_size
+        return stats
+
+    def migrate_objects(self, store: 'FVSStore') -> dict:
+        """
+        Move the catalog objects to the given content addressed store,
+        hashing each of them again from its stored content. Objects with
+        the same content (e.g. a file saved under many names) are merged
+        into a single row, which sums the references of each state, and
+        empty ones are dropped. Objects are linked (or copied, if on a
+        different file system) to their new place, the old ones are
+        released once the transaction is committed. It returns the new
+        sha1 of each object, by old sha1.
+        """
+        old_store = self.__store
+        sha1s = {}
+        catalog = {}
+        released = []
+        for row in self.__data_conf.values():
+            src = old_store.get_object_path(row.file_name, row.sha1)
+            if not os.path.lexists(src):
+                logger.debug(f"File {row.file_name} is missing from the store, keeping its sha1.")
+                catalog[row.sha1] = row
+                continue
+
+            file = FVSFile(self.__repo, row.file_name, row.sha1, [])
+            sha1 = sha1s[row.sha1] = file.get_content_sha1(old_store.get_int_path(row.file_name, row.sha1))
+            released.append(file)
+            if sha1 == FVSHasher.empty_sha1:
+                continue
+
+            new_row = catalog.get(sha1)
+            if new_row is not None:
+                logger.debug(f"Merging {row.file_name} with {new_row.file_name} in data catalog.")
+                for state_id, count in row.states.items():
+                    new_row.states[state_id] = new_row.states.get(state_id, 0) + count
+                continue
+
+            catalog[sha1] = FVSCatalogRow(row.file_name, sha1, dict(row.states), row.codec, row.size)
+            dest = store.get_object_path(row.file_name, sha1)
+            if os.path.lexists(dest):
+                continue
+            self.__journal.track(dest, keep=store.is_shared)
+            try:
+                os.link(src, dest + self.__journal.tmp_suffix, follow_symlinks=False)
+            except OSError:
+                FVSUtils.copy_file(src, dest + self.__journal.tmp_suffix)
+            os.replace(dest + self.__journal.tmp_suffix, dest)
+
+        old_store.release(released, self.__repo.repo_id, self.__journal)
+        self.__store = store
+        self.__data_conf = catalog
+        self.__repo.catalog = catalog
+        self.__save_config()
+        return sha1s
+
+    def list_files(self) -> list:
+        """
+        This method returns a FVSFile object for each file in the data
+        catalog. Relative paths are not tracked by the catalog, so they
+        are left empty.
+        """
+        return [
+            FVSFile(self.__repo, row.file_name, row.sha1, [])
+            for row in self.__data_conf.values()
+        ]
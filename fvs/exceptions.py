@@ -165,3 +165,114 @@ class FVSStateAlreadyExists(FVSException):
 
     def __init__(self, state_id: int):
         super().__init__("State already exists with ID: {}".format(state_id))
+
+
+class FVSStoreCompressionMismatch(FVSException):
+    """
+    Exception raised when a repository is attached to a shared store
+    using a different compression setting.
+    """
+
+    def __init__(self, store_path: str):
+        super().__init__("The store at {} uses a different compression \
+setting than the repository.".format(store_path))
+
+
+class FVSStoreHashModeMismatch(FVSException):
+    """
+    Exception raised when a repository is attached to a shared store
+    using a different hash mode.
+    """
+
+    def __init__(self, store_path: str):
+        super().__init__("The store at {} uses a different hash mode \
+than the repository.".format(store_path))
+
+
+class FVSDivergedStates(FVSException):
+    """
+    Exception raised when two repositories have different states with
+    the same ID, so states can't be exchanged between them.
+    """
+
+    def __init__(self, state_id: int):
+        super().__init__("Repositories diverged at state ID: {}".format(state_id))
+
+
+class FVSNotARepository(FVSException):
+    """
+    Exception raised when opening a path which is not an FVS repository,
+    e.g. the source of a pull.
+    """
+
+    def __init__(self, path: str):
+        super().__init__("{} is not an FVS repository.".format(path))
+
+
+class FVSRemoteCompressionMismatch(FVSException):
+    """
+    Exception raised when exchanging states between repositories using
+    different compression settings.
+    """
+
+    def __init__(self):
+        super().__init__("Repositories use different compression settings.")
+
+
+class FVSRemoteHashModeMismatch(FVSException):
+    """
+    Exception raised when exchanging states between repositories using
+    different hash modes, their sha1s don't match.
+    """
+
+    def __init__(self):
+        super().__init__("Repositories use different hash modes.")
+
+
+class FVSUnsupportedArchiveFormat(FVSException):
+    """
+    Exception raised when an archive format is not supported, e.g. zstd
+    without the zstandard package.
+    """
+
+    def __init__(self, archive_format: str, supported_formats: list):
+        super().__init__("The archive format {} is not supported. \
+It should be one of the following: {}".format(archive_format, supported_formats))
+
+
+class FVSInvalidCheckoutPath(FVSException):
+    """
+    Exception raised when a state is checked out inside the repository.
+    """
+
+    def __init__(self, path: str):
+        super().__init__("Can't check out a state inside the repository: {}".format(path))
+
+
+class FVSInvalidStateRange(FVSException):
+    """
+    Exception raised when a range of states can't be squashed.
+    """
+
+    def __init__(self, state_a: int, state_b: int):
+        super().__init__("Invalid state range {}..{}, it must contain at least two states.".format(state_a, state_b))
+
+
+class FVSUnsupportedIOOrder(FVSException):
+    """
+    Exception raised when an I/O order is not supported.
+    """
+
+    def __init__(self, io_order: str, supported_orders: list):
+        super().__init__("The I/O order {} is not supported. \
+It should be one of the following: {}".format(io_order, supported_orders))
+
+
+class FVSNoCommitToResume(FVSException):
+    """
+    Exception raised when resuming or aborting a commit but no commit was
+    interrupted.
+    """
+
+    def __init__(self):
+        super().__init__("There is no interrupted commit.")
@@ -1,13 +1,24 @@
+import io
 import os
+import stat
+import time
 import shutil
+import hashlib
 import tarfile
 import logging
+import contextlib
+from typing import Union
+
+from fvs.codec import FVSCodec
+from fvs.utils import FVSUtils
+from fvs.hasher import FVSHasher
 
 logger = logging.getLogger("fvs.file")
 
 
 # noinspection DuplicatedCode
 class FVSFile:
+    __slots__ = ("__repo", "__file_name", "__sha1", "__relative_paths")
 
     def __init__(self, repo: 'FVSRepo', file_name: str, sha1: str, relative_paths: list):
         self.__repo = repo
@@ -32,13 +43,23 @@ class FVSFile:
         the appropriate data location, for this reason use_sha1_as_name is 
         set to True by default (data files must be stored with their sha1 
         hash as name to avoid name collisions). This method use copy2 to
-        copy the file, so it will preserve the file metadata.
+        copy the file, so it will preserve the file metadata. It returns
+        the codec used and the size of the file, None if the object was
+        already there.
         """
+        job = self.prepare_copy(dest, use_sha1_as_name)
+        if job is None:
+            return None
+        return self.write(job, self.__repo.has_compression)
 
-        if self.__repo.has_compression:
-            self.__compress_copy_to(dest, use_sha1_as_name)
-            return
-
+    def prepare_copy(self, dest: str, use_sha1_as_name: bool = True) -> Union[tuple, None]:
+        """
+        This method prepares the copy of the file to the given destination,
+        tracking the object in the journal, and returns the job to pass to
+        FVSFile.write, None if the object is already there. Jobs are plain
+        tuples, so they can be written by other threads or processes, see
+        FVSData.complete_transaction.
+        """
         if use_sha1_as_name:
             _dest = os.path.join(dest, self.__sha1)
             _name = self.__sha1
@@ -53,19 +74,49 @@ class FVSFile:
         """
         if os.path.islink(_dest) or os.path.exists(_dest):
             logger.debug(f"File {self.__sha1} already exists in {dest}.")
-            return
+            return None
 
         """
         We will move only the first relative path as the file is supposed to
-        be the same in all relative paths.
+        be the same in all relative paths. Objects of checkpointed commits
+        survive the rollback of the commit, so it can be resumed, see
+        FVSCheckpoint.
         """
-        logger.debug(f"Copying file {_name} to {dest}")
-        shutil.copy2(
+        self.__repo.journal.track(_dest, keep=self.__repo.store.is_shared or self.__repo.checkpoint is not None)
+        return (
             os.path.join(self.__repo.repo_path, self.__relative_paths[0]),
+            _dest + self.__repo.journal.tmp_suffix,
             _dest,
-            follow_symlinks=False
+            _name
         )
 
+    @staticmethod
+    def write(job: tuple, use_compression: bool) -> tuple:
+        """
+        Write the object of a job made by prepare_copy, compressing it with
+        the codec chosen by FVSCodec if needed. The object is written to a
+        temporary file, renamed once complete, so an interrupted copy never
+        leaves a truncated object behind. It returns the codec used and the
+        size of the file.
+        """
+        src, tmp_path, dest, name = job
+        if use_compression:
+            logger.debug(f"Compressing file {name} to {dest}")
+            return FVSCodec.encode(src, tmp_path, dest, name)
+
+        logger.debug(f"Copying file {name} to {dest}")
+        FVSUtils.copy_file(src, tmp_path)
+        os.replace(tmp_path, dest)
+        return "raw", os.lstat(dest).st_size
+
+    @staticmethod
+    def write_batch(jobs: list, use_compression: bool) -> list:
+        """
+        Write the objects of many jobs, see write. This is the unit of work
+        of the FVSData worker pools.
+        """
+        return [FVSFile.write(job, use_compression) for job in jobs]
+
     def remove(self, path: str, use_sha1_as_name: bool = True):
         """
         This method will remove the file from the internal data directory.
@@ -75,67 +126,105 @@ class FVSFile:
         else:
             file_path = os.path.join(path, self.__file_name)
 
-        if os.path.exists(file_path):
+        if os.path.lexists(file_path):
             logger.debug(f"removing file {self.__file_name} from {path}")
-            os.remove(file_path)
+            self.__repo.journal.remove(file_path)
         else:
             logger.debug(f"file {self.__file_name} does not exist, data catalog may be corrupted.")
 
     def restore(self, internal_path: str):
         """
         This method will restore the file, copying from the internal data
-        directory to the repo, renaming it to the original name.
+        directory to the repo, renaming it to the original name. Large
+        files still in the repo are patched in place instead, see
+        FVSUtils.patch_fileobj. Empty files have no object, they are just
+        created (or truncated).
         """
+        if self.__sha1 == FVSHasher.empty_sha1:
+            for relative_path in self.__relative_paths:
+                full_rel_path = os.path.join(self.__repo.repo_path, relative_path)
+                logger.debug(f"restoring empty file {self.__file_name}")
+                os.makedirs(os.path.dirname(full_rel_path), exist_ok=True)
+                open(full_rel_path, "wb").close()
+            return
+
         if self.__repo.has_compression:
             self.__compress_restore(internal_path)
             return
             
         file_path = os.path.join(internal_path, self.__sha1)
-        if not os.path.exists(file_path):
+        if not os.path.lexists(file_path):
             logger.debug(f"file {self.__file_name} does not exist, data catalog may be corrupted.")
             return
 
         for relative_path in self.__relative_paths:
-            dir_name = os.path.dirname(os.path.join(self.__repo.repo_path, relative_path))
+            full_rel_path = os.path.join(self.__repo.repo_path, relative_path)
             logger.debug(f"restoring file {self.__file_name}")
-            os.makedirs(dir_name, exist_ok=True)
-            shutil.copy2(
-                file_path,
-                os.path.join(self.__repo.repo_path, relative_path),
-                follow_symlinks=False
-            )
+            os.makedirs(os.path.dirname(full_rel_path), exist_ok=True)
+
+            """
+            Large files still in the working tree are patched in place,
+            rewriting only the blocks which differ from the object.
+            """
+            _stat = os.lstat(file_path)
+            if stat.S_ISREG(_stat.st_mode) and not FVSHasher.is_sparse(_stat) \
+                    and FVSUtils.can_patch(full_rel_path, _stat.st_size):
+                with open(file_path, "rb") as f, open(full_rel_path, "r+b") as f_dest:
+                    written = FVSUtils.patch_fileobj(f, f_dest, _stat.st_size)
+                logger.debug(f"patched {written} bytes of {relative_path}")
+                shutil.copystat(file_path, full_rel_path)
+                continue
+
+            FVSUtils.copy_file(file_path, full_rel_path)
     
-    def __compress_copy_to(self, dest: str, use_sha1_as_name: bool = True):
+    @contextlib.contextmanager
+    def open(self, internal_path: str):
         """
-        This method will copy the file to the given destination, compressing it.
+        This method will open the stored content of the file, decompressing
+        it on the fly if needed. It yields a TarInfo describing the content,
+        named after the first relative path, and a file object to read it
+        (None if the file is not a regular one, e.g. a symlink). Empty
+        files have no object, they are described as new regular files.
         """
-        if use_sha1_as_name:
-            _dest = os.path.join(dest, self.__sha1)
-            _name = self.__sha1
-        else:
-            _dest = os.path.join(dest, self.__file_name)
-            _name = self.__file_name
+        file_path = os.path.join(internal_path, self.__sha1)
+        name = self.__relative_paths[0] if self.__relative_paths else self.__file_name
 
-        """
-        There never should be a file with the same name and FVSData should
-        already check for duplicates. Anyway, we will check for it here
-        just in case.
-        """
-        if os.path.islink(_dest) or os.path.exists(_dest):
-            logger.debug(f"File {self.__sha1} already exists in {dest}.")
+        if self.__sha1 == FVSHasher.empty_sha1:
+            info = tarfile.TarInfo(name)
+            info.mode = 0o644
+            info.mtime = int(time.time())
+            yield info, io.BytesIO()
             return
 
+        if self.__repo.has_compression:
+            with tarfile.open(file_path, "r:*") as tar:
+                info = tar.next()
+                info.name = name
+                yield info, tar.extractfile(info) if info.isreg() else None
+            return
+
+        with tarfile.open(fileobj=io.BytesIO(), mode="w") as tar:
+            info = tar.gettarinfo(file_path, arcname=name)
+        if not info.isreg():
+            yield info, None
+            return
+        with open(file_path, "rb") as f:
+            yield info, f
+
+    def get_content_sha1(self, internal_path: str) -> str:
         """
-        We will move only the first relative path as the file is supposed to
-        be the same in all relative paths.
-        """
-        logger.debug(f"Compressing file {_name} to {dest}")
-        with tarfile.open(_dest, "w:gz") as tar:
-            tar.add(
-                os.path.join(self.__repo.repo_path, self.__relative_paths[0]),
-                arcname=_name
-            )
-    
+        Hash the stored content of the file as a content addressed
+        repository does, see FVSUtils.get_sha1_hash. This is meant for
+        migrating objects hashed with their name.
+        """
+        with self.open(internal_path) as (info, f):
+            if info.issym():
+                return FVSHasher.link_sha1(info.linkname)
+            sha1_temp = hashlib.sha1()
+            if f is not None:
+                FVSHasher.copy(f, None, sha1_temp)
+            return sha1_temp.hexdigest()
+
     def __compress_restore(self, internal_path: str):
         """
         This method will restore the file, decompressing it and copying it
@@ -151,7 +240,29 @@ class FVSFile:
             dir_name = os.path.dirname(full_rel_path)
             logger.debug(f"restoring file {self.__file_name}")
             os.makedirs(dir_name, exist_ok=True)
-            with tarfile.open(file_path, "r:gz") as tar:
+            with tarfile.open(file_path, "r:*") as tar:
+                """
+                Sparse files are written extent by extent, so their holes
+                are recreated instead of being filled with zeros, large
+                files still in the working tree are patched in place.
+                """
+                info = tar.next()
+                extents = FVSCodec.get_extents(info)
+                if extents is not None:
+                    with tar.extractfile(info) as f, open(full_rel_path, "wb") as f_dest:
+                        FVSUtils.write_extents(f, f_dest, info.size, extents)
+                    os.chmod(full_rel_path, info.mode & 0o7777)
+                    os.utime(full_rel_path, (info.mtime, info.mtime))
+                    continue
+
+                if info.isreg() and FVSUtils.can_patch(full_rel_path, info.size):
+                    with tar.extractfile(info) as f, open(full_rel_path, "r+b") as f_dest:
+                        written = FVSUtils.patch_fileobj(f, f_dest, info.size)
+                    logger.debug(f"patched {written} bytes of {relative_path}")
+                    os.chmod(full_rel_path, info.mode & 0o7777)
+                    os.utime(full_rel_path, (info.mtime, info.mtime))
+                    continue
+
                 def is_within_directory(directory, target):
                     
                     abs_directory = os.path.abspath(directory)
@@ -171,9 +282,14 @@ class FVSFile:
                     tar.extractall(path, members, numeric_owner=numeric_owner) 
                     
                 
+                """
+                The member is named after the sha1 the object was written
+                with, which differs from the current one for objects
+                migrated to content addressing (see FVSRepo.migrate_hashes).
+                """
                 safe_extract(tar, dir_name)
                 os.rename(
-                    os.path.join(dir_name, self.__sha1),
+                    os.path.join(dir_name, info.name),
                     full_rel_path
                 )
 
@@ -0,0 +1,227 @@
+import os
+import mmap
+import errno
+import hashlib
+import logging
+import threading
+from typing import Union
+
+logger = logging.getLogger("fvs.hasher")
+
+
+class FVSHasher:
+    """
+    Hashing reader used to compute the sha1 of the repository files. Each
+    thread owns a single reusable buffer, so hashing a file never allocates
+    new bytes objects, while large files are mapped in memory and hashed
+    straight from the page cache.
+
+    Content addressed repositories hash the content alone: all the empty
+    files share empty_sha1, which needs no object, and symlinks are hashed
+    from their target path (see link_sha1), as they are stored as such.
+    """
+    empty_sha1: str = hashlib.sha1().hexdigest()
+    min_block_size: int = 2 ** 16
+    max_block_size: int = 2 ** 22
+    mmap_threshold: int = 2 ** 24
+    drop_cache: bool = True
+    __local = threading.local()
+
+    @classmethod
+    def block_size_for(cls, size: int) -> int:
+        """
+        Get the block size to use for a file of the given size. Small files
+        are read in a single call, bigger ones with blocks growing with the
+        file size up to max_block_size.
+        """
+        if size <= cls.min_block_size:
+            return cls.min_block_size
+
+        block_size = 1 << (size - 1).bit_length()
+        return min(block_size, cls.max_block_size)
+
+    @classmethod
+    def get_buffer(cls, size: int) -> memoryview:
+        """
+        Get a view of the buffer owned by the calling thread, growing it
+        only if the requested size is bigger than the current one.
+        """
+        buffer = getattr(cls.__local, "buffer", None)
+        if buffer is None or len(buffer) < size:
+            buffer = memoryview(bytearray(size))
+            cls.__local.buffer = buffer
+        return buffer[:size]
+
+    @staticmethod
+    def advise(fd: int, advice: str, offset: int = 0, length: int = 0):
+        """
+        Wrapper around os.posix_fadvise, it silently does nothing on platforms
+        or file systems not supporting it. The advice is the name of the
+        POSIX_FADV_* constant without prefix.
+        """
+        _advice = getattr(os, f"POSIX_FADV_{advice}", None)
+        if _advice is None:
+            return
+        try:
+            os.posix_fadvise(fd, offset, length, _advice)
+        except OSError:
+            pass
+
+    @staticmethod
+    def open(path: str) -> int:
+        """
+        Open the given file for reading, avoiding the access time update
+        when allowed (O_NOATIME is only permitted to the file owner).
+        """
+        flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+        no_atime = getattr(os, "O_NOATIME", 0)
+        if no_atime:
+            try:
+                return os.open(path, flags | no_atime)
+            except PermissionError:
+                pass
+        return os.open(path, flags)
+
+    @staticmethod
+    def is_sparse(stat: os.stat_result) -> bool:
+        """
+        Check if the given stat belongs to a file with holes, i.e. with less
+        blocks allocated than its size needs.
+        """
+        return stat.st_blocks * 512 < stat.st_size if hasattr(stat, "st_blocks") else False
+
+    @staticmethod
+    def get_extents(fd: int, size: int) -> Union[list, None]:
+        """
+        Get the data extents of the given file as a list of (offset, length)
+        tuples, using SEEK_DATA and SEEK_HOLE. Everything outside of them
+        is a hole, reading as zeros. It returns None if the platform or the
+        file system can't tell holes apart. The file offset is reset.
+        """
+        if not hasattr(os, "SEEK_DATA"):
+            return None
+
+        extents = []
+        offset = 0
+        try:
+            while offset < size:
+                try:
+                    start = os.lseek(fd, offset, os.SEEK_DATA)
+                except OSError as e:
+                    if e.errno == errno.ENXIO:
+                        break  # only a hole is left
+                    raise
+                end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+                if end > start:
+                    extents.append((start, end - start))
+                offset = end
+        except OSError:
+            return None
+        finally:
+            os.lseek(fd, 0, os.SEEK_SET)
+        return extents
+
+    @classmethod
+    def update_from_fd(cls, sha1_temp, fd: int, size: int, block_size: int = None):
+        """
+        Feed the content of the given file descriptor to the hash object,
+        choosing between mmap and readinto based on the file size. Only the
+        data extents of sparse files are read, holes are fed as zeros so
+        the hash is the same as for a fully allocated copy.
+        """
+        if cls.is_sparse(os.fstat(fd)):
+            extents = cls.get_extents(fd, size)
+            if extents is not None:
+                cls.__update_sparse(sha1_temp, fd, size, extents, block_size)
+                return
+
+        if size >= cls.mmap_threshold:
+            try:
+                with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                    if hasattr(mm, "madvise") and hasattr(mmap, "MADV_SEQUENTIAL"):
+                        mm.madvise(mmap.MADV_SEQUENTIAL)
+                    sha1_temp.update(mm)
+                return
+            except (OSError, ValueError):
+                logger.debug("mmap not available, falling back to readinto.")
+
+        buffer = cls.get_buffer(block_size or cls.block_size_for(size))
+        with open(fd, "rb", buffering=0, closefd=False) as f:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    break
+                sha1_temp.update(buffer[:read])
+
+    @classmethod
+    def __update_sparse(cls, sha1_temp, fd: int, size: int, extents: list, block_size: int = None):
+        buffer = cls.get_buffer(block_size or cls.max_block_size)
+        zeros = bytes(len(buffer))
+        position = 0
+        with open(fd, "rb", buffering=0, closefd=False) as f:
+            for offset, length in extents + [(size, 0)]:
+                while position < offset:
+                    hole = min(offset - position, len(zeros))
+                    sha1_temp.update(zeros[:hole])
+                    position += hole
+                f.seek(offset)
+                while position < offset + length:
+                    read = f.readinto(buffer[:min(offset + length - position, len(buffer))])
+                    if not read:
+                        return  # the file was truncated in the meantime
+                    sha1_temp.update(buffer[:read])
+                    position += read
+
+    @classmethod
+    def copy(cls, src, dst, sha1_temp, block_size: int = None) -> int:
+        """
+        Copy the src file object to dst feeding the content to the hash
+        object on the way, using the buffer of the calling thread. It returns
+        the number of bytes copied. If dst is None, src is only hashed.
+        """
+        buffer = cls.get_buffer(block_size or cls.max_block_size)
+        copied = 0
+        while True:
+            read = src.readinto(buffer)
+            if not read:
+                break
+            sha1_temp.update(buffer[:read])
+            if dst is not None:
+                dst.write(buffer[:read])
+            copied += read
+        return copied
+
+    @classmethod
+    def sha1(cls, path: str, suffix: bytes = b"", block_size: int = None) -> Union[str, None]:
+        """
+        Get the sha1 hash of the given file, the suffix (if any) is fed to
+        the hash after the file content. It returns None if the file is not
+        accessible or doesn't exist.
+        """
+        sha1_temp = hashlib.sha1()
+        try:
+            fd = cls.open(path)
+        except (FileNotFoundError, PermissionError, IsADirectoryError):
+            return None
+
+        try:
+            size = os.fstat(fd).st_size
+            cls.advise(fd, "SEQUENTIAL")
+            cls.update_from_fd(sha1_temp, fd, size, block_size)
+            if cls.drop_cache:
+                cls.advise(fd, "DONTNEED")
+        except (PermissionError, IsADirectoryError):
+            return None
+        finally:
+            os.close(fd)
+
+        sha1_temp.update(suffix)
+        return sha1_temp.hexdigest()
+
+    @staticmethod
+    def link_sha1(target: str) -> str:
+        """
+        Get the sha1 of a symlink pointing to the given target, prefixed so
+        it never matches a regular file holding the same bytes.
+        """
+        return hashlib.sha1(b"symlink\0" + os.fsencode(target)).hexdigest()
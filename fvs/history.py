@@ -0,0 +1,110 @@
+import bisect
+import logging
+from typing import Union
+
+logger = logging.getLogger("fvs.history")
+
+
+class FVSHistory:
+    """
+    The states of a repository, as stored in repo.json, indexed by id. The
+    ids are also kept in a sorted list, so the prior and next states of a
+    state, and the states in a range, are found by bisection instead of
+    scanning all the states. States are iterated in id order.
+
+    It behaves as the dict it wraps for reads and writes, as_dict returns
+    the dict itself, e.g. to store it.
+    """
+    __slots__ = ("__states", "__ids")
+
+    def __init__(self, states: dict = None):
+        self.__states = dict(sorted(states.items())) if states else {}
+        self.__ids = list(self.__states)
+
+    def __getitem__(self, state_id: int) -> dict:
+        return self.__states[state_id]
+
+    def __setitem__(self, state_id: int, state: dict):
+        if state_id not in self.__states:
+            bisect.insort(self.__ids, state_id)
+        self.__states[state_id] = state
+
+    def __delitem__(self, state_id: int):
+        del self.__states[state_id]
+        del self.__ids[bisect.bisect_left(self.__ids, state_id)]
+
+    def __contains__(self, state_id: int) -> bool:
+        return state_id in self.__states
+
+    def __len__(self) -> int:
+        return len(self.__ids)
+
+    def __iter__(self):
+        return iter(list(self.__ids))
+
+    def get(self, state_id: int, default: dict = None) -> Union[dict, None]:
+        return self.__states.get(state_id, default)
+
+    def keys(self) -> list:
+        return list(self.__ids)
+
+    def items(self):
+        for state_id in self.keys():
+            yield state_id, self.__states[state_id]
+
+    def as_dict(self) -> dict:
+        """
+        Get the states as a dict. States inserted out of order (e.g. with
+        a pull) are sorted first, so repo.json always lists them in order.
+        """
+        if list(self.__states) != self.__ids:
+            self.__states = {state_id: self.__states[state_id] for state_id in self.__ids}
+        return self.__states
+
+    @property
+    def first(self) -> Union[int, None]:
+        return self.__ids[0] if self.__ids else None
+
+    @property
+    def last(self) -> Union[int, None]:
+        return self.__ids[-1] if self.__ids else None
+
+    def prior(self, state_id: int) -> Union[int, None]:
+        """
+        Get the id of the state before the given one, which doesn't need
+        to exist, None if there is none.
+        """
+        index = bisect.bisect_left(self.__ids, state_id)
+        return self.__ids[index - 1] if index > 0 else None
+
+    def next(self, state_id: int) -> Union[int, None]:
+        """
+        Get the id of the state after the given one, which doesn't need to
+        exist, None if there is none.
+        """
+        index = bisect.bisect_right(self.__ids, state_id)
+        return self.__ids[index] if index < len(self.__ids) else None
+
+    def range(self, first: int = None, last: int = None) -> list:
+        """
+        Get the ids of the states from first to last, both included. A
+        missing bound means the first or the last state.
+        """
+        start = 0 if first is None else bisect.bisect_left(self.__ids, first)
+        stop = len(self.__ids) if last is None else bisect.bisect_right(self.__ids, last)
+        return self.__ids[start:stop]
+
+    def page(self, since: int = None, limit: int = None) -> list:
+        """
+        Get a page of state ids: the first limit states from since if
+        given, the last limit states otherwise. Without a limit, all the
+        states from since are returned.
+        """
+        start = 0 if since is None else bisect.bisect_left(self.__ids, since)
+        stop = len(self.__ids)
+        if limit is not None:
+            if since is None:
+                start = max(stop - limit, 0)
+            else:
+                stop = min(start + limit, stop)
+        return self.__ids[start:stop]
@@ -0,0 +1,322 @@
+import os
+import orjson
+import shutil
+import logging
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("fvs.journal")
+
+
+class FVSJournal:
+    """
+    The journal makes repository operations crash-safe. During a transaction
+    metadata is written to temporary files and new objects are tracked, then
+    on commit everything is synced in a single barrier before the temporary
+    files are renamed over the originals. Removals are deferred to the end
+    of the transaction, so a crash never leaves metadata pointing to data
+    which no longer exists.
+
+    The journal file is an append-only log of JSON lines, if it is found
+    when opening the repository, the interrupted transaction is rolled
+    forward (it reached the commit record) or rolled back (it didn't).
+
+    If a FVSLock is given, the read lock is held exclusively while the
+    transaction is published, so readers never see it half applied.
+    """
+    tmp_suffix: str = ".fvs-tmp"
+    sync_workers: int = 8
+    __depth: int = 0
+    __log = None
+    __writes: dict = None
+    __created: list = None
+    __removals: list = None
+    __callbacks: list = None
+    __undos: list = None
+
+    def __init__(self, fvs_path: str, lock: 'FVSLock' = None):
+        self.__journal_path = os.path.join(fvs_path, "journal.log")
+        self.__lock = lock
+
+    @property
+    def pending(self) -> bool:
+        """
+        Check if a journal was left by a transaction.
+        """
+        return os.path.exists(self.__journal_path)
+
+    @property
+    def active(self) -> bool:
+        """
+        Check if a transaction is in progress.
+        """
+        return self.__depth > 0
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the wrapped code in a transaction. Nested transactions are
+        joined to the outermost one, which is the only one committing.
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def begin(self):
+        """
+        Start a new transaction or join the one in progress.
+        """
+        self.__depth += 1
+        if self.__depth > 1:
+            return
+
+        self.__writes = {}
+        self.__created = []
+        self.__removals = []
+        self.__callbacks = []
+        self.__undos = []
+        self.__log = open(self.__journal_path, "wb")
+        self.__append({"op": "begin"})
+
+    def __append(self, record: dict):
+        self.__log.write(orjson.dumps(record) + b"\n")
+        self.__log.flush()
+
+    def resolve(self, path: str) -> str:
+        """
+        Get the path to read the given file from. If the file was written
+        in the current transaction, the temporary file is returned.
+        """
+        if self.active and path in self.__writes:
+            return self.__writes[path]
+        return path
+
+    def write(self, path: str, data: bytes):
+        """
+        Write the given data to path. In a transaction the data goes to a
+        temporary file renamed on commit, otherwise it is written and
+        renamed immediately.
+        """
+        tmp_path = path + self.tmp_suffix
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+
+        if not self.active:
+            self.fsync(tmp_path)
+            os.replace(tmp_path, path)
+            self.fsync(os.path.dirname(path))
+            return
+
+        """
+        Writing the same file twice moves it to the end of the list, so
+        the last written file is also the last renamed on commit.
+        """
+        if self.__writes.pop(path, None) is None:
+            self.__append({"op": "write", "path": path, "tmp": tmp_path})
+        self.__writes[path] = tmp_path
+
+    def track(self, path: str, keep: bool = False):
+        """
+        Track a file or directory created by the current transaction. It
+        will be synced on commit and deleted on rollback, unless keep is
+        set (e.g. objects in a shared store, which other repositories may
+        already reference).
+        """
+        if not self.active:
+            return
+        self.__append({"op": "track", "path": path, "keep": keep})
+        self.__created.append((path, keep))
+
+    def remove(self, path: str):
+        """
+        Remove a file or directory. In a transaction the removal is deferred
+        until the metadata has been committed.
+        """
+        if not self.active:
+            self.__remove(path)
+            return
+        self.__removals.append(path)
+
+    def on_commit(self, callback):
+        """
+        Register a callback to run once the transaction has been committed
+        and published. Callbacks are not persisted, they are meant for
+        actions which are safe to lose on crash (e.g. dropping references).
+        """
+        if not self.active:
+            callback()
+            return
+        self.__callbacks.append(callback)
+
+    def on_rollback(self, callback, record: dict):
+        """
+        Register a callback undoing an action done outside the journal
+        (e.g. taking references in a shared store), to run if the
+        transaction is rolled back. The record describing the action is
+        written to the journal, so that recover can return it to the
+        caller, which must undo the action itself after a crash.
+        """
+        if not self.active:
+            return
+        self.__append({"op": "undo", "record": record})
+        self.__undos.append(callback)
+
+    def commit(self):
+        """
+        Commit the transaction: sync new objects and temporary files in one
+        barrier, write the commit record, rename the temporary files and
+        finally perform the deferred removals.
+        """
+        self.__depth -= 1
+        if self.__depth > 0:
+            return
+
+        renames = [[tmp, path] for path, tmp in self.__writes.items()]
+        synced = [tmp for tmp, _ in renames] + [path for path, _ in self.__created]
+        self.__sync(synced)
+
+        self.__append({"op": "commit", "renames": renames, "removals": self.__removals})
+        os.fsync(self.__log.fileno())
+        self.__log.close()
+
+        callbacks = self.__callbacks
+        with self.__publishing():
+            self.__roll_forward(renames, self.__removals)
+            self.__reset()
+
+        for callback in callbacks:
+            callback()
+
+    def rollback(self):
+        """
+        Roll back the transaction, deleting temporary files and everything
+        created in the meantime.
+        """
+        self.__depth = 0
+        if self.__log is None:
+            return
+        self.__log.close()
+        undos = self.__undos
+        self.__roll_back(list(self.__writes.values()), self.__created)
+        self.__reset()
+
+        for callback in undos[::-1]:
+            callback()
+
+    def recover(self) -> list:
+        """
+        Recover an interrupted transaction, if any. It returns the records
+        registered with on_rollback if the transaction was rolled back.
+        """
+        if not os.path.exists(self.__journal_path):
+            return []
+
+        temps = []
+        created = []
+        undos = []
+        commit = None
+        with open(self.__journal_path, "rb") as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    break  # torn write, the transaction never committed
+                if record["op"] == "write":
+                    temps.append(record["tmp"])
+                elif record["op"] == "track":
+                    created.append((record["path"], record.get("keep", False)))
+                elif record["op"] == "undo":
+                    undos.append(record["record"])
+                elif record["op"] == "commit":
+                    commit = record
+
+        with self.__publishing():
+            if commit is not None:
+                logger.info("Rolling forward an interrupted transaction.")
+                self.__roll_forward(commit["renames"], commit["removals"])
+            else:
+                logger.info("Rolling back an interrupted transaction.")
+                self.__roll_back(temps, created)
+            self.__reset()
+        return undos[::-1] if commit is None else []
+
+    def __publishing(self):
+        if self.__lock is None:
+            return contextlib.nullcontext()
+        return self.__lock.exclusive("read")
+
+    def __roll_forward(self, renames: list, removals: list):
+        dirs = set()
+        for tmp, path in renames:
+            if os.path.exists(tmp):
+                os.replace(tmp, path)
+            dirs.add(os.path.dirname(path))
+        self.__sync(list(dirs))
+
+        for path in removals:
+            self.__remove(path)
+
+    def __roll_back(self, temps: list, created: list):
+        for path in temps:
+            self.__remove(path)
+        for path, keep in created[::-1]:
+            self.__remove(path + self.tmp_suffix)
+            if not keep:
+                self.__remove(path)
+
+    def __reset(self):
+        self.__log = None
+        self.__writes = None
+        self.__created = None
+        self.__removals = None
+        self.__callbacks = None
+        self.__undos = None
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.__journal_path)
+
+    def __sync(self, paths: list):
+        """
+        Sync the given paths and their parent directories, in parallel since
+        fsync calls on different files don't serialize on most file systems.
+        """
+        if not paths:
+            return
+        dirs = {os.path.dirname(path) for path in paths}
+        paths = list(paths) + list(dirs)
+
+        """
+        Each worker gets a slice of the paths, submitting a task per path
+        would keep a future for each of them in memory.
+        """
+        def _sync(chunk: list):
+            for path in chunk:
+                self.fsync(path)
+
+        chunks = [paths[i::self.sync_workers] for i in range(self.sync_workers)]
+        with ThreadPoolExecutor(max_workers=self.sync_workers) as executor:
+            list(executor.map(_sync, chunks))
+
+    @staticmethod
+    def fsync(path: str):
+        """
+        Sync the given file or directory, ignoring missing ones.
+        """
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    def __remove(path: str):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
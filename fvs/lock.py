@@ -0,0 +1,135 @@
+import os
+import time
+import fcntl
+import logging
+import contextlib
+
+logger = logging.getLogger("fvs.lock")
+
+
+class FVSLock:
+    """
+    Inter-process locks for a repository, based on flock(2). Two lock files
+    are used:
+        write: held exclusively for the whole duration of operations
+               altering the repository (commit, restore, delete), so
+               only one writer at a time can run.
+        read:  held shared while loading the repository metadata and
+               exclusively by the writer only while publishing a
+               transaction, so readers always see the last committed
+               snapshot and never wait for a whole commit.
+    Locks are re-entrant in the same FVSLock instance.
+    """
+
+    def __init__(self, fvs_path: str):
+        self.__fvs_path = fvs_path
+        self.__held = {}
+        self.__wait_time = 0.0
+        self.__last_wait = 0.0
+
+    def acquire(self, name: str, exclusive: bool, blocking: bool = True) -> bool:
+        """
+        Acquire the given lock, returning False if the lock is busy and
+        blocking is False. If the lock file can't be opened (e.g. read-only
+        repositories), the lock is considered acquired.
+        """
+        if name in self.__held:
+            fd, is_exclusive, depth = self.__held[name]
+            if exclusive and not is_exclusive and fd is not None:
+                if not self.__flock(fd, name, True, blocking):
+                    return False
+                is_exclusive = True
+            self.__held[name] = (fd, is_exclusive, depth + 1)
+            return True
+
+        try:
+            fd = os.open(
+                os.path.join(self.__fvs_path, f"{name}.lock"),
+                os.O_RDWR | os.O_CREAT | getattr(os, "O_CLOEXEC", 0),
+                0o644
+            )
+        except OSError as e:
+            logger.debug(f"Unable to open lock {name} ({e}), proceeding without it.")
+            fd = None
+
+        if fd is not None and not self.__flock(fd, name, exclusive, blocking):
+            os.close(fd)
+            return False
+
+        self.__held[name] = (fd, exclusive, 1)
+        return True
+
+    def __flock(self, fd: int, name: str, exclusive: bool, blocking: bool) -> bool:
+        operation = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+
+        start = time.monotonic()
+        try:
+            fcntl.flock(fd, operation)
+        except BlockingIOError:
+            return False
+        wait = time.monotonic() - start
+
+        self.__last_wait = wait
+        self.__wait_time += wait
+        if wait > 0.01:
+            logger.info(f"Waited {wait:.2f}s for the {name} lock.")
+        return True
+
+    def release(self, name: str):
+        """
+        Release the given lock. The lock is really released only when the
+        outermost holder releases it.
+        """
+        fd, exclusive, depth = self.__held[name]
+        if depth > 1:
+            self.__held[name] = (fd, exclusive, depth - 1)
+            return
+
+        del self.__held[name]
+        if fd is not None:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    @contextlib.contextmanager
+    def shared(self, name: str = "read"):
+        """
+        Hold the given lock in shared mode for the wrapped code.
+        """
+        self.acquire(name, False)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    @contextlib.contextmanager
+    def exclusive(self, name: str = "write"):
+        """
+        Hold the given lock in exclusive mode for the wrapped code.
+        """
+        self.acquire(name, True)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+    def is_held(self, name: str) -> bool:
+        """
+        Check if the given lock is held by this instance.
+        """
+        return name in self.__held
+
+    @property
+    def wait_time(self) -> float:
+        """
+        Get the total time spent waiting for locks, in seconds.
+        """
+        return self.__wait_time
+
+    @property
+    def last_wait(self) -> float:
+        """
+        Get the time spent waiting for the last acquired lock, in seconds.
+        """
+        return self.__last_wait
@@ -0,0 +1,136 @@
+import os
+import orjson
+import logging
+
+logger = logging.getLogger("fvs.paths")
+
+
+class FVSPathTable:
+    """
+    The interned path table of a repository, shared by all its states and
+    stored in .fvs/paths.json. Each distinct file or directory name is
+    stored once, directories are (parent directory id, name id) pairs, so
+    a relative path is just a (directory id, name id) pair and the common
+    prefixes of deep trees are never repeated. Manifests store paths as
+    such pairs, see FVSState.
+
+    Ids are never reused nor removed, so the table is append-only and the
+    pairs stored in old manifests stay valid.
+
+    Format:
+        {
+            "version": 1,
+            "names": ["<name>", ...],
+            "dirs": [parent_id, name_id, parent_id, name_id, ...]
+        }
+    The directory 0 is the root of the repository, with no parent (-1).
+    """
+    version: int = 1
+    root: int = 0
+
+    def __init__(self, repo: 'FVSRepo'):
+        self.__repo = repo
+        self.__table_path = os.path.join(repo.repo_path, ".fvs/paths.json")
+        self.__names = []
+        self.__name_ids = {}
+        self.__dirs = [-1, -1]
+        self.__dir_ids = {"": self.root}
+        self.__dir_paths = [""]
+        self.__dirty = False
+        self.__load()
+
+    def __load(self):
+        table_path = self.__repo.journal.resolve(self.__table_path)
+        if not os.path.exists(table_path):
+            return
+
+        with open(table_path, "rb") as f:
+            table = orjson.loads(f.read())
+
+        self.__names = table["names"]
+        self.__name_ids = {name: name_id for name_id, name in enumerate(self.__names)}
+        self.__dirs = table["dirs"]
+        for dir_id in range(1, len(self.__dirs) // 2):
+            parent_id, name_id = self.__dirs[dir_id * 2], self.__dirs[dir_id * 2 + 1]
+            dir_path = os.path.join(self.__dir_paths[parent_id], self.__names[name_id])
+            self.__dir_paths.append(dir_path)
+            self.__dir_ids[dir_path] = dir_id
+
+    def save(self):
+        """
+        Save the table through the journal, if anything was interned since
+        it was loaded.
+        """
+        if not self.__dirty:
+            return
+        self.__repo.journal.write(
+            self.__table_path,
+            orjson.dumps({"version": self.version, "names": self.__names, "dirs": self.__dirs})
+        )
+        self.__dirty = False
+
+    def intern_name(self, name: str) -> int:
+        """
+        Get the id of the given name, adding it to the table if missing.
+        """
+        name_id = self.__name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.__names)
+            self.__names.append(name)
+            self.__name_ids[name] = name_id
+            self.__dirty = True
+        return name_id
+
+    def intern_dir(self, dir_path: str) -> int:
+        """
+        Get the id of the given directory, adding it (and its parents) to
+        the table if missing.
+        """
+        dir_id = self.__dir_ids.get(dir_path)
+        if dir_id is None:
+            parent, name = os.path.split(dir_path)
+            parent_id = self.intern_dir(parent)
+            dir_id = len(self.__dir_paths)
+            self.__dirs += [parent_id, self.intern_name(name)]
+            self.__dir_paths.append(dir_path)
+            self.__dir_ids[dir_path] = dir_id
+            self.__dirty = True
+        return dir_id
+
+    def intern(self, relative_path: str) -> tuple:
+        """
+        Get the (directory id, name id) pair of the given relative path.
+        """
+        parent, name = os.path.split(relative_path)
+        return self.intern_dir(parent), self.intern_name(name)
+
+    def lookup(self, relative_path: str) -> tuple:
+        """
+        Get the (directory id, name id) pair of the given relative path
+        without interning it, None if it is not in the table.
+        """
+        parent, name = os.path.split(relative_path)
+        dir_id = self.__dir_ids.get(parent)
+        name_id = self.__name_ids.get(name)
+        if dir_id is None or name_id is None:
+            return None
+        return dir_id, name_id
+
+    def lookup_dir(self, dir_path: str) -> int:
+        """
+        Get the id of the given directory without interning it, None if
+        it is not in the table.
+        """
+        return self.__dir_ids.get(dir_path)
+
+    def get_parent(self, dir_id: int) -> int:
+        return self.__dirs[dir_id * 2]
+
+    def resolve(self, dir_id: int, name_id: int) -> str:
+        """
+        Get the relative path of the given (directory id, name id) pair.
+        """
+        return os.path.join(self.__dir_paths[dir_id], self.__names[name_id])
+
+    def get_name(self, name_id: int) -> str:
+        return self.__names[name_id]
@@ -1,3 +1,4 @@
+import os
 import fnmatch
 import logging
 
@@ -18,3 +19,41 @@ class FVSPattern:
                 logger.debug(f"One pattern match: {file_name} matches {pattern}")
                 return True
         return False
+
+    @staticmethod
+    def match_path(paths: list, relative_path: str) -> bool:
+        """
+        This method will check if the relative_path is one of the given
+        paths or is inside one of them. Paths can contain the same
+        wildcards supported by match.
+        """
+        for path in paths:
+            path = os.path.normpath(path)
+            if path == "." or fnmatch.fnmatch(relative_path, path) \
+                    or fnmatch.fnmatch(relative_path, os.path.join(path, "*")):
+                return True
+        return False
+
+    @staticmethod
+    def get_roots(paths: list) -> list:
+        """
+        This method will return the directories (or files) to scan to find
+        all the files matching the given paths: the leading part of each
+        path without wildcards, skipping the ones inside another root.
+        """
+        roots = []
+        for path in paths:
+            parts = []
+            for part in os.path.normpath(path).split(os.sep):
+                if any(char in part for char in "*?["):
+                    break
+                parts.append(part)
+            roots.append(os.path.join("", *parts) if parts and parts != ["."] else "")
+
+        roots.sort()
+        result = []
+        for root in roots:
+            if result and (result[-1] == "" or root == result[-1] or root.startswith(result[-1] + os.sep)):
+                continue
+            result.append(root)
+        return result
@@ -0,0 +1,81 @@
+import logging
+
+logger = logging.getLogger("fvs.record")
+
+
+class FVSEntry:
+    """
+    An entry of a state manifest: a file content, identified by its sha1,
+    and all the paths it is found at. Paths are stored as a flat list of
+    (directory id, name id) pairs of the repository FVSPathTable. Entries
+    are converted from and to the on-disk format only when the manifest
+    is loaded and saved. Moved entries store a pair of pairs for each
+    move: the new path and the old one.
+    """
+    __slots__ = ("file_name", "sha1", "paths")
+
+    def __init__(self, file_name: str, sha1: str, paths: list):
+        self.file_name = file_name
+        self.sha1 = sha1
+        self.paths = paths
+
+    def iter_paths(self):
+        """
+        Yield the (directory id, name id) pairs of the entry.
+        """
+        for i in range(0, len(self.paths), 2):
+            yield self.paths[i], self.paths[i + 1]
+
+    def iter_moves(self):
+        """
+        Yield the new and old (directory id, name id) pairs of each move
+        of a moved entry.
+        """
+        for i in range(0, len(self.paths), 4):
+            yield (self.paths[i], self.paths[i + 1]), (self.paths[i + 2], self.paths[i + 3])
+
+    def has_path(self, path: tuple) -> bool:
+        return path in self.iter_paths()
+
+    def has_new_path(self, path: tuple) -> bool:
+        """
+        Check if a moved entry has a move to the given path.
+        """
+        return any(new_path == path for new_path, _ in self.iter_moves())
+
+
+class FVSCatalogRow:
+    """
+    A row of the data catalog: an object of the store and the number of
+    references each state holds to it. State ids are strings on disk (JSON
+    keys) and integers in memory. The row also records how the object is
+    stored (see FVSCodec) and the size of the original file, they are None
+    until the object is written or for rows older than codecs.
+    """
+    __slots__ = ("file_name", "sha1", "states", "codec", "size")
+
+    def __init__(self, file_name: str, sha1: str, states: dict = None, codec: str = None, size: int = None):
+        self.file_name = file_name
+        self.sha1 = sha1
+        self.states = states if states is not None else {}
+        self.codec = codec
+        self.size = size
+
+    @classmethod
+    def from_dict(cls, row: dict) -> 'FVSCatalogRow':
+        return cls(
+            row["file_name"],
+            row["sha1"],
+            {int(key): value for key, value in row["states"].items()},
+            row.get("codec"),
+            row.get("size")
+        )
+
+    def as_dict(self) -> dict:
+        return {
+            "file_name": self.file_name,
+            "sha1": self.sha1,
+            "states": self.states,
+            "codec": self.codec,
+            "size": self.size
+        }
@@ -2,15 +2,34 @@ import os
 import time
 import orjson
 import shutil
+import hashlib
 import logging
+import tarfile
+import contextlib
+from typing import Union
+from concurrent.futures import ThreadPoolExecutor
 
 from fvs.exceptions import FVSNothingToCommit, FVSEmptyCommitMessage, FVSStateNotFound, FVSMissingStateIndex, \
-    FVSNothingToRestore, FVSStateZeroNotDeletable, FVSEmptyStateIndex, FVSStateAlreadyExists
+    FVSNothingToRestore, FVSStateZeroNotDeletable, FVSEmptyStateIndex, FVSStateAlreadyExists, \
+    FVSRemoteCompressionMismatch, FVSDivergedStates, FVSInvalidCheckoutPath, FVSInvalidStateRange, \
+    FVSRemoteHashModeMismatch, FVSNoCommitToResume
 from fvs.pattern import FVSPattern
 from fvs.state import FVSState
+from fvs.tree import FVSTree
+from fvs.change import FVSChange
+from fvs.codec import FVSCodec
+from fvs.scheduler import FVSScheduler
+from fvs.checkpoint import FVSCheckpoint
+from fvs.history import FVSHistory
+from fvs.paths import FVSPathTable
 from fvs.file import FVSFile
 from fvs.data import FVSData
+from fvs.journal import FVSJournal
+from fvs.lock import FVSLock
+from fvs.store import FVSStore
 from fvs.utils import FVSUtils
+from fvs.hasher import FVSHasher
+from fvs.archive import FVSArchive
 
 logger = logging.getLogger("fvs.repo")
 
@@ -19,19 +38,62 @@ class FVSRepo:
     __repo_conf: dict = None
     __has_no_states: bool = False
     __use_compression = False
-    __active_state: 'FVSState' = None
-
-    def __init__(self, repo_path: str, use_compression: bool = False, no_init: bool = False):
+    __hash_mode: str = "name"
+    __active_state_id: int = None
+    __state_cache: dict = None
+    __catalog: dict = None
+    __store: FVSStore = None
+    __paths: FVSPathTable = None
+    __scheduler: FVSScheduler = None
+    __checkpoint: FVSCheckpoint = None
+
+    def __init__(self, repo_path: str, use_compression: bool = False, no_init: bool = False, store: str = None,
+                 hash_mode: str = "content"):
         """
-        Initialize the FVSRepo.
+        Initialize the FVSRepo. The store is the path of a shared object
+        store to use when creating the repository, existing repositories
+        can be moved to a shared store with attach_store. New repositories
+        are content addressed, those created before keep hashing files
+        with their name until migrated, see migrate_hashes.
         """
         self.__repo_path = os.path.abspath(repo_path)
         self.__states_path = os.path.join(self.__repo_path, ".fvs/states")
         self.__use_compression = use_compression
+        self.__hash_mode = hash_mode
+        self.__store_path = os.path.abspath(store) if store else None
+        self.__lock = FVSLock(os.path.join(self.__repo_path, ".fvs"))
+        self.__journal = FVSJournal(os.path.join(self.__repo_path, ".fvs"), self.__lock)
         if not no_init:
             self.__update_fvs_path()
+        self.__recover()
         self.__load_config()
 
+    def __recover(self):
+        """
+        Recover a transaction interrupted by a crash. A journal is also
+        present while another process is committing, so the recovery only
+        happens if the write lock is free (the writer is gone). References
+        taken in a shared store by a rolled back transaction are dropped,
+        see FVSStore.acquire. The objects of a checkpointed commit survive
+        the recovery, so a warning tells how to resume or abort it.
+        """
+        if not self.__journal.pending:
+            return
+
+        if not self.__lock.acquire("write", True, blocking=False):
+            logger.debug("Journal found but another process is writing, skipping recovery.")
+            return
+
+        try:
+            for record in self.__journal.recover():
+                if record["op"] == "acquire":
+                    FVSStore.undo_acquire(record)
+        finally:
+            self.__lock.release("write")
+
+        if os.path.exists(os.path.join(self.__repo_path, FVSCheckpoint.file_path)):
+            logger.warning("A commit was interrupted, run fvs commit --resume to resume it or --abort to drop it.")
+
     def __update_fvs_path(self):
         """
         Update the path of the .fvs directory. This directory is not meant
@@ -51,37 +113,145 @@ class FVSRepo:
                 updated = True
 
         if not os.path.exists(repo_conf):
-            with open(repo_conf, "wb") as f:
-                self.__repo_conf = {"id": -1, "states": {}, "compression": self.__use_compression}
-                f.write(orjson.dumps(self.__repo_conf, f, option=orjson.OPT_NON_STR_KEYS,))
-                updated = True
+            self.__repo_conf = {
+                "id": -1,
+                "states": {},
+                "compression": self.__use_compression,
+                "hash": self.__hash_mode,
+                "store": self.__store_path,
+                "uuid": FVSStore.new_repo_id()
+            }
+            self.__journal.write(repo_conf, orjson.dumps(self.__repo_conf, option=orjson.OPT_NON_STR_KEYS))
+            updated = True
 
         if updated:
             logger.debug(f"FVS path updated for repository {self.__repo_path}")
 
     def __load_config(self):
         """
-        Load the repository configuration.
+        Load the repository configuration. The read lock is held so that
+        the configuration is read from a committed snapshot. Only repo.json
+        is read here: the store, the path table, the catalog and the state
+        manifests are loaded on first use and cached until the next reload
+        (i.e. until the next transaction starts or fails, or another process
+        commits, see __snapshot), so commands only reading the configuration
+        stay cheap.
         """
         repo_conf = os.path.join(self.__repo_path, ".fvs/repo.json")
-        with open(repo_conf, "r") as f:
-            self.__repo_conf = orjson.loads(f.read())
+        with self.__lock.shared():
+            with open(self.__journal.resolve(repo_conf), "rb") as f:
+                self.__repo_conf = orjson.loads(f.read())
+                self.__snapshot_id = self.__get_snapshot_id(os.fstat(f.fileno()))
+
+            """
+            JSON store int key as strings, so we need to convert them back to int.
+            """
+            self.__states = FVSHistory({int(key): value for key, value in self.__repo_conf["states"].items()})
+
+        self.__has_no_states = int(self.__repo_conf["id"]) < 0
+        self.__active_state_id = None if self.__has_no_states else int(self.__repo_conf["id"])
+        self.__use_compression = self.__repo_conf["compression"]
+        self.__hash_mode = self.__repo_conf.get("hash", "name")
+        self.__store_path = self.__repo_conf.get("store")
+        self.__scheduler = FVSScheduler(self.__repo_conf.get("io_order"))
+        self.__state_cache = {}
+        self.__catalog = None
+        self.__store = None
+        self.__paths = None
 
+    @staticmethod
+    def __get_snapshot_id(_stat: os.stat_result) -> tuple:
         """
-        JSON store int key as strings, so we need to convert them back to int.
+        Identify the snapshot of the repository by the stat of repo.json:
+        every transaction changing the repository rewrites it, through a
+        new file renamed in place.
         """
-        self.__states = {int(key): value for key, value in self.__repo_conf["states"].items()}
+        return _stat.st_ino, _stat.st_mtime_ns, _stat.st_size
 
-        if int(self.__repo_conf["id"]) >= 0:
-            self.__active_state = FVSState(self, int(self.__repo_conf["id"]))
-        else:
-            self.__has_no_states = True
-        
-        self.__use_compression = self.__repo_conf["compression"]
+    def __refresh(self):
+        """
+        Reload the configuration, dropping the cached metadata, if another
+        process committed since it was read. Metadata loaded on first use
+        (state manifests, path table, catalog) thus always belongs to the
+        same snapshot as the configuration. The read lock must be held.
+        Transactions always see their own changes.
+        """
+        if self.__journal.active:
+            return
 
-    def get_unstaged_files(self, ignore: list = None, purpose: int = 0) -> dict:
+        repo_conf = os.path.join(self.__repo_path, ".fvs/repo.json")
+        if self.__get_snapshot_id(os.stat(repo_conf)) != self.__snapshot_id:
+            logger.debug("The repository changed since it was loaded, reloading it.")
+            self.__load_config()
+
+    @contextlib.contextmanager
+    def __snapshot(self):
+        """
+        Hold the read lock for the wrapped code, reading from the last
+        committed snapshot, see __refresh.
         """
-        Get the unstaged files.
+        with self.__lock.shared():
+            self.__refresh()
+            yield
+
+    def get_state(self, state_id: int) -> FVSState:
+        """
+        Get the state with the given id. States are immutable once
+        committed, so they are loaded once and cached.
+        ...
+        Raises:
+            FVSStateNotFound: If the state doesn't exist.
+        """
+        state_id = int(state_id)
+        state = self.__state_cache.get(state_id)
+        if state is None:
+            with self.__snapshot():
+                state = FVSState(self, state_id)
+            self.__state_cache[state_id] = state
+        return state
+
+    @property
+    def __active_state(self) -> Union[FVSState, None]:
+        if self.__active_state_id is None:
+            return None
+        return self.get_state(self.__active_state_id)
+
+    @__active_state.setter
+    def __active_state(self, state: Union[FVSState, None]):
+        if state is None:
+            self.__active_state_id = None
+            return
+        self.__active_state_id = state.state_id
+        self.__state_cache[state.state_id] = state
+
+    @contextlib.contextmanager
+    def __transaction(self):
+        """
+        Run the wrapped operation in a journal transaction, holding the write
+        lock. The configuration is reloaded once the lock is acquired, since
+        another process may have changed the repository in the meantime, and
+        again if the operation fails, to drop in-memory changes. Operations
+        called by another operation join its transaction.
+        """
+        if self.__journal.active:
+            yield
+            return
+
+        with self.__lock.exclusive("write"):
+            self.__load_config()
+            try:
+                with self.__journal.transaction():
+                    yield
+            except BaseException:
+                self.__load_config()
+                raise
+
+    def get_unstaged_files(self, ignore: list = None, purpose: int = 0, paths: list = None,
+                           state: FVSState = None) -> dict:
+        """
+        Get the unstaged files, comparing the working tree with the given
+        state (the active state by default). This collects all the changes
+        yielded by iter_changes, intact and moved files included.
         ...
         Purpose values:
             0: Committing a new state.
@@ -92,257 +262,1193 @@ class FVSRepo:
             "added": [],
             "removed": [],
             "modified": [],
-            "intact": []
+            "intact": [],
+            "moved": []
         }
-        active_state_files = {}
 
+        for change in self.iter_changes(ignore, purpose, paths, state, intact=True):
+            unstaged_files[change.status].append(change)
+            if change.status != "intact":
+                unstaged_files["count"] += 1
+
+        return unstaged_files
+
+    @staticmethod
+    def __detect_moves(unstaged_files: dict):
+        """
+        Pair the added and removed files of the given unstaged files by
+        sha1, one to one, and replace each pair with a moved file, at the
+        added (new) path and with the removed path as old_relative_path.
+        Moved files need no data I/O: their object is already in the
+        store, so commits only record them in the manifest and restores
+        rename them back.
+        """
+        removed = {}
+        for _file in unstaged_files["removed"]:
+            removed.setdefault(_file.sha1, []).append(_file)
+
+        added = []
+        moved = unstaged_files["moved"]
+        for _file in unstaged_files["added"]:
+            if removed.get(_file.sha1):
+                orig = removed[_file.sha1].pop(0)
+                moved.append(FVSChange(
+                    "moved", _file.file_name, _file.sha1, _file.relative_path, _file.stat,
+                    old_relative_path=orig.relative_path
+                ))
+            else:
+                added.append(_file)
+
+        if moved:
+            unstaged_files["added"] = added
+            unstaged_files["removed"] = [_file for files in removed.values() for _file in files]
+            unstaged_files["count"] -= len(moved)
+
+    def iter_changes(self, ignore: list = None, purpose: int = 0, paths: list = None,
+                     state: FVSState = None, intact: bool = False):
+        """
+        Compare the working tree with the given state (the active state by
+        default), yielding a FVSChange as soon as each change is discovered,
+        so callers can show progress or stop at the first change. Removed
+        files are only known once the scan is over, so they come last,
+        after the moved files: added files with the sha1 of a file of the
+        state are held back until then, as they may be moves (see
+        __detect_moves). Intact files are yielded only if requested. If
+        paths are given, only the matching files are compared and only
+        their subtrees are scanned, see FVSPattern.match_path.
+        ...
+        Purpose values:
+            0: Committing a new state.
+            1: Restoring a state (will return original sha1 for modified files)
+        """
         if ignore is None:
             ignore = []
 
         """
-        The following new variable is used to store all relative paths
-        handled in the following loop. We will use them to list removed
-        files.
+        Index the state tree by relative path, so each scanned file is
+        classified with a single lookup. Entries left in the index once
+        the scan is over were removed from the working tree.
         """
-        unstaged_relative_paths = []
+        state_files = {}
+        state_sha1s = set()
+        tree = None
+        with self.__snapshot():
+            if state is None:
+                state = self.__active_state
+            if state is not None:
+                tree = FVSTree.load(self, state.state_id)
+                for _file in state.iter_files():
+                    if paths is None or FVSPattern.match_path(paths, _file.relative_path):
+                        state_files[_file.relative_path] = _file
+                        state_sha1s.add(_file.sha1)
+
+        moves = {"count": 0, "added": [], "removed": [], "moved": []}
+
+        for _full_path, file, _relative_path, _stat, _sha1 in self.__hash_files(
+                self.__iter_candidates(ignore, paths, state_files, tree)):
+            if _sha1 is None:
+                continue
 
+            """
+            Here we determinate if the file is added, modified or intact,
+            comparing with the state or simply adding it if there is no
+            state to compare with.
+            """
+            orig = state_files.pop(_relative_path, None)
+            if orig is None and _sha1 in state_sha1s:
+                moves["added"].append(FVSChange("added", file, _sha1, _relative_path, _stat))
+            elif orig is None:
+                yield FVSChange("added", file, _sha1, _relative_path, _stat)
+            elif orig.sha1 == _sha1:
+                if intact:
+                    yield FVSChange("intact", file, _sha1, _relative_path, _stat)
+            else:
+                if purpose == 1:
+                    _sha1 = orig.sha1
+                yield FVSChange("modified", file, _sha1, _relative_path, _stat)
+
+        for _file in state_files.values():
+            _file.status = "removed"
+            _file.old_relative_path = None
+            moves["removed"].append(_file)
+
+        self.__detect_moves(moves)
+        yield from moves["moved"]
+        yield from moves["added"]
+        yield from moves["removed"]
+
+    def __iter_candidates(self, ignore: list, paths: list, state_files: dict, tree: FVSTree):
         """
-        Create a copy of the active state files so we can remove every
-        handled entry and easily figure out what was deleted.
+        Walk the working tree yielding, for each file to compare, a list
+        with its full path, name, relative path, stat fingerprint and sha1.
+        The sha1 is None if the file has to be hashed.
         """
-        if not self.__has_no_states:
-            active_state_files = self.__active_state.files.copy()
-        else:
-            active_state_files = {"added": {}, "removed": {}, "modified": {}, "intact": {}}
+        now = time.time_ns()
+        for _full_path, file in self.__walk(paths):
+            _relative_path = self.__get_relative_path(_full_path)
 
-        def del_active_state_file_key(sha1: str):
-            active_state_files["added"].pop(sha1, None)
-            active_state_files["modified"].pop(sha1, None)
-            active_state_files["intact"].pop(sha1, None)
-        
-        for root, _, files in os.walk(self.__repo_path):
             """
-            Here we are excluding the .fvs/ directory from the unstaged files
-            because we don't want to invoke the monster of loops.
+            Here we loop through the ignore pattern and remove the files that
+            match any of them. Check if performed on the relative path.
             """
-            if ".fvs" in root.split(os.sep):
+            if FVSPattern.match(ignore, _relative_path):
+                continue
+
+            if paths is not None and not FVSPattern.match_path(paths, _relative_path):
                 continue
 
             """
-            Here we loop through the files and determinate which ones are
-            added, removed, modified or intact, comparing with prior state 
-            or simply adding all of them if this is the first state.
+            Files whose stat fingerprint didn't change since the state was
+            committed keep the sha1 recorded in the state, without reading
+            them.
             """
-            for file in files:
-                _full_path = os.path.join(root, file)
-                _relative_path = self.__get_relative_path(os.path.join(root, file))
-
-                """
-                Here we loop through the ignore pattern and remove the files that
-                match any of them. Check if performed on the relative path.
-                """
-                if FVSPattern.match(ignore, _relative_path):
-                    continue
-
-                """
-                Here we calculate the sha1 of the file. It will return None if
-                the file is not accessible or doesn't exist.
-                """
-                _sha1 = FVSUtils.get_sha1_hash(_full_path)
-                if _sha1 is None:
-                    continue
-                
-                _entry = {
-                    "file_name": file,
-                    "sha1": _sha1,
-                    "relative_path": _relative_path
-                }
+            try:
+                _stat = FVSTree.fingerprint(os.stat(_full_path), now)
+            except OSError:
+                continue
 
-                unstaged_relative_paths.append(_relative_path)
+            _sha1 = None
+            orig = state_files.get(_relative_path)
+            if _stat is not None and orig is not None and tree is not None \
+                    and tree.get_stat(_relative_path) == _stat:
+                _sha1 = orig.sha1
+            elif self.__checkpoint is not None:
+                _sha1 = self.__checkpoint.get_sha1(_relative_path, _stat)
+            yield [_full_path, file, _relative_path, _stat, _sha1]
 
-                """
-                If this is the first state, just add all files.
-                """
-                if self.__has_no_states:
-                    unstaged_files["added"].append(_entry)
-                    unstaged_files["count"] += 1
-                    continue
+    def __hash_files(self, candidates):
+        """
+        Calculate the sha1 of the candidates needing it, yielding them in
+        the same order. The sha1 stays None if the file is not accessible
+        or doesn't exist. With an I/O order set, candidates are hashed in
+        batches sorted by their position on disk, see FVSScheduler. Hashed
+        files are recorded in the commit checkpoint, if any.
+        """
+        def _get_path(candidate: list):
+            return candidate[0] if candidate[4] is None else None
+
+        scheduler = self.__scheduler
+        for batch in scheduler.iter_batches(candidates, _get_path):
+            for candidate in scheduler.sort([c for c in batch if c[4] is None], _get_path):
+                candidate[4] = FVSUtils.get_sha1_hash(candidate[0], hash_mode=self.__hash_mode)
+                if self.__checkpoint is not None and candidate[4] is not None:
+                    self.__checkpoint.add_hash(candidate[2], candidate[3], candidate[4])
+            yield from batch
+
+    def is_dirty(self, ignore: list = None) -> bool:
+        """
+        Check if the working tree has any change, stopping at the first one.
+        """
+        return next(self.iter_changes(ignore), None) is not None
 
-                """
-                Assuming this is not the first state, we need to check if
-                the file is added, removed, modified or intact.
-                """
-                if self.__active_state.has_file(_sha1, _relative_path):
-                    unstaged_files["intact"].append(_entry)
-                elif orig := self.__active_state.has_relative_path(_relative_path):
-                    if purpose == 1:
-                        _sha1 = orig["sha1"]
-                    unstaged_files["modified"].append({
-                        "file_name": file,
-                        "sha1": _sha1,
-                        "relative_path": _relative_path
-                    })
-                    unstaged_files["count"] += 1
-                    print(f"{_relative_path}is modified")
-                else:
-                    unstaged_files["added"].append(_entry)
-                    unstaged_files["count"] += 1
-
-                unstaged_relative_paths.append(_relative_path)
-
-        if not self.__has_no_states:
-            for file in list(active_state_files["added"].values()) + \
-                        list(active_state_files["modified"].values()) + \
-                        list(active_state_files["intact"].values()):
-                for relative_path in file["relative_paths"]:
-                    if relative_path not in unstaged_relative_paths:
-                        unstaged_files["removed"].append({
-                            "file_name": file["file_name"],
-                            "sha1": file["sha1"],
-                            "relative_path": relative_path
-                        })
-                        unstaged_files["count"] += 1
+    def __walk(self, paths: list = None):
+        """
+        Walk the working tree, or only the subtrees of the given paths,
+        yielding the full path and the name of each file. Here we are
+        excluding the .fvs/ directories because we don't want to invoke
+        the monster of loops. Given roots resolving inside the .fvs/
+        directory of the repository (e.g. .fvs/states, or a path through
+        a symlink to it) are skipped too, symlinks are never followed.
+        """
+        fvs_path = os.path.realpath(os.path.join(self.__repo_path, ".fvs"))
+        roots = [""] if paths is None else FVSPattern.get_roots(paths)
+        for root in roots:
+            full_root = os.path.join(self.__repo_path, root)
+            real_root = os.path.join(os.path.realpath(os.path.dirname(full_root)), os.path.basename(full_root))
+            if os.path.commonpath([real_root, fvs_path]) == fvs_path:
+                logger.warning(f"Skipping {root}, it is inside the repository metadata.")
+                continue
+            if os.path.islink(full_root) or os.path.isfile(full_root):
+                yield full_root, os.path.basename(full_root)
+                continue
 
-        return unstaged_files
+            for _root, dirs, files in os.walk(full_root):
+                dirs[:] = [_dir for _dir in dirs if _dir != ".fvs"]
+                for file in files:
+                    yield os.path.join(_root, file), file
 
-    def commit(self, message: str, ignore: list = None) -> dict:
+    def commit(self, message: str = None, ignore: list = None, paths: list = None, resume: bool = False) -> dict:
         """
         Commit the current state. This is a wrapper around the commit method
         of the FVSState class. A wrapper is used to store the state message
-        and process staged files before committing.
+        and process staged files before committing. If paths are given,
+        only their subtrees are scanned (see FVSPattern.match_path) and the
+        rest of the active state is carried forward as intact, with its
+        stat fingerprints, so the new state is still a full snapshot.
+
+        The progress is checkpointed (see FVSCheckpoint): if the commit is
+        interrupted, the next one doesn't hash again the files which didn't
+        change since and reuses the objects already written. With resume
+        set, the interrupted commit is resumed with the message, ignore
+        patterns and paths it was started with, see also abort_commit.
         ...
         Raises:
             FVSEmptyCommitMessage: If the message is empty.
             FVSNothingToCommit: If there are no unstaged files.
+            FVSNoCommitToResume: If resume is set but no commit was
+            interrupted.
         """
-        if message in [None, ""]:
+        if not resume and message in [None, ""]:
             raise FVSEmptyCommitMessage()
 
-        unstaged_files = self.get_unstaged_files(ignore)
-        if unstaged_files["count"] == 0:
-            raise FVSNothingToCommit()
+        paths = self.__get_relative_paths(paths)
+        with self.__transaction():
+            checkpoint = FVSCheckpoint(self)
+            if resume:
+                if not checkpoint.exists:
+                    raise FVSNoCommitToResume()
+                message, ignore, paths = checkpoint.message, checkpoint.ignore, checkpoint.paths
+            checkpoint.start(message, ignore, paths)
+            self.__drop_pending_objects(checkpoint)
+
+            self.__checkpoint = checkpoint
+            try:
+                unstaged_files = self.get_unstaged_files(ignore, paths=paths)
+                if unstaged_files["count"] == 0:
+                    raise FVSNothingToCommit()
+
+                if paths is not None and self.__active_state is not None:
+                    tree = FVSTree.load(self, self.__active_state_id)
+                    for _file in self.__active_state.iter_files():
+                        if FVSPattern.match_path(paths, _file.relative_path):
+                            continue
+                        _file.status = "intact"
+                        _file.old_relative_path = None
+                        _file.stat = tree.get_stat(_file.relative_path) if tree is not None else None
+                        unstaged_files["intact"].append(_file)
+
+                # Create a new state
+                state = self.__commit_state(message, unstaged_files)
+                self.__active_state = state
+                self.__update_repo()
+
+                """
+                Objects written by an interrupted commit for files which
+                changed since are not referenced by the new state.
+                """
+                self.__release_checkpoint_objects(checkpoint)
+                self.__journal.on_commit(checkpoint.discard)
+            except FVSNothingToCommit:
+                raise
+            except BaseException:
+                checkpoint.save()
+                raise
+            finally:
+                self.__checkpoint = None
+        return {
+            "state_id": state.state_id,
+            "message": message,
+            "timestamp": time.time(),
+            "added": len(unstaged_files["added"]),
+            "removed": len(unstaged_files["removed"]),
+            "modified": len(unstaged_files["modified"]),
+            "intact": len(unstaged_files["intact"]),
+            "moved": len(unstaged_files["moved"]),
+            "lock_wait": self.__lock.wait_time
+        }
 
-        # Create a new state
+    def abort_commit(self) -> int:
+        """
+        Abort an interrupted commit: the objects it wrote are released,
+        unless a state references them, and its checkpoint is discarded.
+        It returns the number of released objects.
+        ...
+        Raises:
+            FVSNoCommitToResume: If no commit was interrupted.
+        """
+        with self.__transaction():
+            checkpoint = FVSCheckpoint(self)
+            if not checkpoint.exists:
+                raise FVSNoCommitToResume()
+            return self.__discard_checkpoint(checkpoint)
+
+    def __discard_checkpoint(self, checkpoint: FVSCheckpoint) -> int:
+        """
+        Release the objects of an interrupted commit and discard its
+        checkpoint once the transaction is committed. It returns the
+        number of released objects.
+        """
+        released = self.__drop_pending_objects(checkpoint)
+        released += self.__release_checkpoint_objects(checkpoint)
+        self.__journal.on_commit(checkpoint.discard)
+        return released
+
+    def __drop_pending_objects(self, checkpoint: FVSCheckpoint) -> int:
+        """
+        Delete the objects an interrupted commit was writing: they were
+        not synced, so they can't be trusted after a power loss. Objects of
+        shared stores are left alone, as other repositories may have
+        written them, and stay listed in the checkpoint, so that their
+        references are released with the other objects of the checkpoint
+        if no state needs them, see __release_checkpoint_objects. It
+        returns the number of deleted objects.
+        """
+        if self.store.is_shared:
+            return 0
+
+        fvs_data = FVSData(self)
+        dropped = 0
+        for file_name, sha1 in checkpoint.iter_pending():
+            if fvs_data.get_file_location(sha1) is not None:
+                continue
+            object_path = self.store.get_object_path(file_name, sha1)
+            dropped += os.path.lexists(object_path)
+            for path in [object_path, object_path + self.__journal.tmp_suffix]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+        checkpoint.drop_pending()
+        return dropped
+
+    def __release_checkpoint_objects(self, checkpoint: FVSCheckpoint) -> int:
+        """
+        Release the objects written by an interrupted commit which no
+        state references, returning their number.
+        """
+        fvs_data = FVSData(self)
+        files = [
+            FVSFile(self, file_name, sha1, []) for file_name, sha1 in checkpoint.iter_objects()
+            if fvs_data.get_file_location(sha1) is None
+        ]
+        self.store.release(files, self.repo_id, self.__journal)
+        return len(files)
+
+    def __commit_state(self, message: str, unstaged_files: dict, state_id: int = None,
+                       timestamp: float = None) -> FVSState:
+        """
+        Commit a new state with the given unstaged files and register it in
+        the repository states. It doesn't change the active state.
+        """
         state = FVSState(self)
-        state.commit(message, unstaged_files)
+        state.commit(message, unstaged_files, state_id)
+        self.__state_cache[state.state_id] = state
+        FVSTree.build(
+            self,
+            unstaged_files["added"] + unstaged_files["modified"] + unstaged_files["intact"]
+            + unstaged_files.get("moved", [])
+        ).save(self, state.state_path)
         self.__states[state.state_id] = {
             "message": message,
-            "timestamp": time.time()
+            "timestamp": timestamp or time.time()
         }
-        self.__active_state = state
-        self.__update_repo()
+        return state
+
+    def receive(self, source: 'FVSTransport', workers: int = 8) -> list:
+        """
+        Receive from the source the states this repository lacks. The
+        repositories negotiate first at state level, this repository must
+        have a prefix of the source states, then at object level: only the
+        objects referenced by the new states and not already in the store
+        are transferred, streaming them in parallel. The working tree and
+        the active state are not touched, unless the repository had no
+        states, in which case the newest received state becomes active.
+        It returns the list of received state ids.
+        ...
+        Raises:
+            FVSRemoteCompressionMismatch: If the repositories use different
+            compression settings.
+            FVSRemoteHashModeMismatch: If the repositories use different
+            hash modes.
+            FVSDivergedStates: If the repositories have different states
+            with the same id.
+        """
+        with self.__transaction():
+            with source:
+                info = source.get_info()
+                if info["compression"] != self.__use_compression:
+                    raise FVSRemoteCompressionMismatch()
+                if info.get("hash", "name") != self.__hash_mode:
+                    raise FVSRemoteHashModeMismatch()
+
+                source_states = {int(key): value for key, value in info["states"].items()}
+                for state_id, state in self.__states.items():
+                    if source_states.get(state_id) != state:
+                        raise FVSDivergedStates(state_id)
+
+                last_state_id = self.__states.last if len(self.__states) else -1
+                new_state_ids = sorted(key for key in source_states if key not in self.__states)
+                if new_state_ids and new_state_ids[0] < last_state_id:
+                    raise FVSDivergedStates(new_state_ids[0])
+
+                manifests = [(state_id, source.get_manifest(state_id)) for state_id in new_state_ids]
+
+                """
+                Here we negotiate the objects: wanted ones are those referenced
+                by the new states, which are not already in the store. Objects
+                are referenced in the store before being written.
+                """
+                wanted = {}
+                for _, manifest in manifests:
+                    for _file in manifest["added"] + manifest["modified"]:
+                        if _file.sha1 == FVSHasher.empty_sha1:
+                            continue
+                        wanted[_file.sha1] = FVSFile(self, _file.file_name, _file.sha1, [])
+                self.store.acquire(list(wanted.values()), self.repo_id, self.__journal)
+                wanted = [
+                    file for file in wanted.values()
+                    if not os.path.lexists(self.store.get_object_path(file.file_name, file.sha1))
+                ]
+                logger.debug(f"Receiving {len(new_state_ids)} states and {len(wanted)} objects.")
+
+                def _transfer(file: FVSFile):
+                    with source.open_object(file.file_name, file.sha1) as f:
+                        self.store.write_object(file.file_name, file.sha1, f, self.__journal)
+
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    list(executor.map(_transfer, wanted))
+
+            for state_id, manifest in manifests:
+                self.__commit_state(
+                    source_states[state_id]["message"],
+                    manifest,
+                    state_id,
+                    source_states[state_id]["timestamp"]
+                )
+
+            if self.__active_state is None and new_state_ids:
+                self.__active_state = self.get_state(new_state_ids[-1])
+            self.__update_repo()
+
+        return new_state_ids
+
+    def push(self, transport: 'FVSTransport', workers: int = 8) -> list:
+        """
+        Push the states the other repository lacks, see receive.
+        """
+        return transport.send(self, workers)
+
+    def pull(self, transport: 'FVSTransport', workers: int = 8) -> list:
+        """
+        Pull the states this repository lacks, see receive.
+        """
+        return self.receive(transport, workers)
+
+    def diff(self, state_a: int, state_b: int):
+        """
+        Compare two states using only their manifests, yielding a dict for
+        each changed path with the following keys: status (added, removed,
+        modified or moved), relative_path, sha1 (of the file in state_b,
+        or state_a for removed files) and old_relative_path (moved files
+        only). The sorted trees of both states are merge-walked, so the
+        comparison is linear in the size of the states, and if both states
+        have a FVSTree only the paths of the changed directories are
+        compared (see FVSTree.changed_files); only removed and added paths
+        are kept in memory to detect moves, i.e. the same file removed from
+        a path and added to another.
+        ...
+        Raises:
+            FVSStateNotFound: If one of the states doesn't exist.
+        """
+        with self.__snapshot():
+            for state_id in [state_a, state_b]:
+                if int(state_id) not in self.__states:
+                    raise FVSStateNotFound(state_id)
+            tree_a = FVSTree.load(self, int(state_a))
+            tree_b = FVSTree.load(self, int(state_b))
+            if tree_a is not None and tree_b is not None:
+                files_a, files_b = [sorted(files) for files in tree_a.changed_files(tree_b)]
+            else:
+                files_a = self.get_state(state_a).sorted_files()
+                files_b = self.get_state(state_b).sorted_files()
+
+        removed = {}
+        added = []
+        i, j = 0, 0
+        while i < len(files_a) or j < len(files_b):
+            if j == len(files_b) or (i < len(files_a) and files_a[i][0] < files_b[j][0]):
+                removed.setdefault(files_a[i][1], []).append(files_a[i][0])
+                i += 1
+            elif i == len(files_a) or files_b[j][0] < files_a[i][0]:
+                added.append(files_b[j])
+                j += 1
+            else:
+                if files_a[i][1] != files_b[j][1]:
+                    yield {"status": "modified", "relative_path": files_b[j][0], "sha1": files_b[j][1]}
+                i += 1
+                j += 1
+
+        for relative_path, sha1, _ in added:
+            if removed.get(sha1):
+                yield {
+                    "status": "moved",
+                    "relative_path": relative_path,
+                    "sha1": sha1,
+                    "old_relative_path": removed[sha1].pop(0)
+                }
+            else:
+                yield {"status": "added", "relative_path": relative_path, "sha1": sha1}
+
+        for sha1, relative_paths in removed.items():
+            for relative_path in relative_paths:
+                yield {"status": "removed", "relative_path": relative_path, "sha1": sha1}
+
+    def checkout(self, state_id: int, dest: str, method: str = "auto", workers: int = 8) -> dict:
+        """
+        Build the tree of the state with the given id in the dest directory,
+        without touching the working tree nor the repository states. Files
+        are cloned from the object store with the given method:
+            auto:     reflink, falling back to a copy;
+            reflink:  reflink only, raising on unsupported file systems;
+            hardlink: hard link, falling back to a copy. This is the fastest
+                      but files share the inode of the stored objects, so
+                      they must never be modified in place;
+            copy:     copy.
+        Compressed objects are always decompressed. Files are processed in
+        parallel, it returns the number of files per method used.
+        ...
+        Raises:
+            FVSStateNotFound: If the state doesn't exist.
+            FVSInvalidCheckoutPath: If dest is inside the repository.
+        """
+        dest = os.path.abspath(dest)
+        if os.path.commonpath([dest, self.__repo_path]) == self.__repo_path:
+            raise FVSInvalidCheckoutPath(dest)
+
+        stats = {"reflink": 0, "hardlink": 0, "copy": 0}
+        methods = {
+            "auto": ["reflink", "copy"],
+            "reflink": ["reflink"],
+            "hardlink": ["hardlink", "copy"],
+            "copy": ["copy"]
+        }[method]
+
+        def _checkout(_file: FVSChange):
+            file = FVSFile(self, _file.file_name, _file.sha1, [_file.relative_path])
+            int_path = self.store.get_int_path(_file.file_name, _file.sha1)
+            dest_path = os.path.join(dest, _file.relative_path)
+
+            if _file.sha1 == FVSHasher.empty_sha1:
+                open(dest_path, "wb").close()
+                return "copy"
+
+            if self.__use_compression:
+                with file.open(int_path) as (info, f):
+                    if f is None:
+                        os.symlink(info.linkname, dest_path)
+                    else:
+                        extents = FVSCodec.get_extents(info)
+                        with open(dest_path, "wb") as f_dest:
+                            if extents is not None:
+                                FVSUtils.write_extents(f, f_dest, info.size, extents)
+                            else:
+                                shutil.copyfileobj(f, f_dest)
+                        os.chmod(dest_path, info.mode & 0o7777)
+                        os.utime(dest_path, (info.mtime, info.mtime))
+                return "copy"
+
+            object_path = os.path.join(int_path, _file.sha1)
+            if os.path.islink(object_path):
+                os.symlink(os.readlink(object_path), dest_path)
+                return "copy"
+
+            for _method in methods:
+                if _method == "reflink" and FVSUtils.reflink(object_path, dest_path):
+                    return _method
+                if _method == "hardlink":
+                    try:
+                        os.link(object_path, dest_path, follow_symlinks=False)
+                        return _method
+                    except OSError:
+                        continue
+                if _method == "copy":
+                    FVSUtils.copy_file(object_path, dest_path)
+                    return _method
+            raise OSError(f"Unable to {method} {object_path} to {dest_path}")
+
+        with self.__snapshot():
+            if int(state_id) not in self.__states:
+                raise FVSStateNotFound(state_id)
+
+            files = self.__scheduler.sort(
+                list(self.get_state(state_id).iter_files()),
+                lambda _file: self.store.get_object_path(_file.file_name, _file.sha1)
+            )
+            for dir_name in {os.path.dirname(_file.relative_path) for _file in files}:
+                os.makedirs(os.path.join(dest, dir_name), exist_ok=True)
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for used in executor.map(_checkout, files):
+                    stats[used] += 1
+
+        return stats
+
+    def export_state(self, state_id: int, fileobj, archive_format: str = None):
+        """
+        Export the state with the given id as a tar archive written to the
+        given file object, streaming the files straight from the object
+        store (decompressing them on the fly if needed). The working tree
+        is not touched. See FVSArchive for the supported formats.
+        ...
+        Raises:
+            FVSStateNotFound: If the state doesn't exist.
+            FVSUnsupportedArchiveFormat: If the format is not supported.
+        """
+        with self.__snapshot():
+            if int(state_id) not in self.__states:
+                raise FVSStateNotFound(state_id)
+
+            state = self.get_state(state_id)
+            with FVSArchive.open_writer(fileobj, archive_format) as tar:
+                for _file in state.iter_files():
+                    file = FVSFile(self, _file.file_name, _file.sha1, [_file.relative_path])
+                    with file.open(self.store.get_int_path(_file.file_name, _file.sha1)) as (info, f):
+                        tar.addfile(info, f)
+
+    def import_state(self, fileobj, message: str) -> dict:
+        """
+        Import a tar archive (e.g. made by export_state) as a new state.
+        Files are streamed straight into the object store, hashing them
+        on the way, and only objects not already in the store are kept.
+        The new state is relative to the active state, which is changed
+        only if the repository had no states, the working tree is not
+        touched. Only regular files and symlinks are imported, symlinks
+        only in content addressed repositories: those hashing files with
+        their name hash the symlink target content, which the archive
+        doesn't have, so they are skipped with a warning.
+        ...
+        Raises:
+            FVSEmptyCommitMessage: If the message is empty.
+            FVSNothingToCommit: If the archive matches the active state.
+            FVSUnsupportedArchiveFormat: If the archive can't be read.
+        """
+        if message in [None, ""]:
+            raise FVSEmptyCommitMessage()
+
+        with self.__transaction():
+            received = {}
+            with FVSArchive.open_reader(fileobj) as tar:
+                for info in tar:
+                    relative_path = os.path.normpath(info.name)
+                    if not (info.isreg() or info.issym()) or os.path.isabs(relative_path) \
+                            or relative_path.split(os.sep)[0] in ["..", ".fvs"]:
+                        logger.debug(f"Skipping {info.name} while importing.")
+                        continue
+                    if info.issym() and self.__hash_mode == "name":
+                        logger.warning(f"Skipping symlink {info.name}, run fvs migrate-hashes to import symlinks.")
+                        continue
+                    if relative_path in received:
+                        os.remove(received[relative_path][0])
+                    received[relative_path] = self.__import_file(tar, info, relative_path, len(received))
+
+            """
+            Objects are referenced in the store all at once, then the
+            temporary files are moved in place, or dropped if the store
+            already had the same object.
+            """
+            self.store.acquire(
+                [file for _, file in received.values() if file.sha1 != FVSHasher.empty_sha1], self.repo_id,
+                self.__journal)
+            for tmp_path, file in received.values():
+                dest = self.store.get_object_path(file.file_name, file.sha1)
+                if os.path.lexists(dest) or file.sha1 == FVSHasher.empty_sha1:
+                    os.remove(tmp_path)
+                    continue
+                self.__journal.track(dest, keep=self.store.is_shared)
+                if self.__use_compression:
+                    FVSCodec.encode(tmp_path, dest + self.__journal.tmp_suffix, dest, file.sha1)
+                    os.remove(tmp_path)
+                else:
+                    os.replace(tmp_path, dest)
+
+            unstaged_files = {"count": 0, "added": [], "removed": [], "modified": [], "intact": [], "moved": []}
+            active_files = {}
+            if self.__active_state is not None:
+                active_files = {_file.relative_path: _file for _file in self.__active_state.iter_files()}
+
+            for relative_path, (_, file) in received.items():
+                orig = active_files.pop(relative_path, None)
+                if orig is not None and orig.sha1 == file.sha1:
+                    unstaged_files["intact"].append(FVSChange("intact", file.file_name, file.sha1, relative_path))
+                    continue
+                status = "modified" if orig is not None else "added"
+                unstaged_files[status].append(FVSChange(status, file.file_name, file.sha1, relative_path))
+                unstaged_files["count"] += 1
+
+            for _file in active_files.values():
+                _file.status = "removed"
+                _file.old_relative_path = None
+            unstaged_files["removed"] = list(active_files.values())
+            unstaged_files["count"] += len(unstaged_files["removed"])
+            self.__detect_moves(unstaged_files)
+            if unstaged_files["count"] == 0:
+                raise FVSNothingToCommit()
+
+            state = self.__commit_state(message, unstaged_files)
+            if self.__active_state is None:
+                self.__active_state = state
+            self.__update_repo()
+
         return {
             "state_id": state.state_id,
             "message": message,
-            "timestamp": time.time(),
+            "timestamp": self.__states[state.state_id]["timestamp"],
             "added": len(unstaged_files["added"]),
             "removed": len(unstaged_files["removed"]),
             "modified": len(unstaged_files["modified"]),
-            "intact": len(unstaged_files["intact"])
+            "intact": len(unstaged_files["intact"]),
+            "moved": len(unstaged_files["moved"]),
+            "lock_wait": self.__lock.wait_time
         }
 
+    def __import_file(self, tar: tarfile.TarFile, info: tarfile.TarInfo, relative_path: str, index: int) -> tuple:
+        """
+        Stream a file from the archive to a temporary file in the store,
+        hashing it as FVSUtils.get_sha1_hash does (with the name too, if
+        the repository is not content addressed). Symlinks are created as
+        such, as the store keeps them. It returns the temporary file path
+        and the FVSFile.
+        """
+        file_name = os.path.basename(relative_path)
+        tmp_path = os.path.join(self.store.path, f"import-{os.getpid()}-{index}{self.__journal.tmp_suffix}")
+        self.__journal.track(tmp_path)
+
+        if info.issym():
+            os.symlink(info.linkname, tmp_path)
+            return tmp_path, FVSFile(self, file_name, FVSHasher.link_sha1(info.linkname), [relative_path])
+
+        sha1_temp = hashlib.sha1()
+        with tar.extractfile(info) as src, open(tmp_path, "wb") as dst:
+            FVSHasher.copy(src, dst, sha1_temp)
+        if self.__hash_mode == "name":
+            sha1_temp.update(file_name.encode())
+
+        os.chmod(tmp_path, info.mode & 0o7777)
+        os.utime(tmp_path, (info.mtime, info.mtime))
+        return tmp_path, FVSFile(self, file_name, sha1_temp.hexdigest(), [relative_path])
+
     def delete_state(self, state_id: int, update_repo: bool = True):
         """
-        Delete a state and all its subsequent states.
+        Delete a state and all its subsequent states. The first state is
+        never deleted, so there is always a prior state to fall back to.
         ...
         Raises:
-            FVSStateZeroNotDeletable: If the state_id is 0.
+            FVSStateZeroNotDeletable: If the state_id is 0 or the first
+            state.
             FVSStateNotFound: If the state doesn't exist.
         """
         if int(state_id) == 0:
             raise FVSStateZeroNotDeletable()
 
-        if int(state_id) not in self.__states:
-            raise FVSStateNotFound(state_id)
+        with self.__transaction():
+            if int(state_id) not in self.__states:
+                raise FVSStateNotFound(state_id)
+            if int(state_id) == self.__states.first:
+                raise FVSStateZeroNotDeletable()
 
+            """
+            Traveling in the future is probably something we don't want to do. So
+            we will break references for subsequent states too.
+            """
+            prior_state_id = self.__get_prior_state_id(state_id)
+            for _state_id in [state_id] + self.__get_subsequent_state_ids(state_id):
+                state = self.get_state(_state_id)
+                state.break_references()
+
+                """
+                If the state is the active state, we need to set the active state to
+                the previous one.
+                """
+                if self.__active_state_id == _state_id:
+                    self.__active_state = self.get_state(prior_state_id)
+
+                """
+                Delete the state from the states folder. It should be safer now as
+                we already unreferenced the state from all its files.
+                """
+                self.__delete_state_folder(state)
+                del self.__states[_state_id]
+                self.__state_cache.pop(_state_id, None)
+
+            if update_repo:
+                self.__update_repo()
+
+    def attach_store(self, store_path: str):
         """
-        Traveling in the future is probably something we don't want to do. So
-        we will break references for subsequent states too.
+        Move the repository objects to the given shared store. Objects
+        already in the store are not copied again, the others are linked
+        (or copied, if on a different file system). Local objects are
+        removed once the transaction is committed.
+        ...
+        Raises:
+            FVSStoreCompressionMismatch: if the store uses a different
+            compression setting.
+            FVSStoreHashModeMismatch: if the store uses a different hash
+            mode.
         """
-        for _state_id in [state_id] + self.__get_subsequent_state_ids(state_id):
-            state = FVSState(self, _state_id)
-            state.break_references()
+        with self.__transaction():
+            store = FVSStore(store_path, True, self.__use_compression, self.__hash_mode)
+            if store.path == self.store.path:
+                return
+
+            repo_id = self.__repo_conf.get("uuid") or FVSStore.new_repo_id()
+            files = FVSData(self).list_files()
+            store.acquire(files, repo_id, self.__journal)
+
+            for file in files:
+                src = self.store.get_object_path(file.file_name, file.sha1)
+                dest = store.get_object_path(file.file_name, file.sha1)
+                if not os.path.lexists(dest) and os.path.lexists(src):
+                    self.__journal.track(dest, keep=True)
+                    try:
+                        os.link(src, dest + self.__journal.tmp_suffix)
+                    except OSError:
+                        FVSUtils.copy_file(src, dest + self.__journal.tmp_suffix)
+                    os.replace(dest + self.__journal.tmp_suffix, dest)
+                self.store.release([file], repo_id, self.__journal)
+
+            self.__repo_conf["store"] = store.path
+            self.__repo_conf["uuid"] = repo_id
+            self.__store_path = store.path
+            self.__store = store
+            self.__update_repo()
+
+    def migrate_hashes(self) -> dict:
+        """
+        Migrate a repository created before content addressing, whose
+        files are hashed with their name, so identical files stored under
+        different names share a single object. Objects are hashed again
+        from their content and duplicates merged (see
+        FVSData.migrate_objects), then the manifests and trees of all the
+        states are rewritten with the new sha1s. Objects of repositories
+        using a shared store are moved to the private store, as the other
+        repositories of the shared store keep the old hashes, the
+        repository can be attached to a content addressed store later.
+        An interrupted commit is aborted first, see abort_commit. It
+        returns the number of objects before and after the migration.
+        """
+        with self.__transaction():
+            fvs_data = FVSData(self)
+            objects = len(fvs_data.list_files())
+            if self.__hash_mode == "content":
+                return {"objects": objects, "migrated": objects}
 
             """
-            If the state is the active state, we need to set the active state to
-            the previous one.
+            The checkpoint of an interrupted commit holds name hashes and
+            objects in the old layout, so the commit is aborted.
             """
-            if self.__active_state.state_id == _state_id:
-                self.__active_state = FVSState(self, self.__get_prior_state_id(_state_id))
+            checkpoint = FVSCheckpoint(self)
+            if checkpoint.exists:
+                self.__discard_checkpoint(checkpoint)
+
+            store = FVSStore(os.path.join(self.__repo_path, ".fvs/data"), hash_mode="content")
+            sha1s = fvs_data.migrate_objects(store)
 
             """
-            Delete the state from the states folder. It should be safer now as
-            we already unreferenced the state from all its files.
+            Files with the same content in a state are merged in the same
+            manifest entry by rebase. Trees keep their stat fingerprints,
+            so the next scan doesn't hash the whole working tree again.
             """
-            self.__delete_state_folder(state)
-            del self.__states[_state_id]
+            for state_id in self.__states.keys():
+                state = self.get_state(state_id)
+                tree = FVSTree.load(self, state_id)
+                unstaged_files = state.as_unstaged_files()
+                for key in state.keys:
+                    for _file in unstaged_files[key]:
+                        _file.sha1 = sha1s.get(_file.sha1, _file.sha1)
+                        if tree is not None:
+                            _file.stat = tree.get_stat(_file.relative_path)
+                state.rebase(unstaged_files)
+                if tree is not None:
+                    FVSTree.build(
+                        self,
+                        unstaged_files["added"] + unstaged_files["modified"] + unstaged_files["intact"]
+                        + unstaged_files["moved"]
+                    ).save(self, state.state_path)
+
+            self.__repo_conf["hash"] = self.__hash_mode = "content"
+            self.__repo_conf["store"] = self.__store_path = None
+            self.__store = store
+            self.__update_repo()
+
+        return {"objects": objects, "migrated": len(FVSData(self).list_files())}
 
-        if update_repo:
+    def set_io_order(self, io_order: str):
+        """
+        Set the order of the file reads and writes of commits, restores
+        and checkouts, stored in the repository configuration. Sorting them
+        by their position on disk reduces seeking on rotational disks, see
+        FVSScheduler for the supported orders.
+        ...
+        Raises:
+            FVSUnsupportedIOOrder: If the order is not supported.
+        """
+        scheduler = FVSScheduler(io_order)
+        with self.__transaction():
+            self.__repo_conf["io_order"] = scheduler.order
+            self.__scheduler = scheduler
             self.__update_repo()
 
+    def squash_states(self, state_a: int, state_b: int, message: str = None) -> list:
+        """
+        Squash the states from state_a to state_b (both included) into a
+        single state, which keeps the id, the tree and the timestamp of
+        state_b, but becomes relative to the state prior to state_a.
+        Objects referenced only by the squashed states are removed. The
+        message of state_b is kept if none is given. It returns the ids of
+        the removed states. The first state is never squashed, as it
+        can't be deleted, see delete_state.
+        ...
+        Raises:
+            FVSStateNotFound: If one of the states doesn't exist.
+            FVSInvalidStateRange: If the range has less than two states.
+            FVSStateZeroNotDeletable: If state_a is the first state.
+        """
+        state_a, state_b = int(state_a), int(state_b)
+        with self.__transaction():
+            for state_id in [state_a, state_b]:
+                if state_id not in self.__states:
+                    raise FVSStateNotFound(state_id)
+
+            state_ids = self.__states.range(state_a, state_b)
+            if len(state_ids) < 2:
+                raise FVSInvalidStateRange(state_a, state_b)
+            if state_a == self.__states.first:
+                raise FVSStateZeroNotDeletable()
+
+            fvs_data = FVSData(self)
+            self.__squash(state_ids, fvs_data, message)
+            fvs_data.complete_transaction()
+            self.__update_repo()
+
+        return state_ids[:-1]
+
+    def prune_states(self, keep_last: int = None, keep_daily: int = None, keep_weekly: int = None) -> list:
+        """
+        Apply a retention policy: keep the last keep_last states, the last
+        state of each of the last keep_daily days and keep_weekly weeks
+        (with states), plus the first, the newest and the active state, so
+        state 0 is never removed (see delete_state). Every run of
+        consecutive states not kept is squashed into the kept state
+        following it, see squash_states. All the squashes share a single
+        transaction and catalog update. It returns the ids of the removed
+        states.
+        """
+        with self.__transaction():
+            state_ids = self.__states.keys()
+            if not state_ids:
+                return []
+
+            keep = {state_ids[0], state_ids[-1]}
+            if self.__active_state_id is not None:
+                keep.add(self.__active_state_id)
+            if keep_last:
+                keep.update(state_ids[-keep_last:])
+
+            for count, period in [(keep_daily, "%Y-%m-%d"), (keep_weekly, "%G-W%V")]:
+                if not count:
+                    continue
+                periods = set()
+                for state_id in reversed(state_ids):
+                    _period = time.strftime(period, time.localtime(self.__states[state_id]["timestamp"]))
+                    if _period in periods:
+                        continue
+                    if len(periods) == count:
+                        break
+                    periods.add(_period)
+                    keep.add(state_id)
+
+            removed = []
+            fvs_data = FVSData(self)
+            run = []
+            for state_id in state_ids:
+                run.append(state_id)
+                if state_id in keep:
+                    if len(run) > 1:
+                        self.__squash(run, fvs_data)
+                        removed += run[:-1]
+                    run = []
+
+            if removed:
+                fvs_data.complete_transaction()
+                self.__update_repo()
+
+        return removed
+
+    def __squash(self, state_ids: list, fvs_data: FVSData, message: str = None):
+        """
+        Squash the given consecutive states into the last one, rebasing it
+        on the state prior to the first one. The catalog changes are only
+        collected in fvs_data, committing them is up to the caller.
+        """
+        state = self.get_state(state_ids[-1])
+        prior_state_id = self.__states.prior(state_ids[0])
+
+        prior_files = {}
+        if prior_state_id is not None:
+            prior_files = {_file.relative_path: _file for _file in self.get_state(prior_state_id).iter_files()}
+
+        unstaged_files = {"count": 0, "added": [], "removed": [], "modified": [], "intact": [], "moved": []}
+        for _file in state.iter_files():
+            _file.old_relative_path = None
+            orig = prior_files.pop(_file.relative_path, None)
+            if orig is None:
+                _file.status = "added"
+            elif orig.sha1 == _file.sha1:
+                _file.status = "intact"
+            else:
+                _file.status = "modified"
+            unstaged_files[_file.status].append(_file)
+
+        for _file in prior_files.values():
+            _file.status = "removed"
+            _file.old_relative_path = None
+            unstaged_files["removed"].append(_file)
+        unstaged_files["count"] = sum(len(unstaged_files[key]) for key in ["added", "modified", "removed"])
+        self.__detect_moves(unstaged_files)
+
+        files = [
+            FVSFile(self, _file.file_name, _file.sha1, [])
+            for state_id in state_ids
+            for key in ["added", "modified"]
+            for _file in self.get_state(state_id).files[key].values()
+        ]
+        new_files = [
+            FVSFile(self, _file.file_name, _file.sha1, [])
+            for _file in unstaged_files["added"] + unstaged_files["modified"]
+        ]
+        fvs_data.squash_references(state_ids, files, state.state_id, new_files)
+        state.rebase(unstaged_files)
+
+        for state_id in state_ids[:-1]:
+            self.__delete_state_folder(self.get_state(state_id))
+            del self.__states[state_id]
+            self.__state_cache.pop(state_id, None)
+
+        if self.__active_state_id in state_ids:
+            self.__active_state = state
+        if message:
+            self.__states[state.state_id]["message"] = message
+
     def delete_active_state(self):
         """
         Delete the active state.
         """
-        self.delete_state(self.__active_state.state_id)
+        self.delete_state(self.__active_state_id)
 
-    def restore_state(self, state_id: int, ignore: list = None):
+    def restore_state(self, state_id: int, ignore: list = None, paths: list = None):
         """
         Restore the state with the given id. This will remove all unstaged
         files and restore the given state, deleting any subsequent states.
+        If paths are given, only the matching files are restored, scanning
+        only their subtrees (see FVSPattern.match_path). This kind of restore
+        is not destructive: subsequent states and the active state are kept.
         ...
         Raises:
             FVSStateNotFound: If the state doesn't exist.
             FVSNothingToRestore: If there are no unstaged files.
         """
-        if int(state_id) not in self.__states.keys():
-            raise FVSStateNotFound(state_id)
+        state_id = int(state_id)
+        paths = self.__get_relative_paths(paths)
 
-        self.__active_state = FVSState(self, state_id)
-        subsequent_state_id = self.__get_subsequent_state_id(state_id)
-        unstaged_files = self.get_unstaged_files(ignore, purpose=1)
+        with self.__transaction():
+            if state_id not in self.__states:
+                raise FVSStateNotFound(state_id)
 
-        if unstaged_files["count"] == 0:
-            raise FVSNothingToRestore()
+            """
+            The changes are streamed, intact files (usually most of them)
+            are never collected as there is nothing to restore for them.
+            """
+            state = self.get_state(state_id)
+            unstaged_files = {"added": [], "removed": [], "modified": [], "moved": []}
+            for change in self.iter_changes(ignore, purpose=1, paths=paths, state=state):
+                unstaged_files[change.status].append(change)
 
-        """
-        If the given state has subsequent states, we need to delete them. The
-        following call will start breaking references for the first subsequent
-        state, FVSData will take care of the rest, physically deleting the
-        files when the reference count reaches 0 (no state references).
-        """
-        if subsequent_state_id is not None:
-            self.delete_state(subsequent_state_id, False)
+            if not any(unstaged_files.values()):
+                raise FVSNothingToRestore()
 
-        """
-        Here we restore the situation to the given state, removing all
-        unstaged files.
-        """
-        fvs_data = FVSData(self)
+            if paths is None:
+                self.__active_state = state
+                subsequent_state_id = self.__get_subsequent_state_id(state_id)
 
-        for file in unstaged_files["added"]:
-            _file_path = os.path.join(self.__repo_path, file["relative_path"])
-            if os.path.isdir(_file_path):
-                shutil.rmtree(_file_path)
-            else:
-                os.remove(_file_path)
+                """
+                If the given state has subsequent states, we need to delete them. The
+                following call will start breaking references for the first subsequent
+                state, FVSData will take care of the rest, physically deleting the
+                files when the reference count reaches 0 (no state references).
+                """
+                if subsequent_state_id is not None:
+                    self.delete_state(subsequent_state_id, False)
+
+            """
+            Modified and removed files are restored from the object store,
+            in the order of the objects on disk if an I/O order is set. The
+            list is built and sorted before touching the working tree, so a
+            failure leaves it as it was.
+            """
+            fvs_data = FVSData(self)
 
-        for file in unstaged_files["modified"]:
-            internal_path = fvs_data.get_int_path(file["file_name"])
-            FVSFile(self, file["file_name"], file["sha1"], [file["relative_path"]]).restore(internal_path)
+            def _get_path(restored: tuple) -> Union[str, None]:
+                return os.path.join(restored[1], restored[0].sha1) if restored[1] is not None else None
 
-        for file in unstaged_files["removed"]:
-            internal_path = fvs_data.get_file_location(file["sha1"])
-            FVSFile(self, file["file_name"], file["sha1"], [file["relative_path"]]).restore(internal_path)
+            restored = [
+                (file, fvs_data.get_int_path(file.file_name, file.sha1)) for file in unstaged_files["modified"]
+            ]
+            restored += [(file, fvs_data.get_file_location(file.sha1)) for file in unstaged_files["removed"]]
+            restored = self.__scheduler.sort(restored, _get_path)
 
-        self.__update_repo()
+            """
+            Here we restore the situation to the given state, removing all
+            unstaged files.
+            """
+            for file in unstaged_files["added"]:
+                _file_path = os.path.join(self.__repo_path, file.relative_path)
+                if os.path.isdir(_file_path):
+                    shutil.rmtree(_file_path)
+                else:
+                    os.remove(_file_path)
 
-    @staticmethod
-    def __delete_state_folder(state: FVSState):
+            """
+            Moved files are renamed back to their path in the state, no
+            data is read nor written.
+            """
+            for file in unstaged_files["moved"]:
+                _old_path = os.path.join(self.__repo_path, file.old_relative_path)
+                os.makedirs(os.path.dirname(_old_path), exist_ok=True)
+                os.rename(os.path.join(self.__repo_path, file.relative_path), _old_path)
+
+            for batch in self.__scheduler.iter_batches(restored, _get_path):
+                for file, internal_path in batch:
+                    FVSFile(self, file.file_name, file.sha1, [file.relative_path]).restore(internal_path)
+
+            if paths is None:
+                self.__update_repo()
+
+    def __delete_state_folder(self, state: FVSState):
+        """
+        Delete the state folder with the given id. The removal is deferred
+        by the journal until the transaction is committed.
+        """
+        self.__journal.remove(state.state_path)
+
+    def get_store_stats(self) -> dict:
+        """
+        Get the statistics of the objects referenced by the repository,
+        grouped by codec, see FVSData.get_stats. They show how much each
+        codec saves, to tune the FVSCodec thresholds.
         """
-        Delete the state folder with the given id.
+        with self.__snapshot():
+            return FVSData(self).get_stats()
+
+    def get_checkpoint_stats(self) -> Union[dict, None]:
+        """
+        Get the number and the stored size of the objects written by an
+        interrupted commit which no state references yet, None if no
+        commit was interrupted. They are not counted by get_store_stats
+        nor touched by prune_states, abort_commit releases them.
         """
-        shutil.rmtree(state.state_path)
+        with self.__snapshot():
+            checkpoint = FVSCheckpoint(self)
+            if not checkpoint.exists:
+                return None
+
+            fvs_data = FVSData(self)
+            stats = {"objects": 0, "stored": 0}
+            for file_name, sha1 in checkpoint.iter_objects():
+                object_path = self.store.get_object_path(file_name, sha1)
+                if fvs_data.get_file_location(sha1) is not None or not os.path.lexists(object_path):
+                    continue
+                stats["objects"] += 1
+                stats["stored"] += os.lstat(object_path).st_size
+            return stats
 
     def is_valid_state(self, state_id: int) -> bool:
         """
@@ -361,7 +1467,7 @@ class FVSRepo:
         if not os.path.exists(index_path):
             raise FVSMissingStateIndex(state_id)
 
-        with open(index_path, "r") as f:
+        with open(self.__journal.resolve(index_path), "rb") as f:
             index = orjson.loads(f.read())
 
         if not index:
@@ -369,21 +1475,18 @@ class FVSRepo:
 
         return True
 
-    def __get_prior_state_id(self, state_id: int) -> int:
+    def __get_prior_state_id(self, state_id: int) -> Union[int, None]:
         """
-        Get the id of the prior state.
+        Get the id of the prior state, None if the given state is the
+        first one.
         ...
         Raises:
             FVSStateNotFound: If the state with the given id does not exist.
         """
-        if int(state_id) not in self.__states.keys():
+        if int(state_id) not in self.__states:
             raise FVSStateNotFound(state_id)
 
-        for key in self.__states.keys():
-            if key < state_id:
-                return key
-
-        return 0
+        return self.__states.prior(int(state_id))
 
     def __get_subsequent_state_ids(self, state_id: int) -> list:
         """
@@ -392,31 +1495,23 @@ class FVSRepo:
         Raises:
             FVSStateNotFound: If the state with the given id does not exist.
         """
-        if int(state_id) not in self.__states.keys():
+        if int(state_id) not in self.__states:
             raise FVSStateNotFound(state_id)
 
-        subsequent_states = []
-        for key in self.__states.keys():
-            if key > int(state_id):
-                subsequent_states.append(key)
-
-        return subsequent_states
+        return self.__states.range(int(state_id) + 1)
 
-    def __get_subsequent_state_id(self, state_id: int) -> int:
+    def __get_subsequent_state_id(self, state_id: int) -> Union[int, None]:
         """
-        Get the id of the subsequent state.
+        Get the id of the subsequent state, None if the given state is
+        the last one.
         ...
         Raises:
             FVSStateNotFound: If the state with the given id does not exist.
         """
-        if int(state_id) not in self.__states.keys():
+        if int(state_id) not in self.__states:
             raise FVSStateNotFound(state_id)
 
-        for key in self.__states.keys():
-            if key > int(state_id):
-                return key
-
-        return 0
+        return self.__states.next(int(state_id))
 
     def __get_relative_path(self, path: str) -> str:
         """
@@ -425,6 +1520,15 @@ class FVSRepo:
         repo_root = os.path.dirname(self.__repo_path)
         return os.path.relpath(path, self.__repo_path)
 
+    def __get_relative_paths(self, paths: list = None) -> Union[list, None]:
+        """
+        Get the given paths relative to the repository, they may be given
+        as absolute paths.
+        """
+        if paths is None:
+            return None
+        return [os.path.relpath(path, self.__repo_path) if os.path.isabs(path) else path for path in paths]
+
     def get_state_path(self, state_id: int) -> str:
         """
         Get the path of the state with the given id.
@@ -436,12 +1540,12 @@ class FVSRepo:
         Update the repository configuration.
         """
         repo_conf = os.path.join(self.__repo_path, ".fvs/repo.json")
-        with open(repo_conf, "wb") as f:
-            self.__repo_conf["id"] = self.__active_state.state_id
-            self.__repo_conf["states"] = self.__states
-            f.write(orjson.dumps(self.__repo_conf, f, option=orjson.OPT_NON_STR_KEYS,))
+        if self.__active_state_id is not None:
+            self.__repo_conf["id"] = self.__active_state_id
+        self.__repo_conf["states"] = self.__states.as_dict()
+        self.__journal.write(repo_conf, orjson.dumps(self.__repo_conf, option=orjson.OPT_NON_STR_KEYS))
 
-        if self.__has_no_states:
+        if self.__has_no_states and self.__active_state_id is not None:
             self.__has_no_states = False
 
     def new_state_path_by_id(self, state_id: int) -> str:
@@ -455,6 +1559,7 @@ class FVSRepo:
         if os.path.exists(state_path):
             raise FVSStateAlreadyExists(state_id)
         os.makedirs(state_path)
+        self.__journal.track(state_path)
         return state_path
 
     @property
@@ -464,6 +1569,64 @@ class FVSRepo:
         """
         return self.__repo_path
 
+    @property
+    def store(self) -> FVSStore:
+        """
+        Get the object store of the repository, opened on first use.
+        """
+        if self.__store is None:
+            if self.__store_path:
+                self.__store = FVSStore(self.__store_path, True, self.__use_compression, self.__hash_mode)
+            else:
+                self.__store = FVSStore(os.path.join(self.__repo_path, ".fvs/data"), hash_mode=self.__hash_mode)
+        return self.__store
+
+    @property
+    def repo_id(self) -> str:
+        """
+        Get the unique id of the repository, used by shared stores.
+        """
+        return self.__repo_conf.get("uuid")
+
+    @property
+    def paths(self) -> FVSPathTable:
+        """
+        Get the interned path table of the repository, loaded on first use.
+        """
+        if self.__paths is None:
+            with self.__snapshot():
+                self.__paths = FVSPathTable(self)
+        return self.__paths
+
+    @property
+    def catalog(self) -> Union[dict, None]:
+        """
+        Get the data catalog cached by FVSData for this session, None if
+        it was not loaded yet. With the read lock held, as FVSData does, it
+        is dropped first if another process committed, see __refresh.
+        """
+        if self.__lock.is_held("read"):
+            self.__refresh()
+        return self.__catalog
+
+    @catalog.setter
+    def catalog(self, catalog: dict):
+        self.__catalog = catalog
+
+    @property
+    def lock(self) -> FVSLock:
+        """
+        Get the repository locks.
+        """
+        return self.__lock
+
+    @property
+    def journal(self) -> FVSJournal:
+        """
+        Get the repository journal.
+        """
+        return self.__journal
+
     @property
     def states_path(self) -> str:
         """
@@ -478,24 +1641,36 @@ class FVSRepo:
         """
         if self.__has_no_states:
             return 0
-        return list(self.__states)[-1] + 1
+        return self.__states.last + 1
 
     @property
     def active_state_id(self) -> int:
         """
         Get the active state.
         """
-        if self.__active_state is None:
-            return None
-        return self.__active_state.state_id
+        return self.__active_state_id
 
     @property
-    def states(self) -> dict:
+    def states(self) -> FVSHistory:
         """
-        Get the list of states.
+        Get the states, indexed by id, see FVSHistory.
         """
         return self.__states
     
+    @property
+    def checkpoint(self) -> Union[FVSCheckpoint, None]:
+        """
+        Get the checkpoint of the commit in progress, if any.
+        """
+        return self.__checkpoint
+
+    @property
+    def scheduler(self) -> FVSScheduler:
+        """
+        Get the I/O scheduler of the repository, see set_io_order.
+        """
+        return self.__scheduler
+
     @property
     def has_compression(self) -> bool:
         """
@@ -503,6 +1678,21 @@ class FVSRepo:
         """
         return self.__use_compression
 
+    @property
+    def hash_mode(self) -> str:
+        """
+        Get the hash mode: "content" for content addressed repositories,
+        "name" for older ones, see FVSUtils.get_sha1_hash.
+        """
+        return self.__hash_mode
+
+    @property
+    def lock_wait(self) -> float:
+        """
+        Get the time spent waiting for the repository locks, in seconds.
+        """
+        return self.__lock.wait_time
+
     @property
     def has_no_states(self) -> bool:
         """
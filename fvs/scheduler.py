@@ -0,0 +1,149 @@
+import os
+import fcntl
+import struct
+import logging
+from itertools import islice
+
+from fvs.hasher import FVSHasher
+from fvs.exceptions import FVSUnsupportedIOOrder
+
+logger = logging.getLogger("fvs.scheduler")
+
+
+class FVSScheduler:
+    """
+    Order batches of file reads and writes by their position on disk, to
+    reduce seeking on rotational disks and slow USB drives. Files are
+    processed in batches: each batch is sorted before being processed and
+    a readahead hint is issued for the files of the next one, so the disk
+    reads them while the current batch is hashed or copied. Only the
+    processing order changes, never the results.
+
+    Orders:
+        none:     no scheduling, files are processed as they come.
+        inode:    sort by inode number, which most file systems allocate
+                  close to the file data.
+        physical: sort by the physical offset of the first extent, asked
+                  with the FIEMAP ioctl, falling back to the inode for
+                  files or file systems without it.
+    """
+    orders: list = ["none", "inode", "physical"]
+    batch_size: int = 256
+    readahead_size: int = 2 ** 21
+    FS_IOC_FIEMAP: int = 0xC020660B
+    FIEMAP_EXTENT_UNKNOWN: int = 0x2
+    __fiemap_header: str = "=QQLLLL"
+    __fiemap_extent_size: int = 56
+
+    def __init__(self, order: str = None):
+        """
+        Initialize the FVSScheduler.
+        ...
+        Raises:
+            FVSUnsupportedIOOrder: If the order is not supported.
+        """
+        order = order or "none"
+        if order not in self.orders:
+            raise FVSUnsupportedIOOrder(order, self.orders)
+        self.__order = order
+
+    @classmethod
+    def get_physical_offset(cls, path: str):
+        """
+        Get the physical offset of the first extent of the given file, None
+        if it has no extent (e.g. empty), its location is not known yet
+        (delayed allocation) or FIEMAP is not available.
+        """
+        request = struct.pack(cls.__fiemap_header, 0, 2 ** 64 - 1, 0, 0, 1, 0)
+        request += bytes(cls.__fiemap_extent_size)
+        try:
+            fd = FVSHasher.open(path)
+        except OSError:
+            return None
+        try:
+            result = fcntl.ioctl(fd, cls.FS_IOC_FIEMAP, request)
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+        mapped_extents = struct.unpack_from("=L", result, 20)[0]
+        if mapped_extents == 0:
+            return None
+        physical, _, _, _, flags = struct.unpack_from("=QQQQL", result, struct.calcsize(cls.__fiemap_header) + 8)
+        if flags & cls.FIEMAP_EXTENT_UNKNOWN:
+            return None
+        return physical
+
+    def get_key(self, path: str) -> tuple:
+        """
+        Get the sort key of the given file. Files with a physical offset
+        come first, ordered by it, then the others by inode. Missing files
+        and items without a path (None, e.g. empty files having no
+        object) come last.
+        """
+        if path is None:
+            return 2, 0
+        if self.__order == "physical":
+            offset = self.get_physical_offset(path)
+            if offset is not None:
+                return 0, offset
+        try:
+            return 1, os.lstat(path).st_ino
+        except OSError:
+            return 2, 0
+
+    def sort(self, items: list, get_path) -> list:
+        """
+        Sort the given items by the position on disk of their path, as
+        returned by get_path, which may return None for items not read
+        from disk, see get_key. The items are returned as they are if the
+        scheduler is disabled.
+        """
+        if not self.enabled:
+            return items
+        return sorted(items, key=lambda item: self.get_key(get_path(item)))
+
+    def readahead(self, paths: list):
+        """
+        Hint the kernel to start reading the beginning of the given files.
+        """
+        for path in paths:
+            try:
+                fd = FVSHasher.open(path)
+            except OSError:
+                continue
+            try:
+                FVSHasher.advise(fd, "WILLNEED", 0, self.readahead_size)
+            finally:
+                os.close(fd)
+
+    def iter_batches(self, items, get_path):
+        """
+        Split the given items in batches, keeping their order, and issue a
+        readahead hint for the next batch before yielding each one. Items
+        for which get_path returns None are not read ahead. If the
+        scheduler is disabled, each item is its own batch so callers
+        keep streaming.
+        """
+        items = iter(items)
+        if not self.enabled:
+            for item in items:
+                yield [item]
+            return
+
+        batch = list(islice(items, self.batch_size))
+        self.readahead([path for path in map(get_path, batch) if path is not None])
+        while batch:
+            next_batch = list(islice(items, self.batch_size))
+            self.readahead([path for path in map(get_path, next_batch) if path is not None])
+            yield batch
+            batch = next_batch
+
+    @property
+    def order(self) -> str:
+        return self.__order
+
+    @property
+    def enabled(self) -> bool:
+        return self.__order != "none"
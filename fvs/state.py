@@ -6,19 +6,23 @@ from fvs.exceptions import FVSCallerWrongClass, FVSEmptyCommitMessage, FVSWrongU
     FVSStateNotFound, FVSCommittingToExistingState, FVSUnsupportedKey
 from fvs.data import FVSData
 from fvs.file import FVSFile
+from fvs.record import FVSEntry
+from fvs.change import FVSChange
 from fvs.utils import FVSUtils
 
 logger = logging.getLogger("fvs.state")
 
 
 class FVSState:
+    version: int = 3
+    keys: list = ["added", "modified", "removed", "intact", "moved"]
     __files: dict = None
     __state_id: int = None
     __state_path: str = None
 
     def __init__(self, repo: 'FVSRepo', state_id: int = None):
         self.__repo = repo
-        self.__files = {"count": 0, "added": {}, "modified": {}, "removed": {}, "intact": {}}
+        self.__files = {"count": 0, **{key: {} for key in self.keys}}
 
         if state_id is not None:
             self.__load_state(state_id)
@@ -40,22 +44,50 @@ class FVSState:
         if not os.path.exists(self.__state_path):
             raise FVSStateNotFound(state_id)
 
-        with open(os.path.join(self.__state_path, "files.json"), "r") as f:
-            self.__files = orjson.loads(f.read())
-        
+        with open(self.__repo.journal.resolve(os.path.join(self.__state_path, "files.json")), "rb") as f:
+            files = orjson.loads(f.read())
+
+        """
+        Manifests written before the path table was introduced (version 1,
+        with no version key) list full relative paths, which are interned
+        on load. Moved files are listed since version 3.
+        """
+        paths = self.__repo.paths
+        self.__files = {"count": files["count"]}
+        for key in self.keys:
+            if files.get("version", 1) >= 2:
+                self.__files[key] = {
+                    sha1: FVSEntry(paths.get_name(name_id), sha1, entry_paths)
+                    for sha1, (name_id, entry_paths) in files.get(key, {}).items()
+                }
+            else:
+                self.__files[key] = {
+                    sha1: FVSEntry(
+                        entry["file_name"], sha1,
+                        [_id for relative_path in entry["relative_paths"] for _id in paths.intern(relative_path)]
+                    )
+                    for sha1, entry in files.get(key, {}).items()
+                }
+
     def commit(
             self,
             message: str,
-            unstaged_files: dict
+            unstaged_files: dict,
+            state_id: int = None
     ):
         """
         States are supposed to be committed only from FVSRepo and only on first
         initialization. So here we will check if the caller is the expected
-        class.
+        class. The state_id is meant for states received from another
+        repository, which keep their original id.
         """
         if FVSUtils.get_caller_class_name() != "FVSRepo":
             raise FVSCallerWrongClass("FVSRepo")
 
+        if state_id is None:
+            state_id = self.__repo.next_state_id
+        self.__state_id = state_id
+
         """
         For the same reason above, we will check if the state were already
         initialized to avoid unwanted commits.
@@ -73,9 +105,11 @@ class FVSState:
         """
         To avoid further investigation and multiple checks, we will check
         for the unstaged files dict structure. It must contain the following
-        keys: added, modified, removed.
+        keys: count, added, modified, removed and intact. Values are not
+        checked for truthiness: a state with no change (count 0), e.g. a
+        squashed state received with a push, is valid.
         """
-        if False in [
+        if None in [
             unstaged_files.get("count"),
             unstaged_files.get("added"),
             unstaged_files.get("modified"),
@@ -85,61 +119,60 @@ class FVSState:
             raise FVSWrongUnstagedDict()
 
         """
-        Set the state id with the next state id available in the repository.
+        Instantiate the FVSData class and start collecting the files.
         """
-        self.__state_id = self.__repo.next_state_id
-        self.__files["count"] = unstaged_files["count"]
+        fvs_data = FVSData(self.__repo, self)
+        self.__set_files(unstaged_files, fvs_data)
+        fvs_data.complete_transaction()
+        self.__save_state()
 
+    def __set_files(self, unstaged_files: dict, fvs_data: FVSData = None):
         """
-        Instantiate the FVSData class and start collecting the files.
+        Build the state files from the given unstaged files. If fvs_data is
+        given, the added and modified files are referenced in the catalog.
+        Moved files are not: their content is already referenced by the
+        state which added it, like intact files, so moves only change the
+        manifest.
         """
-        fvs_data = FVSData(self.__repo, self)
+        self.__files = {"count": unstaged_files["count"], **{key: {} for key in self.keys}}
 
-        for _file in unstaged_files["added"]:
-            fvs_data.add_file(FVSFile(self.__repo, _file["file_name"], _file["sha1"], [_file["relative_path"]]))
-            if _file["sha1"] in self.__files["added"]:
-                self.__files["added"][_file["sha1"]]["relative_paths"] += [_file["relative_path"]]
+        paths = self.__repo.paths
+        for _file in unstaged_files.get("moved", []):
+            move = [*paths.intern(_file.relative_path), *paths.intern(_file.old_relative_path)]
+            if _file.sha1 in self.__files["moved"]:
+                self.__files["moved"][_file.sha1].paths.extend(move)
             else:
-                self.__files["added"][_file["sha1"]] = {
-                    "file_name": _file["file_name"],
-                    "sha1": _file["sha1"],
-                    "relative_paths": [_file["relative_path"]],
-                }
+                self.__files["moved"][_file.sha1] = FVSEntry(_file.file_name, _file.sha1, move)
 
-        for _file in unstaged_files["modified"]:
-            fvs_data.add_file(FVSFile(self.__repo, _file["file_name"], _file["sha1"], [_file["relative_path"]]))
-            if _file["sha1"] in self.__files["modified"]:
-                self.__files["modified"][_file["sha1"]]["relative_paths"] += [_file["relative_path"]]
-            else:
-                self.__files["modified"][_file["sha1"]] = {
-                    "file_name": _file["file_name"],
-                    "sha1": _file["sha1"],
-                    "relative_paths": [_file["relative_path"]],
-                }
+        for key in ["added", "modified", "removed", "intact"]:
+            entries = self.__files[key]
+            for _file in unstaged_files[key]:
+                if fvs_data is not None and key in ["added", "modified"]:
+                    fvs_data.add_file(FVSFile(self.__repo, _file.file_name, _file.sha1, [_file.relative_path]))
+                elif fvs_data is not None and key == "removed":
+                    fvs_data.delete_file(FVSFile(self.__repo, _file.file_name, _file.sha1, [_file.relative_path]))
 
-        for _file in unstaged_files["removed"]:
-            fvs_data.delete_file(FVSFile(self.__repo, _file["file_name"], _file["sha1"], [_file["relative_path"]]))
-            if _file["sha1"] in self.__files["removed"]:
-                self.__files["removed"][_file["sha1"]]["relative_paths"] += [_file["relative_path"]]
-            else:
-                self.__files["removed"][_file["sha1"]] = {
-                    "file_name": _file["file_name"],
-                    "sha1": _file["sha1"],
-                    "relative_paths": [_file["relative_path"]],
-                }
+                if _file.sha1 in entries:
+                    entries[_file.sha1].paths.extend(paths.intern(_file.relative_path))
+                else:
+                    entries[_file.sha1] = FVSEntry(_file.file_name, _file.sha1, list(paths.intern(_file.relative_path)))
 
-        for _file in unstaged_files["intact"]:
-            if _file["sha1"] in self.__files["intact"]:
-                self.__files["intact"][_file["sha1"]]["relative_paths"] += [_file["relative_path"]]
-            else:
-                self.__files["intact"][_file["sha1"]] = {
-                    "file_name": _file["file_name"],
-                    "sha1": _file["sha1"],
-                    "relative_paths": [_file["relative_path"]],
-                }
+    def rebase(self, unstaged_files: dict):
+        """
+        Replace the files of the state, keeping its id. This is meant for
+        squashing, where the state becomes relative to an older one while
+        its tree doesn't change. References in the catalog are up to the
+        caller (see FVSData.squash_references).
+        """
+        if FVSUtils.get_caller_class_name() != "FVSRepo":
+            raise FVSCallerWrongClass("FVSRepo")
 
-        fvs_data.complete_transaction()
-        self.__save_state()
+        self.__set_files(unstaged_files)
+        self.__repo.journal.write(
+            os.path.join(self.__state_path, "files.json"),
+            self.__dump_files()
+        )
+        self.__repo.paths.save()
 
     def break_references(self):
         """
@@ -152,44 +185,99 @@ class FVSState:
 
         fvs_data = FVSData(self.__repo, self)
 
-        for _file in self.__files["added"].values():
-            fvs_data.delete_file(FVSFile(self.__repo, _file["file_name"], _file["sha1"], _file["relative_paths"]))
-
-        for _file in self.__files["modified"].values():
-            fvs_data.delete_file(FVSFile(self.__repo, _file["file_name"], _file["sha1"], _file["relative_paths"]))
+        """
+        A reference was added for each path of the entries, so one is
+        dropped for each path too.
+        """
+        for key in ["added", "modified"]:
+            for _file in self.__files[key].values():
+                for _ in _file.iter_paths():
+                    fvs_data.delete_file(FVSFile(self.__repo, _file.file_name, _file.sha1, []))
 
         fvs_data.complete_transaction()
 
+    def iter_files(self, keys: tuple = ("added", "modified", "intact", "moved")):
+        """
+        This method will yield a FVSChange for each relative path of the
+        files listed under the given keys, with the key as status. The
+        default keys yield the whole tree of the state, moved files at
+        their new path.
+        """
+        paths = self.__repo.paths
+        for key in keys:
+            for _file in self.__files[key].values():
+                if key == "moved":
+                    for new_path, old_path in _file.iter_moves():
+                        yield FVSChange(
+                            key, _file.file_name, _file.sha1, paths.resolve(*new_path),
+                            old_relative_path=paths.resolve(*old_path)
+                        )
+                    continue
+                for dir_id, name_id in _file.iter_paths():
+                    yield FVSChange(key, _file.file_name, _file.sha1, paths.resolve(dir_id, name_id))
+
+    def sorted_files(self) -> list:
+        """
+        This method will return the whole tree of the state as a list of
+        (relative_path, sha1, file_name) tuples sorted by relative path.
+        """
+        return sorted(
+            (_file.relative_path, _file.sha1, _file.file_name)
+            for _file in self.iter_files()
+        )
+
+    def as_unstaged_files(self) -> dict:
+        """
+        This method will return the state files in the same format returned
+        by FVSRepo.get_unstaged_files, so the state can be committed again
+        (e.g. in another repository).
+        """
+        unstaged_files = {"count": self.__files["count"]}
+        for key in self.keys:
+            unstaged_files[key] = list(self.iter_files((key,)))
+        return unstaged_files
+
     def has_file(self, sha1: str, relative_path: str) -> bool:
         """
         This method will check if the state has the given file.
         """
-        if sha1 in self.__files["added"]:
-            if relative_path in self.__files["added"][sha1]["relative_paths"]:
-                return True
-        if sha1 in self.__files["modified"]:
-            if relative_path in self.__files["modified"][sha1]["relative_paths"]:
-                return True
-        if sha1 in self.__files["intact"]:
-            if relative_path in self.__files["intact"][sha1]["relative_paths"]:
+        path = self.__repo.paths.lookup(relative_path)
+        if path is None:
+            return False
+
+        for key in ["added", "modified", "intact"]:
+            if sha1 in self.__files[key] and self.__files[key][sha1].has_path(path):
                 return True
-                
-        return False
+
+        return sha1 in self.__files["moved"] and self.__files["moved"][sha1].has_new_path(path)
 
     def __save_state(self):
         """
         This method will save the state to the repository.
         """
         state_path = self.__repo.new_state_path_by_id(self.__state_id)
-        with open(os.path.join(state_path, "files.json"), "wb") as f:
-            f.write(orjson.dumps(self.__files, f, option=orjson.OPT_NON_STR_KEYS,))
+        self.__state_path = state_path
+        """
+        Entries are saved as [name id, paths], the file name is interned
+        too as it is usually the name of one of the paths.
+        """
+        self.__repo.journal.write(os.path.join(state_path, "files.json"), self.__dump_files())
+        self.__repo.paths.save()
+
+    def __dump_files(self) -> bytes:
+        paths = self.__repo.paths
+        return orjson.dumps(
+            {"version": self.version, **self.__files},
+            default=lambda entry: [paths.intern_name(entry.file_name), entry.paths],
+            option=orjson.OPT_NON_STR_KEYS
+        )
 
     def __is_initialized(self) -> bool:
         """
         This method will check if the state is initialized.
         """
         try:
-            self.__repo.is_valid_state(self.__repo.next_state_id)
+            self.__repo.is_valid_state(self.__state_id)
         except FVSStateNotFound:
             return False
         return True
@@ -198,25 +286,20 @@ class FVSState:
         """
         This method will return the entry from the state files which
         corresponds to the given file name. The 'any' key will check in
-        added, modified and intact files.
+        added, modified, intact and moved files.
         """
-        supported_keys = ["any", "added", "modified", "intact"]
+        supported_keys = ["any", "added", "modified", "intact", "moved"]
         if key not in supported_keys:
             raise FVSUnsupportedKey(supported_keys)
 
-        if key == "any":
-            for file in self.__files["added"].values():
-                if relative_path in file["relative_paths"]:
-                    return file
-            for file in self.__files["modified"].values():
-                if relative_path in file["relative_paths"]:
-                    return file
-            for file in self.__files["intact"].values():
-                if relative_path in file["relative_paths"]:
-                    return file
-        else:
+        path = self.__repo.paths.lookup(relative_path)
+        if path is None:
+            return None
+
+        keys = ["added", "modified", "intact", "moved"] if key == "any" else [key]
+        for key in keys:
             for _file in self.__files[key].values():
-                if relative_path in _file["relative_paths"]:
+                if _file.has_new_path(path) if key == "moved" else _file.has_path(path):
                     return _file
         return None
 
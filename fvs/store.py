@@ -0,0 +1,243 @@
+import os
+import uuid
+import orjson
+import logging
+import contextlib
+
+from fvs.exceptions import FVSStoreCompressionMismatch, FVSStoreHashModeMismatch
+from fvs.journal import FVSJournal
+from fvs.lock import FVSLock
+from fvs.utils import FVSUtils
+
+logger = logging.getLogger("fvs.store")
+
+
+class FVSStore:
+    """
+    The object store is where FVSData physically keeps the files, named
+    after their sha1 hash. By default, each repository has its own store
+    in .fvs/data, but a store can also be shared by many repositories: in
+    that case the store.json file keeps, for each object, the repositories
+    referencing it, so objects are deleted only when no repository needs
+    them anymore. Reference counting per state stays in each repository
+    catalog (FVSData).
+
+    Stores of content addressed repositories (see FVSUtils.get_sha1_hash)
+    place objects by the first digit of their sha1, as the same object may
+    be known under many names, older ones by the first letter of the file
+    name.
+    """
+    hash_modes: list = ["name", "content"]
+    int_paths: list = [
+        "a", "b", "c", "d", "e", "f", "g", "h", "i", "j", "k", "l", "m",
+        "n", "o", "p", "q", "r", "s", "t", "u", "v", "w", "x", "y", "z",
+        "0", "1", "2", "3", "4", "5", "6", "7", "8", "9", "-"
+    ]
+
+    def __init__(self, path: str, shared: bool = False, use_compression: bool = False, hash_mode: str = "name"):
+        """
+        Initialize the FVSStore.
+        ...
+        Raises:
+            FVSStoreCompressionMismatch: if a shared store was created with a
+            different compression setting.
+            FVSStoreHashModeMismatch: if a shared store was created with a
+            different hash mode.
+        """
+        self.__path = os.path.abspath(path)
+        self.__shared = shared
+        self.__use_compression = use_compression
+        self.__hash_mode = hash_mode
+        self.__conf_path = os.path.join(self.__path, "store.json")
+        self.__lock = FVSLock(self.__path) if shared else None
+        self.__update_store_path(use_compression)
+
+    def __update_store_path(self, use_compression: bool):
+        """
+        Create the store structure if missing. Shared stores also get
+        the store.json file, storing the compression setting and the hash
+        mode of the first repository attached, which must be the same for
+        all of them as objects are stored in the same format and place.
+        Stores created before content addressing use the "name" mode.
+        """
+        """
+        The internal paths are created together, the last one is checked
+        first to avoid a system call per path on every open.
+        """
+        if not os.path.isdir(os.path.join(self.__path, self.int_paths[-1])):
+            for int_path in self.int_paths:
+                os.makedirs(os.path.join(self.__path, int_path), exist_ok=True)
+
+        if not self.__shared:
+            return
+
+        with self.__lock.exclusive():
+            if not os.path.exists(self.__conf_path):
+                self.__save_config({"compression": use_compression, "hash": self.__hash_mode, "objects": {}})
+                return
+
+            store_conf = self.__load_config()
+            if store_conf["compression"] != use_compression:
+                raise FVSStoreCompressionMismatch(self.__path)
+            if store_conf.get("hash", "name") != self.__hash_mode:
+                raise FVSStoreHashModeMismatch(self.__path)
+
+    def __load_config(self) -> dict:
+        with open(self.__conf_path, "rb") as f:
+            return orjson.loads(f.read())
+
+    def __save_config(self, store_conf: dict):
+        """
+        The store configuration is shared by repositories with different
+        journals, so it is always replaced atomically, right away.
+        """
+        with open(self.__conf_path + FVSJournal.tmp_suffix, "wb") as f:
+            f.write(orjson.dumps(store_conf))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.__conf_path + FVSJournal.tmp_suffix, self.__conf_path)
+
+    def get_int_path(self, file_name: str, sha1: str) -> str:
+        """
+        This simple method determines the internal path of a file based
+        on the first letter of the file name. Every file starting with
+        a special character will be placed in the "-" directory. Content
+        addressed stores use the first digit of the sha1 instead.
+        """
+        if self.__hash_mode == "content":
+            return os.path.join(self.__path, sha1[0])
+
+        first_letter = file_name[0].lower()
+        int_path = "-"
+        if first_letter in self.int_paths:
+            int_path = first_letter
+
+        return os.path.join(self.__path, int_path)
+
+    def get_object_path(self, file_name: str, sha1: str) -> str:
+        """
+        Get the full path of the object for the given file.
+        """
+        return os.path.join(self.get_int_path(file_name, sha1), sha1)
+
+    def write_object(self, file_name: str, sha1: str, fileobj, journal: FVSJournal) -> bool:
+        """
+        Write an object reading its content from the given file object, as
+        stored (i.e. already compressed if the store uses compression). It
+        returns False if the object was already in the store.
+        """
+        dest = self.get_object_path(file_name, sha1)
+        if os.path.lexists(dest):
+            return False
+
+        journal.track(dest, keep=self.__shared)
+        with open(dest + journal.tmp_suffix, "wb") as f:
+            FVSUtils.copy_fileobj(fileobj, f)
+        os.replace(dest + journal.tmp_suffix, dest)
+        return True
+
+    def acquire(self, files: list, repo_id: str, journal: FVSJournal = None, keep=None):
+        """
+        Reference the given FVSFile objects for the repository. This must
+        happen before the objects are written, so that no other repository
+        can delete them in the meantime. For private stores this is a
+        no-op, FVSData references are enough.
+
+        References are saved right away, if a journal is given the new
+        ones are dropped again if the transaction is rolled back (see
+        FVSJournal.on_rollback and undo_acquire), except those of the
+        objects for which keep returns True, e.g. the objects of a
+        checkpointed commit.
+        """
+        if not self.__shared or not files:
+            return
+
+        acquired = []
+        with self.__lock.exclusive():
+            store_conf = self.__load_config()
+            for file in files:
+                entry = store_conf["objects"].setdefault(
+                    file.sha1, {"file_name": file.file_name, "repos": {}})
+                if repo_id not in entry["repos"]:
+                    acquired.append(file.sha1)
+                entry["repos"][repo_id] = 1
+            self.__save_config(store_conf)
+
+        if journal is None or not acquired:
+            return
+
+        def _undo():
+            self.unreference([sha1 for sha1 in acquired if keep is None or not keep(sha1)], repo_id)
+
+        journal.on_rollback(_undo, {
+            "op": "acquire", "store": self.__path, "compression": self.__use_compression,
+            "hash": self.__hash_mode, "repo": repo_id, "sha1s": acquired
+        })
+
+    @classmethod
+    def undo_acquire(cls, record: dict):
+        """
+        Drop the references taken by a transaction interrupted by a crash,
+        from the record given to FVSJournal.on_rollback by acquire.
+        """
+        store = cls(record["store"], True, record["compression"], record["hash"])
+        store.unreference(record["sha1s"], record["repo"])
+
+    def unreference(self, sha1s: list, repo_id: str):
+        """
+        Drop the references of the repository to the given objects right
+        away, deleting the ones no longer referenced. See release.
+        """
+        if not sha1s:
+            return
+
+        with self.__lock.exclusive():
+            store_conf = self.__load_config()
+            for sha1 in sha1s:
+                entry = store_conf["objects"].get(sha1)
+                if entry is None:
+                    continue
+                entry["repos"].pop(repo_id, None)
+                if len(entry["repos"]) == 0:
+                    logger.debug(f"{entry['file_name']} is not referenced by any repository. Removing.")
+                    del store_conf["objects"][sha1]
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(self.get_object_path(entry["file_name"], sha1))
+            self.__save_config(store_conf)
+
+    def release(self, files: list, repo_id: str, journal: FVSJournal):
+        """
+        Unreference the given FVSFile objects for the repository, deleting
+        the ones no longer referenced. Private stores delete them through
+        the journal, on commit. Shared stores update the references once
+        the repository transaction is committed, so a rolled back
+        transaction never drops references it still needs.
+        """
+        if not files:
+            return
+
+        if not self.__shared:
+            for file in files:
+                journal.remove(self.get_object_path(file.file_name, file.sha1))
+            return
+
+        journal.on_commit(lambda: self.unreference([file.sha1 for file in files], repo_id))
+
+    @staticmethod
+    def new_repo_id() -> str:
+        """
+        Generate a new id for a repository attaching to a store.
+        """
+        return uuid.uuid4().hex
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def is_shared(self) -> bool:
+        return self.__shared
+
+    @property
+    def hash_mode(self) -> str:
+        return self.__hash_mode
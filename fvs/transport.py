@@ -0,0 +1,105 @@
+import os
+import abc
+import logging
+
+from fvs.exceptions import FVSNotARepository
+
+logger = logging.getLogger("fvs.transport")
+
+
+class FVSTransport(abc.ABC):
+    """
+    Base class of the transports used to exchange states with another
+    repository. A transport exposes the read-only primitives needed by
+    FVSRepo.receive (info, manifests and objects) plus send, which asks
+    the other side to receive from a local repository. New transports
+    (e.g. over an SSH pipe) must implement these abstract methods, they
+    can't be instantiated otherwise.
+
+    Transports are context managers, the other repository is expected to
+    stay consistent while the context is active.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+    @abc.abstractmethod
+    def get_info(self) -> dict:
+        """
+        Get the repository info: compression, hash mode, active state id
+        and the states dict (state id: message and timestamp).
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def get_manifest(self, state_id: int) -> dict:
+        """
+        Get the files of the given state, in the format returned by
+        FVSState.as_unstaged_files. Manifests are exchanged with full
+        relative paths, as path table ids are local to each repository.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def open_object(self, file_name: str, sha1: str):
+        """
+        Open an object for reading, as stored in the repository.
+        """
+        raise NotImplementedError()
+
+    @abc.abstractmethod
+    def send(self, repo: 'FVSRepo', workers: int = 8) -> list:
+        """
+        Make the other repository receive the states it lacks from the
+        given one. It returns the list of sent state ids.
+        """
+        raise NotImplementedError()
+
+
+class FVSLocalTransport(FVSTransport):
+    """
+    Transport for a repository on a local path, e.g. a backup disk. The
+    repository is created on send if it doesn't exist yet, reading from a
+    path which is not a repository raises FVSNotARepository.
+    """
+    __repo: 'FVSRepo' = None
+
+    def __init__(self, path: str):
+        self.__path = path
+
+    def __get_repo(self, use_compression: bool = False, hash_mode: str = "content", create: bool = False) -> 'FVSRepo':
+        from fvs.repo import FVSRepo
+        if self.__repo is None:
+            if not create and not os.path.exists(os.path.join(self.__path, ".fvs/repo.json")):
+                raise FVSNotARepository(self.__path)
+            self.__repo = FVSRepo(self.__path, use_compression, no_init=not create, hash_mode=hash_mode)
+        return self.__repo
+
+    def __enter__(self):
+        self.__get_repo().lock.acquire("read", False)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.__repo.lock.release("read")
+        return False
+
+    def get_info(self) -> dict:
+        repo = self.__get_repo()
+        return {
+            "compression": repo.has_compression,
+            "hash": repo.hash_mode,
+            "active": repo.active_state_id,
+            "states": repo.states.as_dict()
+        }
+
+    def get_manifest(self, state_id: int) -> dict:
+        return self.__get_repo().get_state(state_id).as_unstaged_files()
+
+    def open_object(self, file_name: str, sha1: str):
+        return open(self.__get_repo().store.get_object_path(file_name, sha1), "rb")
+
+    def send(self, repo: 'FVSRepo', workers: int = 8) -> list:
+        return self.__get_repo(repo.has_compression, repo.hash_mode, create=True).receive(FVSLocalTransport(repo.repo_path), workers)
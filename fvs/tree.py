@@ -0,0 +1,233 @@
+import os
+import orjson
+import hashlib
+import logging
+
+logger = logging.getLogger("fvs.tree")
+
+
+class FVSTree:
+    """
+    The tree of a state, stored in the tree.json file next to the manifest.
+    It is a Merkle tree of the state directories: each directory has a hash
+    computed from the names and hashes of its files and subdirectories, so
+    two states having the same hash for a directory have the same whole
+    subtree. The tree also keeps the stat fingerprint of the files at
+    commit time, used to skip hashing files which didn't change since.
+
+    Directories and files are identified by their ids in the repository
+    FVSPathTable, and the directory listings are not stored: they are the
+    manifest of the state, read again only to compare trees, see
+    changed_files. Fingerprints store the ctime as an offset from the
+    mtime, which is usually small.
+
+    Format:
+        {
+            "version": 2,
+            "dirs": {"<dir id>": "<sha1>", ...},
+            "stats": [dir_id, name_id, size, mtime_ns, ctime_ns - mtime_ns, ino, ...]
+        }
+    The root directory has id 0, see FVSPathTable.root.
+
+    Trees of version 1 stored the listings and the fingerprints by relative
+    path, they are still loaded.
+    """
+    version: int = 2
+    stat_size: int = 6
+    racy_window: int = 2 * 10 ** 9
+    __repo: 'FVSRepo' = None
+    __state_id: int = None
+    __hashes: dict = None
+    __stats: dict = None
+    __listing: dict = None
+
+    def __init__(self, repo: 'FVSRepo', hashes: dict = None, stats: dict = None, state_id: int = None):
+        self.__repo = repo
+        self.__hashes = hashes or {}
+        self.__stats = stats or {}
+        self.__state_id = state_id
+
+    @classmethod
+    def load(cls, repo: 'FVSRepo', state_id: int) -> 'FVSTree':
+        """
+        Load the tree of the given state. It returns None for states
+        committed before trees were introduced.
+        """
+        tree_path = repo.journal.resolve(os.path.join(repo.get_state_path(state_id), "tree.json"))
+        if not os.path.exists(tree_path):
+            return None
+
+        with open(tree_path, "rb") as f:
+            tree = orjson.loads(f.read())
+        if tree.get("version") == 1:
+            return cls.__load_v1(repo, tree, state_id)
+        if tree.get("version") != cls.version:
+            logger.debug(f"Unsupported tree version for state {state_id}, ignoring it.")
+            return None
+
+        stats = {}
+        flat = tree["stats"]
+        for i in range(0, len(flat), cls.stat_size):
+            dir_id, name_id, size, mtime, ctime, ino = flat[i:i + cls.stat_size]
+            stats[dir_id, name_id] = (size, mtime, mtime + ctime, ino)
+        return cls(repo, {int(dir_id): sha1 for dir_id, sha1 in tree["dirs"].items()}, stats, state_id)
+
+    @classmethod
+    def __load_v1(cls, repo: 'FVSRepo', tree: dict, state_id: int) -> 'FVSTree':
+        paths = repo.paths
+        hashes = {}
+        for _dir, entry in tree["dirs"].items():
+            dir_id = paths.lookup_dir(_dir)
+            if dir_id is not None:
+                hashes[dir_id] = entry["hash"]
+        stats = {}
+        for relative_path, stat in tree["stats"].items():
+            path = paths.lookup(relative_path)
+            if path is not None:
+                stats[path] = tuple(stat)
+        return cls(repo, hashes, stats, state_id)
+
+    @classmethod
+    def build(cls, repo: 'FVSRepo', files: list) -> 'FVSTree':
+        """
+        Build the tree from the given FVSChange entries, as returned by
+        FVSRepo.get_unstaged_files. Entries with a stat also record their
+        fingerprint.
+        """
+        paths = repo.paths
+        dirs = {"": {"dirs": [], "files": {}}}
+        stats = {}
+        for _file in files:
+            relative_path = _file.relative_path
+            parent, name = os.path.split(relative_path)
+            cls.__add_dir(dirs, parent)
+            dirs[parent]["files"][name] = _file.sha1
+            if _file.stat is not None:
+                stats[paths.intern(relative_path)] = tuple(_file.stat)
+
+        """
+        Hash the directories bottom-up: sorting by depth, deepest first,
+        subdirectories are always hashed before their parent.
+        """
+        for _dir in sorted(dirs, key=lambda d: d.count(os.sep) + (d != ""), reverse=True):
+            entry = dirs[_dir]
+            entry["dirs"].sort()
+            sha1_temp = hashlib.sha1()
+            for name in entry["dirs"]:
+                sha1_temp.update(f"d\0{name}\0{dirs[os.path.join(_dir, name)]['hash']}\n".encode())
+            for name in sorted(entry["files"]):
+                sha1_temp.update(f"f\0{name}\0{entry['files'][name]}\n".encode())
+            entry["hash"] = sha1_temp.hexdigest()
+
+        return cls(repo, {paths.intern_dir(_dir): entry["hash"] for _dir, entry in dirs.items()}, stats)
+
+    @staticmethod
+    def __add_dir(dirs: dict, _dir: str):
+        if _dir in dirs:
+            return
+        parent, name = os.path.split(_dir)
+        FVSTree.__add_dir(dirs, parent)
+        dirs[parent]["dirs"].append(name)
+        dirs[_dir] = {"dirs": [], "files": {}}
+
+    def save(self, repo: 'FVSRepo', state_path: str):
+        """
+        Save the tree in the given state directory, through the journal,
+        with the path table if the tree interned new paths.
+        """
+        stats = []
+        for (dir_id, name_id), (size, mtime, ctime, ino) in self.__stats.items():
+            stats += [dir_id, name_id, size, mtime, ctime - mtime, ino]
+        repo.paths.save()
+        repo.journal.write(
+            os.path.join(state_path, "tree.json"),
+            orjson.dumps(
+                {"version": self.version, "dirs": self.__hashes, "stats": stats},
+                option=orjson.OPT_NON_STR_KEYS
+            )
+        )
+
+    @classmethod
+    def fingerprint(cls, stat: os.stat_result, now: int) -> tuple:
+        """
+        Get the fingerprint of a file from its stat. Files changed too
+        close to the given time (in ns) get no fingerprint: another change
+        in the same timestamp tick would not be noticed.
+        """
+        if stat.st_ctime_ns >= now - cls.racy_window:
+            return None
+        return stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino
+
+    def get_stat(self, relative_path: str) -> tuple:
+        """
+        Get the fingerprint recorded for the given file, if any.
+        """
+        path = self.__repo.paths.lookup(relative_path)
+        return self.__stats.get(path) if path is not None else None
+
+    def get_hash(self, _dir: str = "") -> str:
+        """
+        Get the hash of the given directory, None if the tree has no such
+        directory.
+        """
+        dir_id = self.__repo.paths.lookup_dir(_dir)
+        return self.__hashes.get(dir_id) if dir_id is not None else None
+
+    def __get_listing(self) -> dict:
+        """
+        Get the files and subdirectories of each directory, by id. They
+        are read from the manifest of the state, as (name id, sha1) pairs
+        for files.
+        """
+        if self.__listing is not None:
+            return self.__listing
+
+        paths = self.__repo.paths
+        listing = {dir_id: ([], []) for dir_id in self.__hashes}
+        for dir_id in self.__hashes:
+            if dir_id != paths.root:
+                listing[paths.get_parent(dir_id)][0].append(dir_id)
+
+        files = self.__repo.get_state(self.__state_id).files
+        for key in ["added", "modified", "intact", "moved"]:
+            for entry in files[key].values():
+                if key == "moved":
+                    _paths = [new_path for new_path, _ in entry.iter_moves()]
+                else:
+                    _paths = entry.iter_paths()
+                for dir_id, name_id in _paths:
+                    listing.setdefault(dir_id, ([], []))[1].append((name_id, entry.sha1))
+
+        self.__listing = listing
+        return listing
+
+    def changed_files(self, other: 'FVSTree') -> tuple:
+        """
+        Compare this tree with another one, descending only in directories
+        with a different hash. It returns the files of the changed
+        directories in both trees as two lists of (relative_path, sha1,
+        file_name) tuples, so only the paths of the changed directories
+        are resolved and compared. Both trees must have been loaded.
+        """
+        paths = self.__repo.paths
+        listing_a, listing_b = self.__get_listing(), other.__get_listing()
+        files_a, files_b = [], []
+        pending = [paths.root]
+        while pending:
+            dir_id = pending.pop()
+            hash_a = self.__hashes.get(dir_id)
+            hash_b = other.__hashes.get(dir_id)
+            if hash_a is not None and hash_a == hash_b:
+                continue
+
+            subdirs = set()
+            for listing, files in [(listing_a, files_a), (listing_b, files_b)]:
+                entry = listing.get(dir_id)
+                if entry is None:
+                    continue
+                subdirs.update(entry[0])
+                for name_id, sha1 in entry[1]:
+                    files.append((paths.resolve(dir_id, name_id), sha1, paths.get_name(name_id)))
+            pending.extend(subdirs)
+
+        return files_a, files_b
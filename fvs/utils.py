@@ -1,10 +1,19 @@
 import os
+import stat
+import fcntl
+import shutil
 import inspect
-import hashlib
 from typing import Union
 
+from fvs.hasher import FVSHasher
+
 
 class FVSUtils:
+    FICLONE: int = 0x40049409
+    patch_min_size: int = 2 ** 24
+    patch_block_size: int = 2 ** 17
+    patch_min_blocks: int = 32
+    patch_max_changed: float = 0.5
 
     @staticmethod
     def get_caller_class_name() -> str:
@@ -16,21 +25,169 @@ class FVSUtils:
         return caller
 
     @staticmethod
-    def get_sha1_hash(path: str, block_size: int = 2 ** 20) -> Union[str, None]:
+    def get_sha1_hash(path: str, block_size: int = None, hash_mode: str = "content") -> Union[str, None]:
+        """
+        Get the sha1 hash of the given file. The content alone is hashed
+        by default, symlinks are hashed from their target path, see
+        FVSHasher. Repositories created before content addressing use the
+        "name" mode, hashing name+content. The block size adapts to the
+        file size when not given, see FVSHasher for details.
+        """
+        if hash_mode == "name":
+            file_name = os.path.basename(path)
+            return FVSHasher.sha1(path, suffix=file_name.encode(), block_size=block_size)
+
+        if os.path.islink(path):
+            """
+            Broken symlinks are skipped, as they were with name+content.
+            """
+            if not os.path.exists(path):
+                return None
+            return FVSHasher.link_sha1(os.readlink(path))
+        return FVSHasher.sha1(path, block_size=block_size)
+
+    @staticmethod
+    def reflink(src: str, dst: str) -> bool:
+        """
+        Clone the src file to dst sharing its data blocks (copy-on-write),
+        as cp --reflink does. It returns False if the file system doesn't
+        support it, leaving no dst file behind.
+        """
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            try:
+                fcntl.ioctl(f_dst.fileno(), FVSUtils.FICLONE, f_src.fileno())
+            except OSError:
+                cloned = False
+            else:
+                cloned = True
+
+        if not cloned:
+            os.remove(dst)
+            return False
+
+        shutil.copystat(src, dst)
+        return True
+
+    @staticmethod
+    def copy_file(src: str, dst: str):
+        """
+        Copy src to dst as shutil.copy2 does, symlinks are copied as such,
+        but keeping the holes of sparse files: only their data extents are
+        read and written, so the copy takes as much space and I/O as the
+        allocated data.
+        """
+        _stat = os.lstat(src)
+        if not stat.S_ISREG(_stat.st_mode) or not FVSHasher.is_sparse(_stat):
+            shutil.copy2(src, dst, follow_symlinks=False)
+            return
+
+        with open(src, "rb") as f_src, open(dst, "wb") as f_dst:
+            FVSUtils.copy_fileobj(f_src, f_dst)
+        shutil.copystat(src, dst)
+
+    @staticmethod
+    def copy_fileobj(src, dst):
         """
-        Get the sha1 hash of the given file. It will use name+content
-        to avoid empty files.
+        Copy the src file object to dst, as shutil.copyfileobj does. If src
+        is a sparse file, only its data extents are copied and the holes
+        are recreated in dst, which must be seekable.
         """
-        sha1_temp = hashlib.sha1()
-        file_name = os.path.basename(path)
         try:
-            with open(path, "rb") as f:
-                while True:
-                    buffer = f.read(block_size)
-                    if not buffer:
-                        break
-                    sha1_temp.update(buffer)
-            sha1_temp.update(file_name.encode())
-            return sha1_temp.hexdigest()
-        except (FileNotFoundError, PermissionError, IsADirectoryError):
-            return None
+            fd = src.fileno()
+            _stat = os.fstat(fd)
+        except (AttributeError, OSError):
+            _stat = None
+
+        if _stat is not None and stat.S_ISREG(_stat.st_mode) and FVSHasher.is_sparse(_stat):
+            extents = FVSHasher.get_extents(fd, _stat.st_size)
+            if extents is not None:
+                FVSUtils.write_extents(src, dst, _stat.st_size, extents)
+                return
+
+        shutil.copyfileobj(src, dst)
+
+    @staticmethod
+    def write_extents(src, dst, size: int, extents: list):
+        """
+        Copy only the given (offset, length) extents of the src file object
+        to dst, seeking over the holes, then set the dst size. Holes are
+        skipped in src too, seeking forward, so src can be a stream which
+        can only seek by reading (e.g. a compressed tar member).
+        """
+        buffer = FVSHasher.get_buffer(FVSHasher.max_block_size)
+        for offset, length in extents:
+            src.seek(offset)
+            dst.seek(offset)
+            while length > 0:
+                read = src.readinto(buffer[:min(length, len(buffer))])
+                if not read:
+                    break
+                dst.write(buffer[:read])
+                length -= read
+        dst.truncate(size)
+
+    @staticmethod
+    def can_patch(path: str, size: int) -> bool:
+        """
+        Check if the given file can be patched in place to become a file
+        of the given size, see patch_fileobj. Only large regular files,
+        without holes, are worth it.
+        """
+        try:
+            _stat = os.lstat(path)
+        except OSError:
+            return False
+        return stat.S_ISREG(_stat.st_mode) and not FVSHasher.is_sparse(_stat) \
+            and min(_stat.st_size, size) >= FVSUtils.patch_min_size
+
+    @staticmethod
+    def patch_fileobj(src, dst, size: int) -> int:
+        """
+        Make the dst file object, opened for reading and writing, match the
+        src one, of the given size, rewriting in place only the blocks
+        which differ, so the writes are proportional to the difference.
+        Once most of the compared blocks differ (after patch_min_blocks),
+        the rest is copied without comparing, as a full copy would do. It
+        returns the number of bytes written.
+        """
+        block_size = FVSUtils.patch_block_size
+        buffer = FVSHasher.get_buffer(block_size * 2)
+        src_block, dst_block = buffer[:block_size], buffer[block_size:]
+        offset = written = compared = changed = 0
+        comparing = True
+        while offset < size:
+            read = FVSUtils.__read_block(src, src_block)
+            if not read:
+                break
+
+            if comparing:
+                compared += 1
+                dst.seek(offset)
+                if FVSUtils.__read_block(dst, dst_block[:read]) == read and dst_block[:read] == src_block[:read]:
+                    offset += read
+                    continue
+                changed += 1
+                if compared >= FVSUtils.patch_min_blocks and changed > compared * FVSUtils.patch_max_changed:
+                    comparing = False
+
+            dst.seek(offset)
+            dst.write(src_block[:read])
+            written += read
+            offset += read
+
+        dst.truncate(offset)
+        return written
+
+    @staticmethod
+    def __read_block(f, block: memoryview) -> int:
+        """
+        Fill the given block reading from f, stopping only at the end of
+        the file. It returns the number of bytes read.
+        """
+        read = 0
+        while read < len(block):
+            _read = f.readinto(block[read:])
+            if not _read:
+                break
+            read += _read
+        return read
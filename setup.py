@@ -17,5 +17,8 @@ setup(
     },
     install_requires=[
         'orjson'
-    ]
+    ],
+    extras_require={
+        'zstd': ['zstandard']
+    }
 )
@@ -0,0 +1,50 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from fvs.repo import FVSRepo
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.other_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+        shutil.rmtree(self.other_path)
+
+    def check_symlink_round_trip(self, use_compression: bool):
+        repo = FVSRepo(self.repo_path, use_compression)
+        with open(os.path.join(self.repo_path, "target"), "wb") as f:
+            f.write(b"target")
+        os.symlink("target", os.path.join(self.repo_path, "link"))
+        repo.commit("initial")
+
+        archive = io.BytesIO()
+        repo.export_state(0, archive, "tar")
+        archive.seek(0)
+
+        other = FVSRepo(self.other_path, use_compression)
+        res = other.import_state(io.BufferedReader(archive), "imported")
+        self.assertEqual(res["added"], 2)
+        self.assertEqual(
+            {_file.relative_path: _file.sha1 for _file in other.get_state(0).iter_files()},
+            {_file.relative_path: _file.sha1 for _file in repo.get_state(0).iter_files()}
+        )
+
+        other.restore_state(0)
+        self.assertEqual(os.readlink(os.path.join(self.other_path, "link")), "target")
+
+    def test_symlink_round_trip(self):
+        self.check_symlink_round_trip(False)
+
+    def test_symlink_round_trip_compressed(self):
+        self.check_symlink_round_trip(True)
+
+
+if __name__ == "__main__":
+    unittest.main()
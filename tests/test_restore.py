@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fvs.repo import FVSRepo
+
+
+class TestRestore(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.repo = FVSRepo(self.repo_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+
+    def write(self, relative_path: str, content: bytes):
+        with open(os.path.join(self.repo_path, relative_path), "wb") as f:
+            f.write(content)
+
+    def test_restore_removed_empty_file_with_io_order(self):
+        self.write("empty", b"")
+        self.write("data", b"data")
+        self.repo.commit("initial")
+        self.repo.set_io_order("inode")
+
+        os.remove(os.path.join(self.repo_path, "empty"))
+        self.write("added", b"added")
+        self.repo.restore_state(0)
+
+        self.assertEqual(os.path.getsize(os.path.join(self.repo_path, "empty")), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.repo_path, "added")))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from fvs.repo import FVSRepo
+from fvs.transport import FVSLocalTransport
+
+
+class TestSquash(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_path = tempfile.mkdtemp()
+        self.remote_path = tempfile.mkdtemp()
+        self.repo = FVSRepo(self.repo_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_path)
+        shutil.rmtree(self.remote_path)
+
+    def write(self, relative_path: str, content: bytes):
+        with open(os.path.join(self.repo_path, relative_path), "wb") as f:
+            f.write(content)
+
+    def test_push_squashed_state_without_changes(self):
+        self.write("keep", b"keep")
+        self.repo.commit("initial")
+        self.write("tmp", b"tmp")
+        self.repo.commit("add tmp")
+        os.remove(os.path.join(self.repo_path, "tmp"))
+        self.repo.commit("remove tmp")
+
+        self.assertEqual(self.repo.squash_states(1, 2), [1])
+        self.assertEqual(self.repo.get_state(2).files["count"], 0)
+
+        self.assertEqual(self.repo.push(FVSLocalTransport(self.remote_path)), [0, 2])
+        remote = FVSRepo(self.remote_path, no_init=True)
+        self.assertEqual(remote.states.keys(), [0, 2])
+        self.assertEqual(
+            sorted(_file.relative_path for _file in remote.get_state(2).iter_files()), ["keep"]
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()